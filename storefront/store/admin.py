@@ -1,8 +1,7 @@
 from django.contrib import admin
-from django.db.models.aggregates import Count
 from django.utils.html import format_html, urlencode
 from django.urls import reverse
-from . import models
+from . import images, models
 # Register your models here.
 
 class InventoryFilter(admin.SimpleListFilter):
@@ -25,7 +24,8 @@ class ProductImageInline(admin.TabularInline):
 
     def thumbnail(self, instance):
         if instance.image.name != '': # Если есть картинка
-            return format_html(f'<img src="{instance.image.url}" width="75px">')
+            # Маленький вариант, а не оригинал на сотни КБ
+            return format_html(f'<img src="{images.get_thumbnail_url(instance)}" width="75px">')
 
 
 @admin.register(models.Product)
@@ -63,9 +63,3 @@ class CollectionAdmin(admin.ModelAdmin):
         })
         )
         return format_html(f'<a href="{url}">{collection.products_count}</a>')
-
-
-    def get_queryset(self, request):
-        return super().get_queryset(request).annotate(
-            products_count=Count('products')
-        )
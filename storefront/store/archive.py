@@ -0,0 +1,32 @@
+from django.db import transaction
+from .models import ArchivedOrder, ArchivedOrderItem, Order, OrderItem
+
+# Перенос старых заказов из горячих таблиц в архивные.
+# Каждая пачка - одна транзакция: заказы копируются в архив и удаляются
+# из горячих таблиц вместе, поэтому заказ всегда лежит ровно в одном месте
+
+ORDER_FIELDS = ['id', 'placed_at', 'payment_status', 'customer_id',
+                'total_price', 'item_count', 'sales_recorded']
+ITEM_FIELDS = ['id', 'order_id', 'product_id', 'quantity', 'unit_price']
+
+
+def archive_batch(cutoff, after_id, batch_size, using='default'):
+    # Возвращает id перенесенных заказов
+    with transaction.atomic(using=using):
+        orders = list(Order.objects.using(using).select_for_update()
+                      .filter(placed_at__lt=cutoff, id__gt=after_id)
+                      .order_by('id').values(*ORDER_FIELDS)[:batch_size])
+        if not orders:
+            return []
+        ids = [order['id'] for order in orders]
+        items = list(OrderItem.objects.using(using).filter(order_id__in=ids)
+                     .order_by().values(*ITEM_FIELDS))
+
+        ArchivedOrder.objects.using(using).bulk_create(
+            [ArchivedOrder(**order) for order in orders])
+        ArchivedOrderItem.objects.using(using).bulk_create(
+            [ArchivedOrderItem(**item) for item in items])
+        # Сначала строки - заказ защищен от удаления, пока на него есть ссылки
+        OrderItem.objects.using(using).filter(order_id__in=ids).delete()
+        Order.objects.using(using).filter(id__in=ids).delete()
+    return ids
@@ -0,0 +1,147 @@
+import time
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import router, transaction
+from django.utils.crypto import salted_hmac
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
+from rest_framework_simplejwt.settings import api_settings
+from .cache import get_cache
+from . import customers
+
+# Аутентификация по claims токена. При выдаче в токен пишутся is_staff,
+# is_superuser, customer_id и хэш пароля, и запросу не нужна строка auth_user:
+# права проверяются по токену. Отключенных и измененных пользователей
+# отсекает кэш их состояния (живет STORE_JWT_USER_STATE_TTL секунд)
+# и отметка об отзыве всех токенов, выданных до нее.
+# Сигналы сбрасывают кэш сразу, но только в том кэше, который видит
+# процесс. С общим кэшем (redis, memcached) изменение действует сразу везде.
+# С кэшем в памяти процесса (locmem) другие процессы увидят его, когда
+# истечет их копия состояния: не позже чем через STORE_JWT_USER_STATE_TTL.
+
+CLAIMS = ('is_staff', 'is_superuser', 'customer_id', 'auth_hash')
+# Изменение этих полей пользователя отзывает его токены
+AUTH_FIELDS = ('is_active', 'is_staff', 'is_superuser', 'password')
+
+
+def user_state_key(user_id):
+    return f'store:auth-state:{user_id}'
+
+
+def revoked_key(user_id):
+    return f'store:auth-revoked:{user_id}'
+
+
+def get_revoked_timeout():
+    # Отметка нужна, пока жив последний токен, выданный до нее. Access токен,
+    # полученный через refresh, наследует iat refresh токена
+    lifetime = api_settings.ACCESS_TOKEN_LIFETIME + api_settings.REFRESH_TOKEN_LIFETIME
+    return int(lifetime.total_seconds())
+
+
+def get_auth_hash(password):
+    # Меняется вместе с паролем: токены, выданные до смены, перестают подходить
+    return salted_hmac('store.authentication.get_auth_hash', password or '',
+                       algorithm='sha256').hexdigest()[:32]
+
+
+def get_user_state(user_id):
+    # (is_active, is_staff, is_superuser, auth_hash, customer_id) и время
+    # отзыва токенов - одним походом в кэш
+    cache = get_cache()
+    state_key, revoked = user_state_key(user_id), revoked_key(user_id)
+    found = cache.get_many([state_key, revoked])
+    state = found.get(state_key)
+    if state is None:
+        state = (get_user_model().objects
+                 .filter(**{api_settings.USER_ID_FIELD: user_id})
+                 .values_list('is_active', 'is_staff', 'is_superuser', 'password',
+                              'customer__id').first())
+        # Удаленный пользователь - то же, что отключенный
+        state = ((*state[:3], get_auth_hash(state[3]), state[4]) if state
+                 else (False, False, False, None, None))
+        cache.set(state_key, state, getattr(settings, 'STORE_JWT_USER_STATE_TTL', 60))
+    return state, found.get(revoked)
+
+
+def get_auth_state(user):
+    # Только загруженные поля: отложенные не читаем, чтобы не делать запрос
+    return tuple(user.__dict__.get(name) for name in AUTH_FIELDS)
+
+
+def forget(user_ids, using='default'):
+    # Состояние пользователя перечитается из базы на следующем запросе
+    def delete():
+        get_cache().delete_many([user_state_key(user_id) for user_id in user_ids])
+    transaction.on_commit(delete, using=using)
+
+
+def revoke(user_ids, using='default'):
+    def write():
+        cache = get_cache()
+        cache.delete_many([user_state_key(user_id) for user_id in user_ids])
+        # iat в токене - целые секунды, поэтому и отметка в целых секундах:
+        # токен, выданный в ту же секунду после отзыва, должен работать
+        revoked_at = int(time.time())
+        cache.set_many({revoked_key(user_id): revoked_at for user_id in user_ids},
+                       get_revoked_timeout())
+    transaction.on_commit(write, using=using)
+
+
+class ClaimsTokenObtainPairSerializer(TokenObtainPairSerializer):
+    @classmethod
+    def get_token(cls, user):
+        token = super().get_token(user)
+        token['is_staff'] = user.is_staff
+        token['is_superuser'] = user.is_superuser
+        token['customer_id'] = customers.get_customer_id_for_user(user.id)
+        token['auth_hash'] = get_auth_hash(user.password)
+        return token
+
+
+class ClaimsJWTAuthentication(JWTAuthentication):
+    def get_user(self, validated_token):
+        if any(claim not in validated_token for claim in CLAIMS):
+            # Токен выдан до появления claims - берем пользователя из базы
+            return super().get_user(validated_token)
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken('Токен не содержит id пользователя')
+
+        state, revoked_at = get_user_state(user_id)
+        is_active, is_staff, is_superuser, auth_hash, customer_id = state
+        if not is_active:
+            raise AuthenticationFailed('Пользователь отключен', code='user_inactive')
+        if ((revoked_at is not None and validated_token.get('iat', 0) < revoked_at)
+                or auth_hash != validated_token['auth_hash']):
+            raise AuthenticationFailed('Токен отозван, войдите заново', code='token_revoked')
+        if customer_id != validated_token['customer_id']:
+            # Покупателя удалили или отдали другому пользователю -
+            # customer_id из токена больше не его
+            raise AuthenticationFailed('Покупатель изменился, войдите заново',
+                                       code='token_revoked')
+        if (is_staff, is_superuser) != (validated_token['is_staff'],
+                                        validated_token['is_superuser']):
+            # Права изменились в обход сигналов (например, через update())
+            raise AuthenticationFailed('Права пользователя изменились, войдите заново',
+                                       code='token_revoked')
+
+        # Пользователь без запроса к базе: загружены только поля из токена,
+        # остальные (email, username...) подгрузятся при первом обращении.
+        # save() такого объекта пишет только загруженные поля
+        user_model = get_user_model()
+        loaded = {
+            user_model._meta.get_field(api_settings.USER_ID_FIELD).attname: user_id,
+            'is_active': True,
+            'is_staff': is_staff,
+            'is_superuser': is_superuser,
+        }
+        names = [field.attname for field in user_model._meta.concrete_fields
+                 if field.attname in loaded]
+        user = user_model.from_db(router.db_for_read(user_model), names,
+                                  [loaded[name] for name in names])
+        user.customer_id = validated_token['customer_id']
+        return user
@@ -0,0 +1,267 @@
+import csv
+import io
+import json
+from itertools import islice
+
+from django.conf import settings
+from django.db import DatabaseError, transaction
+from .models import Collection, Product, Promotion
+from .serializers import ProductImportSerializer
+from . import search
+
+# Массовый импорт и экспорт товаров в NDJSON и CSV.
+# Одна запись = один товар, товары связываются по slug.
+
+EXPORT_FIELDS = ['slug', 'title', 'description', 'unit_price', 'inventory',
+                 'collection', 'promotion']
+UPDATE_FIELDS = ['title', 'description', 'unit_price', 'inventory', 'collection']
+CSV_LIST_SEPARATOR = ';'  # Разделитель id акций в CSV
+ENCODING_ERROR = 'Строка не в кодировке UTF-8'
+
+
+def get_batch_size(value, default_setting='STORE_IMPORT_BATCH_SIZE'):
+    default = getattr(settings, default_setting, 500)
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        return default
+    return max(1, min(value, 10000))
+
+
+def decode_lines(lines):
+    # Отдает тройки (номер строки, текст, строка в UTF-8 или нет).
+    # Первую строку читаем как utf-8-sig: Excel пишет BOM в начало файла
+    for number, line in enumerate(lines, start=1):
+        encoding = 'utf-8-sig' if number == 1 else 'utf-8'
+        try:
+            yield number, line.decode(encoding), True
+        except UnicodeDecodeError:
+            yield number, line.decode(encoding, errors='replace'), False
+
+
+def read_ndjson(lines):
+    # Отдает пары (номер строки, данные или текст ошибки)
+    for number, line, valid in decode_lines(lines):
+        if not valid:
+            yield number, ENCODING_ERROR
+            continue
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as error:
+            yield number, f'Некорректный JSON: {error}'
+            continue
+        if not isinstance(record, dict):
+            yield number, 'Ожидается JSON объект'
+            continue
+        yield number, record
+
+
+def read_csv(lines):
+    # Запись CSV может занимать несколько строк файла, поэтому запоминаем
+    # строки не в UTF-8 и отдаем ошибкой всю запись, в которую они попали
+    invalid = []
+
+    def text_lines():
+        for number, line, valid in decode_lines(lines):
+            if not valid:
+                invalid.append(number)
+            yield line
+
+    reader = csv.DictReader(text_lines())
+    if reader.fieldnames is not None and invalid:
+        invalid.clear()
+        yield 1, ENCODING_ERROR
+    for record in reader:
+        # Номер строки файла с учетом заголовка
+        number = reader.line_num
+        if invalid:
+            invalid.clear()
+            yield number, ENCODING_ERROR
+            continue
+        record = {key: value for key, value in record.items()
+                  if key is not None and value != ''}
+        if 'promotion' in record:
+            record['promotion'] = [value for value in
+                                   record['promotion'].split(CSV_LIST_SEPARATOR) if value]
+        yield number, record
+
+
+class ProductImporter:
+    def __init__(self, batch_size, using='default'):
+        self.batch_size = batch_size
+        self.using = using
+        self.created = 0
+        self.updated = 0
+        self.errors = []
+
+    def run(self, records):
+        records = iter(records)
+        while True:
+            batch = list(islice(records, self.batch_size))
+            if not batch:
+                break
+            self.import_batch(batch)
+        return {'created': self.created, 'updated': self.updated, 'errors': self.errors}
+
+    def validate(self, batch):
+        valid = {}
+        for number, record in batch:
+            if isinstance(record, str):
+                self.errors.append({'line': number, 'errors': record})
+                continue
+            serializer = ProductImportSerializer(data=record)
+            if not serializer.is_valid():
+                self.errors.append({'line': number, 'errors': serializer.errors})
+                continue
+            data = serializer.validated_data
+            if data['slug'] in valid:
+                self.errors.append({'line': number,
+                                    'errors': {'slug': ['Повторяется в этой пачке']}})
+                continue
+            valid[data['slug']] = (number, data)
+
+        # Проверяем связи сразу для всей пачки - по одному запросу на модель
+        collection_ids = {data['collection'] for number, data in valid.values()}
+        promotion_ids = {promotion for number, data in valid.values()
+                         for promotion in data.get('promotion', [])}
+        known_collections = set(Collection.objects.using(self.using)
+                                .filter(pk__in=collection_ids).values_list('pk', flat=True))
+        known_promotions = set(Promotion.objects.using(self.using)
+                               .filter(pk__in=promotion_ids).values_list('pk', flat=True))
+        for slug, (number, data) in list(valid.items()):
+            errors = {}
+            if data['collection'] not in known_collections:
+                errors['collection'] = [f'Нет категории с id {data["collection"]}']
+            missing = set(data.get('promotion', [])) - known_promotions
+            if missing:
+                errors['promotion'] = [f'Нет акций с id {sorted(missing)}']
+            if errors:
+                self.errors.append({'line': number, 'errors': errors})
+                del valid[slug]
+        return valid
+
+    def import_batch(self, batch):
+        valid = self.validate(batch)
+        if not valid:
+            return
+        try:
+            with transaction.atomic(using=self.using):
+                created, updated, errors = self.write(valid)
+        except DatabaseError as error:
+            # Ошибка базы откатывает только эту пачку, импорт продолжается.
+            # Ошибки из write не записываем - строки пачки уже перечислены здесь
+            self.errors.append({'lines': [number for number, data in valid.values()],
+                                'errors': str(error)})
+            return
+        self.created += created
+        self.updated += updated
+        self.errors.extend(errors)
+
+    def write(self, valid):
+        products = Product.objects.using(self.using)
+        existing = {}
+        descriptions = {}
+        duplicated = set()
+        errors = []
+        for slug, pk, description in (products.filter(slug__in=list(valid))
+                                      .values_list('slug', 'pk', 'description')):
+            if slug in existing:
+                duplicated.add(slug)
+            existing[slug] = pk
+            descriptions[slug] = description
+
+        to_create = []
+        to_update = {}  # Поля из записи -> товары: отсутствующие поля не затираем
+        promotions = {}
+        for slug, (number, data) in valid.items():
+            if slug in duplicated:
+                errors.append({'line': number, 'errors': {
+                    'slug': ['В базе несколько товаров с таким slug']
+                }})
+                continue
+            product = Product(
+                pk=existing.get(slug), slug=slug, title=data['title'],
+                # Без описания в записи оставляем прежнее - оно нужно поисковому индексу
+                description=data.get('description', descriptions.get(slug)),
+                unit_price=data['unit_price'],
+                inventory=data['inventory'], collection_id=data['collection'],
+            )
+            if product.pk:
+                fields = tuple(name for name in UPDATE_FIELDS if name in data)
+                to_update.setdefault(fields, []).append(product)
+            else:
+                to_create.append(product)
+            if 'promotion' in data:
+                promotions[slug] = data['promotion']
+
+        for fields, objs in to_update.items():
+            products.bulk_update(objs, fields)
+        if to_create:
+            products.bulk_create(to_create)
+
+        updated = [product for objs in to_update.values() for product in objs]
+        written = to_create + updated
+        self.write_promotions([product for product in written if product.slug in promotions],
+                              promotions)
+        # Массовые операции не вызывают сигналы - обновляем поисковый индекс сами
+        search.index_products([(product.pk, product.title, product.description)
+                               for product in written], using=self.using)
+        return len(to_create), len(updated), errors
+
+    def write_promotions(self, products, promotions):
+        if not products:
+            return
+        through = Product.promotion.through
+        links = through.objects.using(self.using)
+        links.filter(product_id__in=[product.pk for product in products]).delete()
+        links.bulk_create([
+            through(product_id=product.pk, promotion_id=promotion_id)
+            for product in products for promotion_id in promotions[product.slug]
+        ])
+
+
+def export_rows(queryset, chunk_size):
+    # Отдает словари товаров, не держа в памяти больше одной пачки
+    rows = queryset.order_by('id').values_list(
+        'id', 'slug', 'title', 'description', 'unit_price', 'inventory', 'collection_id'
+    ).iterator(chunk_size=chunk_size)
+    through = Product.promotion.through
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+        promotions = {}
+        for product_id, promotion_id in (through.objects.using(queryset.db)
+                                         .filter(product_id__in=[row[0] for row in chunk])
+                                         .values_list('product_id', 'promotion_id')):
+            promotions.setdefault(product_id, []).append(promotion_id)
+        for pk, slug, title, description, unit_price, inventory, collection_id in chunk:
+            yield {
+                'slug': slug,
+                'title': title,
+                'description': description,
+                'unit_price': str(unit_price),
+                'inventory': inventory,
+                'collection': collection_id,
+                'promotion': sorted(promotions.get(pk, [])),
+            }
+
+
+def export_ndjson(queryset, chunk_size):
+    for row in export_rows(queryset, chunk_size):
+        yield json.dumps(row, ensure_ascii=False) + '\n'
+
+
+def export_csv(queryset, chunk_size):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_FIELDS)
+    writer.writeheader()
+    for row in export_rows(queryset, chunk_size):
+        row['promotion'] = CSV_LIST_SEPARATOR.join(str(pk) for pk in row['promotion'])
+        writer.writerow(row)
+        # Отдаем накопленный текст сразу, не собирая весь файл в памяти
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
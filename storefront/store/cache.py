@@ -0,0 +1,155 @@
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from rest_framework.response import Response
+
+# Кэш ответов каталога. У каждой модели есть счетчик поколений (generation).
+# Он входит в ключ кэша, поэтому после изменения модели старые ответы
+# просто перестают читаться, и весь кэш чистить не нужно.
+
+
+def get_cache():
+    return caches[getattr(settings, 'STORE_CACHE_ALIAS', 'default')]
+
+
+def generation_key(model):
+    return f'store:generation:{model._meta.label_lower}'
+
+
+def get_versions(keys, timeout=None):
+    cache = get_cache()
+    generations = cache.get_many(keys)
+    for key in keys:
+        if key not in generations:
+            # Счетчик вытеснили из кэша - начинаем с текущего времени,
+            # чтобы не совпасть со старыми ключами
+            cache.add(key, time.time_ns(), timeout=timeout)
+            generations[key] = cache.get(key)
+    return [generations[key] for key in keys]
+
+
+def bump_version(key, timeout=None):
+    cache = get_cache()
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, time.time_ns(), timeout=timeout)
+
+
+def generation_time_key(model):
+    return f'store:generation-time:{model._meta.label_lower}'
+
+
+def get_generations(models):
+    return get_versions([generation_key(model) for model in models])
+
+
+def get_last_modified(models):
+    # Время последней смены поколения любой из моделей (unix time) - для Last-Modified
+    cache = get_cache()
+    keys = [generation_time_key(model) for model in models]
+    times = cache.get_many(keys)
+    for key in keys:
+        if key not in times:
+            # Без срока, как и сам счетчик поколений: иначе время сдвинется
+            # вперед без изменений и клиенты перекачают все заново
+            cache.add(key, time.time(), timeout=None)
+            times[key] = cache.get(key)
+    return max(times.values(), default=None)
+
+
+def bump_generation(model):
+    # Сначала время, потом поколение: кто увидит новое поколение,
+    # увидит и новое время
+    get_cache().set(generation_time_key(model), time.time(), timeout=None)
+    bump_version(generation_key(model))
+
+
+def invalidate(model, using='default'):
+    # Меняем поколение только после коммита. Иначе параллельный запрос
+    # может закэшировать старые данные уже под новым поколением
+    transaction.on_commit(lambda: bump_generation(model), using=using)
+
+
+# Сумма корзины. У каждой корзины свой счетчик, его меняет любая запись
+# в CartItem. В ключ суммы входит и поколение товаров - после смены цены
+# старая сумма тоже перестает читаться
+
+def get_cart_total_timeout():
+    return getattr(settings, 'STORE_CART_TOTAL_CACHE_TIMEOUT', 60 * 60)
+
+
+def cart_version_key(cart_id):
+    return f'store:cart-version:{cart_id}'
+
+
+def get_cart_total(cart_id, models, compute):
+    cache = get_cache()
+    timeout = get_cart_total_timeout()
+    versions = get_versions([cart_version_key(cart_id)], timeout) + get_generations(models)
+    key = f'store:cart-total:{cart_id}:' + ':'.join(str(version) for version in versions)
+    total = cache.get(key)
+    if total is None:
+        total = compute()
+        cache.set(key, total, timeout)
+    return total
+
+
+def invalidate_cart(cart_id, using='default'):
+    transaction.on_commit(lambda: bump_version(cart_version_key(cart_id),
+                                               get_cart_total_timeout()), using=using)
+
+
+def make_key(prefix, request, models, generations=None):
+    # Одинаковые запросы с разным порядком параметров дают один ключ
+    params = sorted(
+        (name, value)
+        for name, values in request.query_params.lists()
+        for value in values if value != ''
+    )
+    if generations is None:
+        generations = get_generations(models)
+    raw = repr((request.get_host(), request.path, params, generations))
+    return f'store:response:{prefix}:{hashlib.sha1(raw.encode()).hexdigest()}'
+
+
+class CachedResponseMixin:
+    # Кэширует GET ответы list и retrieve.
+    # cache_models - модели, от которых зависит ответ
+    cache_models = ()
+    cache_timeout = None
+
+    def get_cache_timeout(self):
+        if self.cache_timeout is not None:
+            return self.cache_timeout
+        return getattr(settings, 'STORE_CACHE_TIMEOUT', 60 * 5)
+
+    def get_generations(self):
+        # Читаем один раз за запрос: из этих же поколений ConditionalGetMixin
+        # строит ETag, поэтому ETag и закэшированный ответ всегда одной версии
+        if getattr(self, 'generations', None) is None:
+            self.generations = get_generations(self.cache_models)
+        return self.generations
+
+    def cached_response(self, handler, request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return handler(request, *args, **kwargs)
+        cache = get_cache()
+        key = make_key(f'{self.basename}-{self.action}', request, self.cache_models,
+                       self.get_generations())
+        data = cache.get(key)
+        if data is not None:
+            return Response(data)
+        response = handler(request, *args, **kwargs)
+        if response.status_code == 200:
+            cache.set(key, response.data, self.get_cache_timeout())
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self.cached_response(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.cached_response(super().retrieve, request, *args, **kwargs)
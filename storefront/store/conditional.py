@@ -0,0 +1,80 @@
+import hashlib
+
+from django.core.exceptions import ValidationError
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from . import cache
+
+# Условные GET запросы (ETag / Last-Modified / 304).
+# Версия списка - поколения моделей из cache_models (store/cache.py),
+# те же, что входят в ключ кэша ответа CachedResponseMixin. Их читаем
+# из кэша, без запросов к базе и до сериализации.
+# Версия одного объекта - его собственные version_fields (last_update),
+# один запрос по первичному ключу: правка другого товара не меняет
+# ETag этого. Ключ кэша ответа строится из той же версии.
+# Если клиент прислал совпадающий If-None-Match или If-Modified-Since -
+# сразу отвечаем 304. Подключается вместе с CachedResponseMixin.
+
+
+class ConditionalGetMixin:
+    # Поля, которые меняются вместе с ответом retrieve. Пусто - и для
+    # одного объекта версия по поколениям моделей
+    version_fields = ()
+
+    def get_generations(self):
+        if self.action != 'retrieve' or not self.version_fields:
+            return super().get_generations()
+        if getattr(self, 'generations', None) is None:
+            self.generations = self.get_object_version()
+        return self.generations
+
+    def get_object_version(self):
+        # None - объекта нет, ответ будет 404
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        try:
+            return (self.queryset.model.objects
+                    .filter(**{self.lookup_field: self.kwargs[lookup_url_kwarg]})
+                    .values_list(*self.version_fields).first())
+        except (ValueError, ValidationError):
+            return None
+
+    def get_last_modified(self, generations):
+        if self.action == 'retrieve' and self.version_fields:
+            return max(value.timestamp() for value in generations if value is not None)
+        return cache.get_last_modified(self.cache_models)
+
+    def make_etag(self, request, generations):
+        # В ETag входят параметры запроса и формат ответа,
+        # чтобы разные представления не совпадали
+        params = sorted(
+            (name, value)
+            for name, values in request.query_params.lists()
+            for value in values
+        )
+        media_type = getattr(request, 'accepted_media_type', '')
+        raw = repr((request.path, params, media_type, generations))
+        return quote_etag(hashlib.sha1(raw.encode()).hexdigest())
+
+    def conditional_response(self, handler, request, *args, **kwargs):
+        generations = self.get_generations()
+        if generations is None:
+            return handler(request, *args, **kwargs)
+        etag = self.make_etag(request, generations)
+        last_modified = self.get_last_modified(generations)
+        timestamp = int(last_modified) if last_modified else None
+        response = get_conditional_response(request._request, etag=etag,
+                                            last_modified=timestamp)
+        if response is None:
+            response = handler(request, *args, **kwargs)
+            if response.status_code != 200:
+                return response
+        response['ETag'] = etag
+        if timestamp is not None:
+            response['Last-Modified'] = http_date(timestamp)
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self.conditional_response(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.conditional_response(super().retrieve, request, *args, **kwargs)
@@ -0,0 +1,52 @@
+from django.conf import settings
+from django.db import transaction
+from .cache import get_cache
+from .models import Customer
+
+# Покупатель текущего пользователя. Связка user_id -> customer_id
+# хранится в кэше (сбрасывается сигналами при изменении Customer),
+# а в пределах запроса запоминается на самом request.
+
+
+def customer_cache_key(user_id):
+    return f'store:customer-id:{user_id}'
+
+
+def get_customer_id_for_user(user_id):
+    cache = get_cache()
+    key = customer_cache_key(user_id)
+    customer_id = cache.get(key)
+    if customer_id is None:
+        customer = get_or_create_customer(user_id)
+        customer_id = customer.id
+        cache.set(key, customer_id, getattr(settings, 'STORE_CUSTOMER_CACHE_TIMEOUT', 60 * 60))
+    return customer_id
+
+
+def get_or_create_customer(user_id):
+    # Покупатель создается при первом обращении. get_or_create сам
+    # разбирается с гонкой: при параллельном создании сработает уникальность
+    # user_id и он вернет уже созданную запись
+    customer, created = Customer.objects.get_or_create(user_id=user_id)
+    return customer
+
+
+def get_customer_id(request):
+    if not hasattr(request, 'customer_id'):
+        # Токен с claims уже знает покупателя (store.authentication)
+        request.customer_id = (getattr(request.user, 'customer_id', None)
+                               or get_customer_id_for_user(request.user.id))
+    return request.customer_id
+
+
+def get_customer(request):
+    if not hasattr(request, 'customer'):
+        request.customer = Customer.objects.get(pk=get_customer_id(request))
+    return request.customer
+
+
+def invalidate(user_ids, using='default'):
+    def delete():
+        get_cache().delete_many([customer_cache_key(user_id)
+                                 for user_id in user_ids if user_id is not None])
+    transaction.on_commit(delete, using=using)
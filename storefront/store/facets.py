@@ -0,0 +1,86 @@
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.db.models import Case, Count, IntegerField, Q, Value, When
+from rest_framework.exceptions import ValidationError
+from .filters import ProductFilter
+
+# Счетчики фасетов каталога: сколько товаров в каждой категории и в каждом
+# ценовом диапазоне при текущем поиске и фильтрах. Все считается одним
+# GROUP BY запросом с условными Count: для фасета категорий не учитывается
+# фильтр по категории, для фасета цен - фильтр по цене. Так клиент видит,
+# сколько товаров получит, если поменяет именно этот фильтр.
+
+MAX_PRICE_BUCKETS = 20
+
+
+def get_price_bounds(request):
+    # Границы диапазонов: [0, 10, 50] -> 0-10, 10-50, 50 и выше
+    bounds = getattr(settings, 'STORE_FACET_PRICE_BUCKETS', [0, 10, 50, 100, 500])
+    value = request.query_params.get('price_buckets')
+    if value:
+        try:
+            bounds = [Decimal(bound) for bound in value.split(',')[:MAX_PRICE_BUCKETS + 1]]
+        except InvalidOperation:
+            bounds = None
+        # NaN и Infinity Decimal принимает, но сравнивать с ними цену нельзя
+        if bounds is None or not all(bound.is_finite() for bound in bounds):
+            raise ValidationError({'price_buckets': ['Ожидаются числа через запятую']})
+    return sorted(set(Decimal(bound) for bound in bounds))
+
+
+def get_filter_conditions(request, queryset):
+    # Условия ProductFilter отдельно: по категории и по цене
+    filterset = ProductFilter(request.query_params, queryset=queryset, request=request)
+    # Как и список товаров: неверный фильтр - 400, а не счетчики по всему каталогу
+    if not filterset.is_valid():
+        raise ValidationError(filterset.errors)
+    data = filterset.form.cleaned_data
+    collection_q = Q()
+    if data.get('collection_id') is not None:
+        collection_q &= Q(collection_id=data['collection_id'])
+    price_q = Q()
+    for lookup in ('unit_price__gt', 'unit_price__lt'):
+        if data.get(lookup) is not None:
+            price_q &= Q(**{lookup: data[lookup]})
+    return collection_q, price_q
+
+
+def get_facets(request, queryset):
+    bounds = get_price_bounds(request)
+    collection_q, price_q = get_filter_conditions(request, queryset)
+    bucket = Case(
+        *[When(unit_price__gte=bound, then=Value(index))
+          for index, bound in reversed(list(enumerate(bounds)))],
+        default=Value(-1), output_field=IntegerField(),
+    )
+    rows = (queryset.order_by()
+            .annotate(bucket=bucket)
+            .values('collection_id', 'collection__title', 'bucket')
+            .annotate(total=Count('id', filter=collection_q & price_q),
+                      in_collection=Count('id', filter=price_q),
+                      in_price=Count('id', filter=collection_q)))
+
+    total = 0
+    collections = {}
+    prices = [0] * len(bounds)
+    for row in rows:
+        total += row['total']
+        collection = collections.setdefault(row['collection_id'], {
+            'id': row['collection_id'], 'title': row['collection__title'], 'count': 0,
+        })
+        collection['count'] += row['in_collection']
+        if row['bucket'] >= 0:
+            prices[row['bucket']] += row['in_price']
+
+    return {
+        'count': total,
+        'collections': sorted((collection for collection in collections.values()
+                               if collection['count']),
+                              key=lambda collection: collection['title']),
+        'price': [{
+            'min': bound,
+            'max': bounds[index + 1] if index + 1 < len(bounds) else None,
+            'count': prices[index],
+        } for index, bound in enumerate(bounds)],
+    }
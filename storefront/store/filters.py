@@ -1,5 +1,7 @@
 from django_filters.rest_framework import FilterSet
+from rest_framework.filters import SearchFilter
 from .models import Product
+from . import search
 
 class ProductFilter(FilterSet):
     class Meta:
@@ -7,4 +9,16 @@ class ProductFilter(FilterSet):
         fields = {
             'collection_id': ['exact'],
             'unit_price': ['gt', 'lt']
-        }
\ No newline at end of file
+        }
+
+
+class ProductSearchFilter(SearchFilter):
+    # Ищет через полнотекстовый индекс (store/search.py) вместо
+    # icontains по всей таблице. Результат сортируется по релевантности,
+    # если клиент не передал свой ?ordering=
+    def filter_queryset(self, request, queryset, view):
+        words = search.get_search_words(self.get_search_terms(request))
+        backend = search.get_backend(queryset.db)
+        if not words or backend is None:
+            return super().filter_queryset(request, queryset, view)
+        return backend.search(queryset, words).order_by('-search_rank')
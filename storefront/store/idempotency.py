@@ -0,0 +1,133 @@
+import hashlib
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.response import Response
+from rest_framework.throttling import BaseThrottle
+from .models import IdempotencyKey
+
+# Заголовок Idempotency-Key для POST запросов. Первый запрос с ключом
+# занимает строку в IdempotencyKey, выполняется и сохраняет ответ.
+# Повторы с тем же ключом получают этот ответ. Если первый запрос
+# еще выполняется - повтор ждет его, а не выполняет его второй раз.
+# Если воркер упал посреди запроса, ключ занят не дольше
+# STORE_IDEMPOTENCY_LEASE: после этого запрос выполнит следующий повтор.
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+POLL_INTERVAL = 0.1
+
+
+def get_ttl():
+    return timedelta(seconds=getattr(settings, 'STORE_IDEMPOTENCY_TTL', 60 * 60 * 24))
+
+
+def get_lease():
+    return timedelta(seconds=getattr(settings, 'STORE_IDEMPOTENCY_LEASE', 60))
+
+
+def get_client(request):
+    if request.user.is_authenticated:
+        return request.user.pk
+    # У анонимов нет id - различаем клиентов по адресу (с учетом
+    # X-Forwarded-For и NUM_PROXIES) и User-Agent, иначе два анонима
+    # с одинаковым ключом получат ответы друг друга
+    return (BaseThrottle().get_ident(request), request.headers.get('User-Agent', ''))
+
+
+def make_lookup(request, key):
+    raw = repr((get_client(request), request.path, key))
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+def make_request_hash(request):
+    return hashlib.sha256(request.body).hexdigest()
+
+
+class IdempotentCreateMixin:
+    def create(self, request, *args, **kwargs):
+        return self.idempotent_response(super().create, request, *args, **kwargs)
+
+    def idempotent_response(self, handler, request, *args, **kwargs):
+        key = request.headers.get(IDEMPOTENCY_HEADER)
+        if key is None:
+            return handler(request, *args, **kwargs)
+        if not key or len(key) > 255:
+            return Response({'detail': f'Некорректный {IDEMPOTENCY_HEADER}'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        lookup = make_lookup(request, key)
+        request_hash = make_request_hash(request)
+        record, claimed_at = self.claim(lookup, request_hash)
+        if record is not None:
+            return self.replay(record, request_hash)
+
+        # Пишем только в свой захват: если аренду перехватил повтор,
+        # его запись не трогаем
+        claim = IdempotencyKey.objects.filter(lookup=lookup, claimed_at=claimed_at,
+                                              status_code=None)
+        try:
+            response = handler(request, *args, **kwargs)
+        except Exception:
+            # Запрос упал - освобождаем ключ, повтор выполнится заново
+            claim.delete()
+            raise
+        if response.status_code >= 500:
+            claim.delete()
+        else:
+            claim.update(status_code=response.status_code, response=response.data)
+        return response
+
+    def claim(self, lookup, request_hash):
+        # (None, время захвата) - ключ наш, запрос надо выполнить.
+        # Иначе - (запись первого запроса с этим ключом, None)
+        while True:
+            now = timezone.now()
+            try:
+                with transaction.atomic():
+                    IdempotencyKey.objects.create(lookup=lookup, request_hash=request_hash,
+                                                  claimed_at=now)
+                return None, now
+            except IntegrityError:
+                pass
+            record = IdempotencyKey.objects.filter(lookup=lookup).first()
+            if record is None:
+                # Первый запрос упал и освободил ключ
+                continue
+            if record.created_at < now - get_ttl():
+                # Ключ устарел - занимаем его заново
+                IdempotencyKey.objects.filter(pk=record.pk).delete()
+                continue
+            if (record.status_code is None and record.request_hash == request_hash
+                    and record.claimed_at < now - get_lease()):
+                # Первый запрос не ответил за время аренды - его воркер упал.
+                # Перехватываем ключ условным UPDATE: из нескольких повторов
+                # ключ достанется одному
+                if IdempotencyKey.objects.filter(pk=record.pk, status_code=None,
+                                                 claimed_at=record.claimed_at).update(
+                        claimed_at=now):
+                    return None, now
+                continue
+            return record, None
+
+    def replay(self, record, request_hash):
+        if record.request_hash != request_hash:
+            return Response({'detail': f'{IDEMPOTENCY_HEADER} уже использован '
+                                       f'с другим телом запроса'},
+                            status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+        deadline = time.monotonic() + getattr(settings, 'STORE_IDEMPOTENCY_WAIT', 10)
+        while record is not None and record.status_code is None:
+            if time.monotonic() > deadline:
+                return Response({'detail': 'Запрос с этим ключом еще выполняется'},
+                                status=status.HTTP_409_CONFLICT)
+            time.sleep(POLL_INTERVAL)
+            record = IdempotencyKey.objects.filter(pk=record.pk).first()
+        if record is None:
+            # Первый запрос упал, пока мы ждали
+            return Response({'detail': 'Запрос с этим ключом не выполнен, повторите его'},
+                            status=status.HTTP_409_CONFLICT)
+        return Response(record.response, status=record.status_code,
+                        headers={'Idempotent-Replayed': 'true'})
@@ -0,0 +1,137 @@
+import io
+import os
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import connection, transaction
+from django.utils import timezone
+from PIL import Image, ImageOps
+from .models import Product, ProductImage, change_blob_refs, get_blob_names
+from . import cache
+
+# Уменьшенные копии картинок товаров (варианты). Оригинал может весить
+# до 500 КБ, а списку товаров и админке хватает превью. Варианты строит
+# фоновая задача после загрузки, их имена лежат в ProductImage.variants:
+# {'thumbnail': {'webp': имя, 'jpeg': имя}, ...}
+
+# Формат -> (формат Pillow, расширение, параметры сохранения)
+FORMATS = {
+    'webp': ('WEBP', 'webp', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', 'jpg', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+VARIANTS_DIR = 'variants'
+
+
+def get_storage():
+    return ProductImage._meta.get_field('image').storage
+
+
+def get_sizes():
+    # Вариант -> максимальная сторона в пикселях
+    return getattr(settings, 'STORE_IMAGE_VARIANTS',
+                   {'thumbnail': 150, 'card': 600, 'zoom': 1600})
+
+
+def get_variant_urls(variants, request=None):
+    storage = get_storage()
+    urls = {}
+    for variant, names in (variants or {}).items():
+        urls[variant] = {}
+        for image_format, name in names.items():
+            url = storage.url(name)
+            if request is not None:
+                url = request.build_absolute_uri(url)
+            urls[variant][image_format] = url
+    return urls
+
+
+def get_thumbnail_url(image):
+    # Маленький JPEG (его понимают все браузеры), пока его нет - оригинал
+    name = (image.variants or {}).get('thumbnail', {}).get('jpeg')
+    return get_storage().url(name) if name else image.image.url
+
+
+def resize(original, size):
+    image = original.copy()
+    # thumbnail() только уменьшает и сохраняет пропорции
+    image.thumbnail((size, size), Image.LANCZOS)
+    return image
+
+
+def encode(image, image_format):
+    pillow_format, extension, options = FORMATS[image_format]
+    if pillow_format == 'JPEG' and image.mode != 'RGB':
+        # У JPEG нет прозрачности - кладем картинку на белый фон
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel('A'))
+        image = background
+    elif image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA')
+    buffer = io.BytesIO()
+    image.save(buffer, pillow_format, **options)
+    return buffer.getvalue(), extension
+
+
+def save_variants(name):
+    storage = get_storage()
+    with storage.open(name) as file:
+        original = Image.open(file)
+        original.load()
+    # Фото с телефона часто повернуты через EXIF - поворачиваем по-настоящему
+    original = ImageOps.exif_transpose(original)
+
+    directory, filename = os.path.split(name)
+    stem = os.path.splitext(filename)[0]
+    variants = {}
+    for variant, size in get_sizes().items():
+        # Уменьшаем один раз, сжимаем в каждый формат
+        image = resize(original, size)
+        variants[variant] = {}
+        for image_format in FORMATS:
+            content, extension = encode(image, image_format)
+            variants[variant][image_format] = storage.save(
+                os.path.join(directory, VARIANTS_DIR, f'{stem}-{variant}.{extension}'),
+                ContentFile(content),
+            )
+    return variants
+
+
+def get_refs_delta(old_variants, new_variants):
+    old, new = get_blob_names(None, old_variants), get_blob_names(None, new_variants)
+    counts = {name: 1 for name in new - old}
+    counts.update({name: -1 for name in old - new})
+    return counts
+
+
+def generate_variants(image_id, force=False):
+    # True - варианты готовы. Файлы пишутся вне транзакции, а в базу
+    # попадают условным UPDATE: если картинку за это время заменили
+    # или удалили, на наши файлы никто не сошлется и их удалит
+    # сборщик мусора хранилища
+    image = ProductImage.objects.filter(pk=image_id).values('image', 'variants',
+                                                            'product_id').first()
+    if image is None or not image['image']:
+        return False
+    if image['variants'] and not force:
+        return True
+    variants = save_variants(image['image'])
+    with transaction.atomic():
+        updated = ProductImage.objects.filter(pk=image_id, image=image['image'],
+                                              variants=image['variants']).update(
+            variants=variants)
+        if updated:
+            # UPDATE не вызывает сигналы - ссылки на файлы считаем сами
+            change_blob_refs(get_refs_delta(image['variants'], variants))
+            # Ответы каталога содержат ссылки на варианты - сбрасываем их
+            Product.objects.filter(pk=image['product_id']).update(last_update=timezone.now())
+            cache.invalidate(ProductImage)
+    return bool(updated)
+
+
+def generate_variants_in_thread(image_id, force=False):
+    try:
+        return generate_variants(image_id, force)
+    finally:
+        # Каждый поток держит свое соединение - закрываем его
+        connection.close()
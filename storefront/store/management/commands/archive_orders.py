@@ -0,0 +1,79 @@
+import time
+from datetime import datetime, time as day_start, timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from store.archive import archive_batch
+from store.models import ArchiveCheckpoint
+
+
+class Command(BaseCommand):
+    help = ('Переносит заказы старше даты отсечки вместе со строками в архивные таблицы. '
+            'Прогресс сохраняется, прерванный запуск продолжается с того же места')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int,
+                            default=getattr(settings, 'STORE_ORDER_ARCHIVE_DAYS', 365),
+                            help='Переносить заказы старше стольких дней')
+        parser.add_argument('--before', help='Или явная дата отсечки YYYY-MM-DD')
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--pause', type=float, default=0,
+                            help='Пауза между пачками в секундах')
+        parser.add_argument('--restart', action='store_true',
+                            help='Не продолжать прошлый запуск, начать с начала')
+        parser.add_argument('--database', default='default')
+
+    def get_cutoff(self, options):
+        # Отсечка - начало дня, чтобы повторные запуски в тот же день совпадали
+        if options['before']:
+            try:
+                day = datetime.strptime(options['before'], '%Y-%m-%d').date()
+            except ValueError:
+                raise CommandError('--before ожидает дату YYYY-MM-DD')
+        else:
+            day = timezone.localdate() - timedelta(days=options['days'])
+        return timezone.make_aware(datetime.combine(day, day_start.min))
+
+    def handle(self, *args, **options):
+        using = options['database']
+        cutoff = self.get_cutoff(options)
+        checkpoint, created = ArchiveCheckpoint.objects.using(using).get_or_create(
+            name='orders', defaults={'cutoff': cutoff}
+        )
+        if options['restart'] or checkpoint.cutoff != cutoff:
+            checkpoint.cutoff = cutoff
+            checkpoint.last_order_id = 0
+            checkpoint.archived = 0
+            checkpoint.finished_at = None
+            checkpoint.save(using=using)
+        elif checkpoint.last_order_id and checkpoint.finished_at is None:
+            self.stdout.write(f'Продолжаем с заказа #{checkpoint.last_order_id}, '
+                              f'уже перенесено {checkpoint.archived}')
+
+        moved = 0
+        started = time.perf_counter()
+        while True:
+            # Отметка прогресса пишется в той же транзакции, что и пачка
+            with transaction.atomic(using=using):
+                ids = archive_batch(cutoff, checkpoint.last_order_id,
+                                    options['batch_size'], using)
+                if not ids:
+                    break
+                checkpoint.last_order_id = ids[-1]
+                checkpoint.archived += len(ids)
+                checkpoint.save(using=using,
+                                update_fields=['last_order_id', 'archived', 'updated_at'])
+            moved += len(ids)
+            elapsed = time.perf_counter() - started
+            self.stdout.write(f'Перенесено заказов: {moved} ({moved / elapsed:.0f} в секунду)')
+            if options['pause']:
+                time.sleep(options['pause'])
+
+        checkpoint.finished_at = timezone.now()
+        checkpoint.save(using=using, update_fields=['finished_at', 'updated_at'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Заказы до {cutoff:%Y-%m-%d} перенесены в архив: {moved} '
+            f'за {time.perf_counter() - started:.1f} с'
+        ))
@@ -0,0 +1,90 @@
+import time
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.client import RequestFactory
+from django.test.utils import CaptureQueriesContext, override_settings
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from store.models import Collection, Product, ProductImage
+from store.serializers import ProductSerializer, FastProductSerializer
+from store.views import ProductViewSet
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = ('Сравнивает ProductSerializer и FastProductSerializer на страницах '
+            'разного размера. Тестовые товары создаются в транзакции и откатываются')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--page-sizes', type=int, nargs='+', default=[10, 50, 100])
+        parser.add_argument('--repeat', type=int, default=20)
+        parser.add_argument('--images', type=int, default=2,
+                            help='Картинок на каждый тестовый товар')
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self.create_products(max(options['page_sizes']), options['images'])
+                for page_size in options['page_sizes']:
+                    self.compare(page_size, options['repeat'])
+                raise Rollback
+        except Rollback:
+            pass
+
+    def create_products(self, count, images):
+        collection = Collection.objects.create(title='benchmark')
+        products = Product.objects.bulk_create([
+            Product(title=f'benchmark {i:06}', slug=f'benchmark-{i}',
+                    description='benchmark ' * 20, unit_price=Decimal(i % 500 + 1) / 3,
+                    inventory=10, collection=collection)
+            for i in range(count)
+        ])
+        ProductImage.objects.bulk_create([
+            ProductImage(product=product, image=f'store/images/benchmark{j}.png')
+            for product in products for j in range(images)
+        ])
+
+    def measure(self, render, repeat):
+        with CaptureQueriesContext(connection) as queries:
+            content = render()
+        started = time.perf_counter()
+        for _ in range(repeat):
+            render()
+        return content, (time.perf_counter() - started) / repeat * 1000, len(queries)
+
+    def get_queryset(self, request, fast):
+        view = ProductViewSet(request=request, action='list', format_kwarg=None, kwargs={})
+        with override_settings(STORE_FAST_PRODUCT_SERIALIZER=fast):
+            queryset = view.get_queryset()
+        return queryset.filter(title__startswith='benchmark ').order_by('title', 'id')
+
+    def compare(self, page_size, repeat):
+        request = Request(RequestFactory().get('/products/', SERVER_NAME='localhost'))
+        context = {'request': request}
+        renderer = JSONRenderer()
+        # Оба пути берут queryset из ProductViewSet - как в настоящем запросе
+        default_queryset = self.get_queryset(request, fast=False)
+        fast_queryset = self.get_queryset(request, fast=True)
+
+        def render_default():
+            page = list(default_queryset[:page_size])
+            return renderer.render(ProductSerializer(page, many=True, context=context).data)
+
+        def render_fast():
+            page = list(fast_queryset[:page_size])
+            return renderer.render(FastProductSerializer(page, many=True, context=context).data)
+
+        default, default_ms, default_queries = self.measure(render_default, repeat)
+        fast, fast_ms, fast_queries = self.measure(render_fast, repeat)
+        same = 'да' if default == fast else 'НЕТ'
+        self.stdout.write(
+            f'page_size={page_size:<4} ProductSerializer: {default_ms:7.2f} мс '
+            f'({default_queries} запросов)  FastProductSerializer: {fast_ms:7.2f} мс '
+            f'({fast_queries} запросов)  ускорение x{default_ms / fast_ms:.1f}  '
+            f'JSON совпадает: {same}'
+        )
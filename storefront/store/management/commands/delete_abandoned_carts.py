@@ -0,0 +1,63 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+from store.models import Cart, CartItem
+
+
+class Command(BaseCommand):
+    help = ('Удаляет брошенные корзины старше заданного возраста. '
+            'Работает небольшими пачками, каждая пачка - отдельная короткая транзакция')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int,
+                            default=getattr(settings, 'STORE_CART_MAX_AGE_DAYS', 30),
+                            help='Удалять корзины, созданные раньше, чем столько дней назад')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Сколько корзин удалять за одну транзакцию')
+        parser.add_argument('--pause', type=float, default=0,
+                            help='Пауза между пачками в секундах')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Только посчитать, что будет удалено')
+        parser.add_argument('--database', default='default')
+
+    def handle(self, *args, **options):
+        using = options['database']
+        batch_size = options['batch_size']
+        cutoff = timezone.now() - timedelta(days=options['days'])
+        # Запросы идут по индексу store_cart_created_idx
+        carts = Cart.objects.using(using).filter(created_at__lt=cutoff)
+
+        if options['dry_run']:
+            self.stdout.write(
+                f'Будет удалено корзин: {carts.count()}, '
+                f'строк в них: {CartItem.objects.using(using).filter(cart__in=carts).count()} '
+                f'(созданы раньше {cutoff:%Y-%m-%d %H:%M})'
+            )
+            return
+
+        deleted_carts = 0
+        deleted_items = 0
+        started = time.perf_counter()
+        while True:
+            ids = list(carts.order_by('created_at').values_list('id', flat=True)[:batch_size])
+            if not ids:
+                break
+            with transaction.atomic(using=using):
+                deleted, by_model = Cart.objects.using(using).filter(id__in=ids).delete()
+            deleted_carts += by_model.get(Cart._meta.label, 0)
+            deleted_items += by_model.get(CartItem._meta.label, 0)
+            elapsed = time.perf_counter() - started
+            self.stdout.write(f'Удалено корзин: {deleted_carts} '
+                              f'({deleted_carts / elapsed:.0f} в секунду)')
+            if options['pause']:
+                time.sleep(options['pause'])
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f'Удалено корзин: {deleted_carts}, строк корзин: {deleted_items} '
+            f'за {elapsed:.1f} с'
+        ))
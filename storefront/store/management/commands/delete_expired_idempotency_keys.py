@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from store.idempotency import get_ttl
+from store.models import IdempotencyKey
+
+
+class Command(BaseCommand):
+    help = 'Удаляет сохраненные ответы Idempotency-Key старше STORE_IDEMPOTENCY_TTL'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--database', default='default')
+
+    def handle(self, *args, **options):
+        using = options['database']
+        keys = IdempotencyKey.objects.using(using).filter(
+            created_at__lt=timezone.now() - get_ttl()
+        )
+        deleted = 0
+        while True:
+            ids = list(keys.order_by('created_at').values_list('id', flat=True)
+                       [:options['batch_size']])
+            if not ids:
+                break
+            deleted += IdempotencyKey.objects.using(using).filter(id__in=ids).delete()[0]
+        self.stdout.write(self.style.SUCCESS(f'Удалено ключей: {deleted}'))
@@ -0,0 +1,78 @@
+import time
+from itertools import islice
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from store.images import get_storage
+from store.models import ImageBlob
+from store.storage import ContentAddressedStorage
+
+
+class Command(BaseCommand):
+    help = ('Удаляет файлы картинок, на которые не ссылается ни один ProductImage. '
+            'Файл удаляется, только если его не загружали повторно дольше --grace секунд')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--grace', type=int,
+                            default=getattr(settings, 'STORE_BLOB_GC_GRACE', 60 * 60 * 24),
+                            help='Сколько секунд файл без ссылок должен не использоваться')
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Только посчитать, что будет удалено')
+
+    def handle(self, *args, **options):
+        storage = get_storage()
+        if not isinstance(storage, ContentAddressedStorage):
+            raise CommandError('Картинки товаров хранятся не в ContentAddressedStorage')
+        self.storage = storage
+        self.cutoff = time.time() - options['grace']
+        self.dry_run = options['dry_run']
+        batch_size = options['batch_size']
+        started = time.monotonic()
+
+        # Файлы, ссылки на которые освободились
+        released = deleted = 0
+        last_id = 0
+        while True:
+            batch = list(ImageBlob.objects.filter(refs__lte=0, id__gt=last_id)
+                         .order_by('id').values_list('id', 'name')[:batch_size])
+            if not batch:
+                break
+            last_id = batch[-1][0]
+            for blob_id, name in batch:
+                released += 1
+                if self.delete(name):
+                    deleted += 1
+                    if not self.dry_run:
+                        # Пока мы удаляли, на файл могли сослаться снова - тогда строку оставляем
+                        ImageBlob.objects.filter(pk=blob_id, refs__lte=0).delete()
+
+        # Файлы без строки ImageBlob: загрузка откатилась вместе с транзакцией
+        # или варианты построены для уже замененной картинки
+        unknown = 0
+        blobs = self.storage.iter_blobs()
+        while True:
+            chunk = dict(islice(blobs, batch_size))
+            if not chunk:
+                break
+            known = set(ImageBlob.objects.filter(name__in=list(chunk))
+                        .values_list('name', flat=True))
+            for name, used_at in chunk.items():
+                if name not in known and used_at < self.cutoff and self.delete(name):
+                    unknown += 1
+
+        temp = 0 if self.dry_run else self.storage.delete_stale_temp_files(self.cutoff)
+        action = 'Будет удалено' if self.dry_run else 'Удалено'
+        self.stdout.write(self.style.SUCCESS(
+            f'{action}: {deleted} из {released} освободившихся файлов, '
+            f'{unknown} файлов без ссылок, {temp} временных файлов '
+            f'за {time.monotonic() - started:.1f} с'
+        ))
+
+    def delete(self, name):
+        if self.dry_run:
+            try:
+                return self.storage.get_modified_time(name).timestamp() < self.cutoff
+            except FileNotFoundError:
+                return False
+        return self.storage.delete_unused(name, self.cutoff)
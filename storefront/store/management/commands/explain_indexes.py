@@ -0,0 +1,166 @@
+import random
+import time
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from store.models import Cart, CartItem, Collection, Customer, Order, Product
+from store.paginations import KeysetPagination
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = ('Показывает план и время горячих запросов store без индекса и с индексом. '
+            'Синтетические данные создаются в транзакции и откатываются')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=100000)
+        parser.add_argument('--orders', type=int, default=100000)
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def handle(self, *args, **options):
+        self.repeat = options['repeat']
+        try:
+            with transaction.atomic():
+                self.create_data(options['products'], options['orders'])
+                for model, name, description, query in self.get_cases():
+                    self.compare(model, name, description, query)
+                raise Rollback
+        except Rollback:
+            pass
+
+    def create_data(self, products_count, orders_count):
+        self.stdout.write(f'Создаем {products_count} товаров и {orders_count} заказов...')
+        random.seed(1)
+        collections = Collection.objects.bulk_create(
+            [Collection(title=f'collection {i}') for i in range(50)]
+        )
+        products = Product.objects.bulk_create([
+            Product(title=f'product {random.randrange(10 ** 9):09}', slug='product',
+                    unit_price=Decimal(random.randrange(100, 100000)) / 100,
+                    inventory=random.randrange(1, 1000),
+                    collection=random.choice(collections))
+            for _ in range(products_count)
+        ], batch_size=5000)
+        self.spread_dates(Product, 'last_update')
+        Product.objects.filter(pk__in=[product.pk for product in products[:500]]) \
+            .update(inventory=5)
+
+        users = User.objects.bulk_create(
+            [User(username=f'explain-indexes-{i}') for i in range(1000)]
+        )
+        customers = Customer.objects.bulk_create([Customer(user=user) for user in users])
+        Order.objects.bulk_create(
+            [Order(customer=random.choice(customers)) for _ in range(orders_count)],
+            batch_size=5000
+        )
+        self.spread_dates(Order, 'placed_at')
+
+        carts = Cart.objects.bulk_create([Cart() for _ in range(products_count // 10)])
+        CartItem.objects.bulk_create([
+            CartItem(cart=cart, product=product, quantity=1)
+            for cart in carts for product in random.sample(products, 5)
+        ], batch_size=5000)
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+        self.product = Product.objects.get(pk=products[len(products) // 2].pk)
+        self.collection = collections[0]
+        self.customer = customers[0]
+        self.order = Order.objects.order_by('-placed_at')[orders_count // 2]
+        self.cart_item = CartItem.objects.order_by('?').first()
+
+    def spread_dates(self, model, field):
+        # Разносим даты по времени, иначе у всех записей они почти одинаковые
+        if connection.vendor == 'postgresql':
+            expression = "now() - random() * interval '700 days'"
+        else:
+            expression = "datetime('now', '-' || abs(random() % 1000000) || ' minutes')"
+        with connection.cursor() as cursor:
+            cursor.execute(f'UPDATE {model._meta.db_table} SET {field} = {expression}')
+
+    def get_page(self, queryset, ordering, after=None):
+        # Ровно тот запрос, что строит курсорная пагинация: ее сортировка
+        # с добивкой по id и ее условие курсора после записи after
+        pagination = KeysetPagination()
+        ordering = pagination.get_ordering(queryset.order_by(*ordering), None)
+        queryset = queryset.order_by(*ordering)
+        if after is not None:
+            position = [getattr(after, name.lstrip('-')) for name in ordering]
+            queryset = queryset.filter(pagination.build_filter(ordering, position))
+        return list(queryset[:pagination.page_size + 1])
+
+    def get_cases(self):
+        product = self.product
+        order = self.order
+        products, orders = Product.objects.all(), Order.objects.all()
+        return [
+            (Product, 'store_product_title_idx', 'Каталог: title, id по курсору',
+             lambda: self.get_page(products, ['title'], product)),
+            (Product, 'store_product_coll_title_idx', 'Категория: collection_id + title',
+             lambda: self.get_page(products.filter(collection=self.collection), ['title'])),
+            (Product, 'store_product_price_idx', 'unit_price__gt/lt + сортировка по цене',
+             lambda: self.get_page(products.filter(unit_price__gt=100, unit_price__lt=110),
+                                   ['unit_price'])),
+            (Product, 'store_product_updated_idx', '?ordering=-last_update по курсору',
+             lambda: self.get_page(products, ['-last_update'], product)),
+            (Product, 'store_product_low_stock_idx', 'Админка: inventory__lt=10',
+             lambda: Product.objects.filter(inventory__lt=10).count()),
+            (CartItem, 'store_cartitem_unique_product', 'Строка корзины по (cart_id, product_id)',
+             lambda: CartItem.objects.filter(cart_id=self.cart_item.cart_id,
+                                             product_id=self.cart_item.product_id).first()),
+            (Order, 'store_order_customer_idx', 'Заказы покупателя, новые сверху',
+             lambda: self.get_page(orders.filter(customer=self.customer), ['-placed_at'])),
+            (Order, 'store_order_placed_idx', 'Все заказы, новые сверху, по курсору',
+             lambda: self.get_page(orders, ['-placed_at'], order)),
+        ]
+
+    def get_index(self, model, name):
+        for index in model._meta.indexes:
+            if index.name == name:
+                return index, 'index'
+        for constraint in model._meta.constraints:
+            if constraint.name == name:
+                return constraint, 'constraint'
+
+    def explain(self, query):
+        queries = []
+        with connection.execute_wrapper(lambda execute, sql, params, many, context:
+                                        queries.append((sql, params)) or
+                                        execute(sql, params, many, context)):
+            query()
+        sql, params = queries[-1]
+        prefix = 'EXPLAIN QUERY PLAN' if connection.vendor == 'sqlite' else 'EXPLAIN'
+        with connection.cursor() as cursor:
+            cursor.execute(f'{prefix} {sql}', params)
+            plan = [' '.join(str(column) for column in row) for row in cursor.fetchall()]
+        started = time.perf_counter()
+        for _ in range(self.repeat):
+            query()
+        return plan, (time.perf_counter() - started) / self.repeat * 1000
+
+    def compare(self, model, name, description, query):
+        index, kind = self.get_index(model, name)
+        self.stdout.write(self.style.MIGRATE_HEADING(f'\n{name}: {description}'))
+        # schema_editor как контекст на SQLite внутри транзакции не работает,
+        # поэтому выполняем DDL индекса напрямую
+        editor = connection.schema_editor()
+        if kind == 'constraint' and connection.vendor == 'sqlite':
+            # На SQLite уникальное ограничение - часть таблицы, удалить его нельзя
+            self.stdout.write('  без индекса: не измерить на SQLite')
+        else:
+            editor.execute(index.remove_sql(model, editor))
+            before_plan, before_ms = self.explain(query)
+            editor.execute(index.create_sql(model, editor))
+            self.stdout.write(f'  без индекса: {before_ms:8.3f} мс')
+            for line in before_plan:
+                self.stdout.write(f'    {line}')
+        after_plan, after_ms = self.explain(query)
+
+        self.stdout.write(f'  с индексом:  {after_ms:8.3f} мс')
+        for line in after_plan:
+            self.stdout.write(f'    {line}')
@@ -0,0 +1,51 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from store.images import generate_variants_in_thread
+from store.models import ProductImage
+
+
+class Command(BaseCommand):
+    help = ('Строит уменьшенные копии для уже загруженных картинок товаров. '
+            'Новые картинки обрабатывает фоновая задача, эта команда - для старых')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4,
+                            help='Сколько картинок обрабатывать параллельно (потоки)')
+        parser.add_argument('--batch-size', type=int, default=200)
+        parser.add_argument('--force', action='store_true',
+                            help='Перестроить и те картинки, у которых варианты уже есть')
+
+    def handle(self, *args, **options):
+        images = ProductImage.objects.exclude(image='').order_by('id')
+        if not options['force']:
+            images = images.filter(variants={})
+        done = failed = 0
+        last_id = 0
+        started = time.monotonic()
+        # Pillow отпускает GIL при сжатии, поэтому потоков достаточно
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            while True:
+                ids = list(images.filter(id__gt=last_id)
+                           .values_list('id', flat=True)[:options['batch_size']])
+                if not ids:
+                    break
+                last_id = ids[-1]
+                futures = {image_id: executor.submit(generate_variants_in_thread,
+                                                     image_id, options['force'])
+                           for image_id in ids}
+                for image_id, future in futures.items():
+                    try:
+                        future.result()
+                        done += 1
+                    except Exception as error:
+                        failed += 1
+                        self.stderr.write(f'Картинка {image_id}: {error}')
+                self.stdout.write(f'Обработано {done}, ошибок {failed}')
+
+        elapsed = time.monotonic() - started
+        rate = done / elapsed if elapsed else 0
+        self.stdout.write(self.style.SUCCESS(
+            f'Готово: {done} картинок за {elapsed:.1f} с ({rate:.1f} в секунду), ошибок {failed}'
+        ))
@@ -0,0 +1,76 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from store.models import (ArchivedOrder, ArchivedOrderItem, CollectionSales, Order, OrderItem,
+                          ProductSales)
+from store import sales
+
+
+class ChunkChanged(Exception):
+    pass
+
+
+# Заказы и их строки: горячие таблицы и архив (manage.py archive_orders)
+SOURCES = [(Order, OrderItem), (ArchivedOrder, ArchivedOrderItem)]
+
+
+class Command(BaseCommand):
+    help = ('Заносит оплаченные заказы, еще не учтенные в сводках продаж, пачками. '
+            'Учитывает и заказы из архива. '
+            'Можно запускать повторно и параллельно с работой магазина')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Сколько заказов учитывать за одну транзакцию')
+        parser.add_argument('--rebuild', action='store_true',
+                            help='Сначала очистить сводки и пересчитать все заново')
+        parser.add_argument('--database', default='default')
+
+    def handle(self, *args, **options):
+        using = options['database']
+        if options['rebuild']:
+            # Одной транзакцией, чтобы сводки и отметки заказов не разошлись
+            with transaction.atomic(using=using):
+                for orders, _ in SOURCES:
+                    orders.objects.using(using).filter(sales_recorded=True).update(
+                        sales_recorded=False)
+                ProductSales.objects.using(using).all().delete()
+                CollectionSales.objects.using(using).all().delete()
+
+        recorded = 0
+        started = time.perf_counter()
+        for orders, items in SOURCES:
+            last_id = 0
+            while True:
+                try:
+                    ids = self.record_chunk(orders, items, last_id, options['batch_size'], using)
+                except ChunkChanged:
+                    # Заказ пачки параллельно учел PATCH - повторяем пачку
+                    continue
+                if not ids:
+                    break
+                last_id = ids[-1]
+                recorded += len(ids)
+                elapsed = time.perf_counter() - started
+                self.stdout.write(f'Учтено заказов: {recorded} '
+                                  f'({recorded / elapsed:.0f} в секунду)')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Учтено заказов: {recorded} за {time.perf_counter() - started:.1f} с'
+        ))
+
+    def record_chunk(self, orders, items, last_id, batch_size, using):
+        with transaction.atomic(using=using):
+            ids = list(orders.objects.using(using).select_for_update()
+                       .filter(id__gt=last_id, payment_status=Order.PAYMENT_STATUS_COMPLETE,
+                               sales_recorded=False)
+                       .order_by('id').values_list('id', flat=True)[:batch_size])
+            if not ids:
+                return ids
+            marked = orders.objects.using(using).filter(id__in=ids, sales_recorded=False).update(
+                sales_recorded=True)
+            if marked != len(ids):
+                raise ChunkChanged
+            sales.record_orders(ids, using=using, items=items)
+        return ids
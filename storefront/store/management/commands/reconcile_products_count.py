@@ -0,0 +1,55 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+from store.models import Collection, Product
+from store import cache
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает Collection.products_count пачками и исправляет расхождения'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Сколько категорий проверять за одну транзакцию')
+        parser.add_argument('--database', default='default')
+
+    def handle(self, *args, **options):
+        using = options['database']
+        batch_size = options['batch_size']
+        last_id = 0
+        checked = 0
+        fixed = 0
+        while True:
+            with transaction.atomic(using=using):
+                # select_for_update, чтобы параллельные изменения товаров
+                # не потерялись между подсчетом и записью
+                collections = list(
+                    Collection.objects.using(using).select_for_update()
+                    .filter(id__gt=last_id).order_by('id')
+                    .only('id', 'products_count')[:batch_size]
+                )
+                if not collections:
+                    break
+                counts = dict(
+                    Product.objects.using(using)
+                    .filter(collection_id__in=[c.id for c in collections])
+                    .order_by().values('collection_id')
+                    .annotate(count=Count('id'))
+                    .values_list('collection_id', 'count')
+                )
+                wrong = []
+                for collection in collections:
+                    count = counts.get(collection.id, 0)
+                    if collection.products_count != count:
+                        collection.products_count = count
+                        wrong.append(collection)
+                Collection.objects.using(using).bulk_update(wrong, ['products_count'])
+                if wrong:
+                    cache.invalidate(Collection, using)
+            last_id = collections[-1].id
+            checked += len(collections)
+            fixed += len(wrong)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Проверено категорий: {checked}, исправлено: {fixed}'
+        ))
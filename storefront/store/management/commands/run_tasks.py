@@ -0,0 +1,58 @@
+import json
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from store import queue
+import store.tasks  # noqa: F401 - регистрирует задачи
+
+
+class Command(BaseCommand):
+    help = 'Воркер очереди фоновых задач (таблица Task)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4,
+                            help='Сколько задач выполнять параллельно (потоки)')
+        parser.add_argument('--poll', type=float, default=1,
+                            help='Пауза в секундах, когда очередь пуста')
+        parser.add_argument('--metrics-interval', type=float, default=60,
+                            help='Как часто печатать метрики очереди, в секундах')
+        parser.add_argument('--once', action='store_true',
+                            help='Выполнить готовые задачи и выйти')
+        parser.add_argument('--stats', action='store_true',
+                            help='Только напечатать метрики очереди')
+
+    def handle(self, *args, **options):
+        if options['stats']:
+            self.stdout.write(json.dumps(queue.get_metrics(), indent=2))
+            return
+
+        workers = options['workers']
+        last_metrics = 0
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            running = set()
+            while True:
+                if time.monotonic() - last_metrics >= options['metrics_interval']:
+                    queue.requeue_stale()
+                    queue.delete_finished()
+                    self.stdout.write(json.dumps(queue.get_metrics()))
+                    last_metrics = time.monotonic()
+
+                # Берем задач не больше, чем свободных потоков
+                running = {future for future in running if not future.done()}
+                free = workers - len(running)
+                claimed = queue.claim(free) if free else []
+                running |= {executor.submit(queue.run, task_id) for task_id in claimed}
+                if claimed:
+                    continue
+
+                if options['once'] and not running:
+                    break
+                # Соединение основного потока не держим открытым во время паузы
+                connection.close()
+                if running:
+                    wait(running, timeout=options['poll'], return_when=FIRST_COMPLETED)
+                else:
+                    time.sleep(options['poll'])
+        self.stdout.write(json.dumps(queue.get_metrics()))
@@ -0,0 +1,68 @@
+import threading
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from store.models import Cart, CartItem, Collection, Product
+from store.serializers import AddCartItemSerializer
+
+
+class Command(BaseCommand):
+    help = ('Много потоков одновременно добавляют один товар в одну корзину. '
+            'Проверяет, что ни одно добавление не потерялось')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8)
+        parser.add_argument('--adds', type=int, default=50,
+                            help='Сколько добавлений делает каждый поток')
+
+    def handle(self, *args, **options):
+        threads_count = options['threads']
+        adds = options['adds']
+        with transaction.atomic():
+            collection = Collection.objects.create(title='stress')
+            product = Product.objects.create(title='stress', slug='stress', unit_price=1,
+                                             inventory=1, collection=collection)
+            cart = Cart.objects.create()
+
+        errors = []
+        barrier = threading.Barrier(threads_count)
+
+        def worker():
+            try:
+                barrier.wait()
+                for _ in range(adds):
+                    serializer = AddCartItemSerializer(
+                        data={'product_id': product.id, 'quantity': 1},
+                        context={'cart_id': cart.id}
+                    )
+                    serializer.is_valid(raise_exception=True)
+                    serializer.save()
+            except Exception as error:
+                errors.append(error)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker) for _ in range(threads_count)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        quantity = CartItem.objects.get(cart=cart, product=product).quantity
+        rows = CartItem.objects.filter(cart=cart).count()
+        cart.delete()
+        product.delete()
+        collection.delete()
+
+        expected = threads_count * adds
+        self.stdout.write(f'Потоков: {threads_count}, добавлений: {expected}, '
+                          f'{expected / elapsed:.0f} добавлений/с')
+        if errors:
+            raise CommandError(f'Ошибки в потоках: {errors[:3]}')
+        if quantity != expected or rows != 1:
+            raise CommandError(f'Потеряны добавления: quantity={quantity}, '
+                               f'ожидалось {expected}, строк в корзине {rows}')
+        self.stdout.write(self.style.SUCCESS(f'quantity={quantity}, ничего не потерялось'))
@@ -0,0 +1,36 @@
+# Generated by Django 5.0.4 on 2026-10-18 19:44
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def fill_products_count(apps, schema_editor):
+    Collection = apps.get_model('store', 'Collection')
+    Product = apps.get_model('store', 'Product')
+    counts = (Product.objects.filter(collection_id=OuterRef('pk'))
+              .order_by().values('collection_id')
+              .annotate(count=Count('id')).values('count'))
+    Collection.objects.update(products_count=Coalesce(Subquery(counts), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0002_product_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='collection',
+            name='products_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Кол-во товаров'),
+        ),
+        migrations.RunPython(fill_products_count, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='orderitem',
+            name='order',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='items', to='store.order', verbose_name='Заказ'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0003_collection_products_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='collection',
+            name='last_update',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now, verbose_name='Дата обновления'),
+            preserve_default=False,
+        ),
+        migrations.AlterField(
+            model_name='product',
+            name='last_update',
+            field=models.DateTimeField(auto_now=True, verbose_name='Дата обновления'),
+        ),
+    ]
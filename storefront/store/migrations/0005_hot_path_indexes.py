@@ -0,0 +1,78 @@
+# Generated by Django 5.0.4 on 2026-10-18 19:50
+#
+# Индексы под горячие запросы store. Замеры manage.py explain_indexes
+# (SQLite, 100 000 товаров и 100 000 заказов), время одного запроса.
+# Меряются те же запросы, что строит KeysetPagination (страница из 11
+# записей, добивка id в сторону первого поля, условие курсора):
+#
+#   store_product_title_idx        курсор по title, id        6.18 -> 1.96 мс
+#   store_product_coll_title_idx   категория + title           4.37 -> 1.31 мс
+#   store_product_price_idx        unit_price gt/lt + sort    22.97 -> 1.25 мс
+#   store_product_updated_idx      курсор по -last_update, -id 26.14 -> 1.18 мс
+#   store_product_low_stock_idx    inventory < 10             11.58 -> 0.76 мс
+#   store_order_customer_idx       заказы покупателя           1.41 -> 1.35 мс
+#   store_order_placed_idx         курсор по -placed_at, -id  25.89 -> 1.12 мс
+#   store_cartitem_unique_product  строка корзины              0.96 мс, см. ниже
+#
+# Без индексов это полный SCAN таблицы и TEMP B-TREE для сортировки.
+# С индексами - SEARCH/SCAN по индексу без сортировки.
+# Уникальное ограничение CartItem на SQLite нельзя удалить для замера "до".
+# Оно нужно прежде всего для upsert строк корзины.
+
+from django.db import migrations, models
+from django.db.models import Count, Min, Sum
+
+
+def merge_duplicate_cart_items(apps, schema_editor):
+    # Перед уникальным ограничением складываем одинаковые товары в одной корзине
+    CartItem = apps.get_model('store', 'CartItem')
+    duplicates = (CartItem.objects.values('cart_id', 'product_id')
+                  .annotate(count=Count('id'), first_id=Min('id'), quantity=Sum('quantity'))
+                  .filter(count__gt=1))
+    for row in list(duplicates):
+        CartItem.objects.filter(pk=row['first_id']).update(quantity=row['quantity'])
+        CartItem.objects.filter(cart_id=row['cart_id'], product_id=row['product_id']) \
+            .exclude(pk=row['first_id']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0004_last_update'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['customer', 'placed_at', 'id'], name='store_order_customer_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['placed_at', 'id'], name='store_order_placed_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['title', 'id'], name='store_product_title_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['collection', 'title', 'id'], name='store_product_coll_title_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['unit_price', 'id'], name='store_product_price_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['last_update', 'id'], name='store_product_updated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(condition=models.Q(('inventory__lt', 10)), fields=['inventory'], name='store_product_low_stock_idx'),
+        ),
+        migrations.RunPython(merge_duplicate_cart_items, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='cartitem',
+            constraint=models.UniqueConstraint(fields=('cart', 'product'), name='store_cartitem_unique_product'),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 5.0.4 on 2026-10-18 20:00
+
+from django.db import migrations, models
+from django.db.models import DecimalField, ExpressionWrapper, F, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+
+def fill_order_totals(apps, schema_editor):
+    Order = apps.get_model('store', 'Order')
+    OrderItem = apps.get_model('store', 'OrderItem')
+    items = OrderItem.objects.filter(order_id=OuterRef('pk')).order_by().values('order_id')
+    total = items.annotate(total=Sum(ExpressionWrapper(
+        F('quantity') * F('unit_price'),
+        output_field=DecimalField(max_digits=12, decimal_places=2)
+    ))).values('total')
+    count = items.annotate(count=Sum('quantity')).values('count')
+    Order.objects.update(total_price=Coalesce(Subquery(total), 0,
+                                              output_field=DecimalField(max_digits=12,
+                                                                        decimal_places=2)),
+                         item_count=Coalesce(Subquery(count), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0006_cart_created_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='item_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Кол-во товаров'),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='total_price',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=12, verbose_name='Сумма заказа'),
+        ),
+        migrations.RunPython(fill_order_totals, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 5.0.4 on 2026-10-18 20:05
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0009_task_queue'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='sales_recorded',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+        migrations.CreateModel(
+            name='CollectionSales',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('units', models.IntegerField(default=0)),
+                ('collection', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='store.collection')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ProductSales',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('units', models.IntegerField(default=0)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='store.product')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='collectionsales',
+            constraint=models.UniqueConstraint(fields=('day', 'collection'), name='store_collectionsales_unique_day'),
+        ),
+        migrations.AddConstraint(
+            model_name='productsales',
+            constraint=models.UniqueConstraint(fields=('day', 'product'), name='store_productsales_unique_day'),
+        ),
+    ]
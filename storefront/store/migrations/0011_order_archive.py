@@ -0,0 +1,57 @@
+# Generated by Django 5.0.4 on 2026-10-18 20:05
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0010_sales_rollups'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchiveCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True)),
+                ('cutoff', models.DateTimeField()),
+                ('last_order_id', models.IntegerField(default=0)),
+                ('archived', models.PositiveIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('finished_at', models.DateTimeField(null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ArchivedOrder',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('placed_at', models.DateTimeField(verbose_name='Время оформления')),
+                ('payment_status', models.CharField(choices=[('P', 'Pending'), ('C', 'Complete'), ('F', 'Failed')], max_length=1, verbose_name='Статус оплаты')),
+                ('total_price', models.DecimalField(decimal_places=2, max_digits=12, verbose_name='Сумма заказа')),
+                ('item_count', models.PositiveIntegerField(verbose_name='Кол-во товаров')),
+                ('sales_recorded', models.BooleanField(default=False)),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+                ('customer', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='+', to='store.customer')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ArchivedOrderItem',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('quantity', models.PositiveIntegerField(verbose_name='Кол-во заказанного')),
+                ('unit_price', models.DecimalField(decimal_places=2, max_digits=6, verbose_name='Цена за шт')),
+                ('order', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='items', to='store.archivedorder')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='+', to='store.product')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='archivedorder',
+            index=models.Index(fields=['customer', 'placed_at', 'id'], name='store_archorder_customer_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='archivedorder',
+            index=models.Index(fields=['placed_at', 'id'], name='store_archorder_placed_idx'),
+        ),
+    ]
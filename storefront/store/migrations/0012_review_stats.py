@@ -0,0 +1,40 @@
+# Generated by Django 5.0.4 on 2026-10-18 20:11
+
+from django.db import migrations, models
+from django.db.models import Count, Max, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def fill_review_stats(apps, schema_editor):
+    Product = apps.get_model('store', 'Product')
+    Review = apps.get_model('store', 'Review')
+    reviews = Review.objects.filter(product_id=OuterRef('pk')).order_by().values('product_id')
+    Product.objects.update(
+        review_count=Coalesce(Subquery(reviews.annotate(count=Count('id')).values('count')), 0),
+        last_review_date=Subquery(reviews.annotate(last=Max('date')).values('last')),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0011_order_archive'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='last_review_date',
+            field=models.DateField(editable=False, null=True, verbose_name='Дата последнего отзыва'),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='review_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Кол-во отзывов'),
+        ),
+        migrations.AddIndex(
+            model_name='review',
+            index=models.Index(fields=['product', 'date', 'id'], name='store_review_product_date_idx'),
+        ),
+        migrations.RunPython(fill_review_stats, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.4 on 2026-10-18 20:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0012_review_stats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='productimage',
+            name='variants',
+            field=models.JSONField(default=dict, editable=False),
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 5.0.4 on 2026-10-18 20:17
+
+import store.models
+import store.validators
+from collections import Counter
+from django.db import migrations, models
+
+
+def fill_image_blobs(apps, schema_editor):
+    ProductImage = apps.get_model('store', 'ProductImage')
+    ImageBlob = apps.get_model('store', 'ImageBlob')
+    counts = Counter()
+    for image, variants in ProductImage.objects.values_list('image', 'variants').iterator():
+        names = {image} | {name for formats in (variants or {}).values()
+                           for name in formats.values()}
+        counts.update(name for name in names if name)
+    ImageBlob.objects.bulk_create([ImageBlob(name=name, refs=refs)
+                                   for name, refs in counts.items()], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0013_productimage_variants'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImageBlob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('refs', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='productimage',
+            name='image',
+            field=models.ImageField(storage=store.models.get_image_storage, upload_to='store/images', validators=[store.validators.validate_file_size]),
+        ),
+        migrations.RunPython(fill_image_blobs, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.0.4 on 2026-10-18 20:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0015_idempotency_claimed_at'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='archivecheckpoint',
+            name='last_order_id',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='archivedorder',
+            name='id',
+            field=models.BigIntegerField(primary_key=True, serialize=False),
+        ),
+        migrations.AlterField(
+            model_name='archivedorderitem',
+            name='id',
+            field=models.BigIntegerField(primary_key=True, serialize=False),
+        ),
+    ]
@@ -1,9 +1,15 @@
-from django.db import models
+from collections import Counter
+from django.db import connections, models, transaction
+from django.db.models import Case, F, OuterRef, Q, Subquery, Sum, When
+from rest_framework.utils.encoders import JSONEncoder
 from django.core.validators import MinValueValidator
 from uuid import uuid4
 from django.conf import settings
+from django.core.files.storage import storages
+from django.utils import timezone
 from django.contrib import admin
 from .validators import validate_file_size
+from . import cache
 # Create your models here.
 class Promotion(models.Model):
     description = models.CharField(max_length=255, verbose_name='Описание')
@@ -19,6 +25,11 @@ class Collection(models.Model):
                                          null=True, blank=True,
                                          related_name='+',
                                          verbose_name='Рекомендуемый товар')
+    # Хранимое кол-во товаров вместо annotate(Count('products')) на каждый запрос.
+    # Обновляется в ProductQuerySet и сигналах store/signals.py
+    products_count = models.PositiveIntegerField(default=0, editable=False,
+                                                 verbose_name='Кол-во товаров')
+    last_update = models.DateTimeField(auto_now=True, verbose_name='Дата обновления')
 
     def __str__(self):
         return self.title
@@ -29,6 +40,97 @@ class Collection(models.Model):
         ordering = ['title']  # Сортировка в админке по названию, а не по id
 
 
+def change_products_count(counts, using='default'):
+    # counts - {collection_id: на сколько изменить}
+    for collection_id, delta in counts.items():
+        if delta:
+            Collection.objects.using(using).filter(pk=collection_id).update(
+                products_count=F('products_count') + delta,
+                last_update=timezone.now()
+            )
+            cache.invalidate(Collection, using)
+
+
+class ProductQuerySet(models.QuerySet):
+    # Массовые операции не вызывают сигналы, поэтому кол-во товаров
+    # в категориях и кэш каталога обновляем здесь
+
+    def bulk_create(self, objs, *args, **kwargs):
+        with transaction.atomic(using=self.db):
+            objs = super().bulk_create(objs, *args, **kwargs)
+            change_products_count(Counter(obj.collection_id for obj in objs), self.db)
+            cache.invalidate(self.model, self.db)
+        for obj in objs:
+            obj._loaded_collection_id = obj.collection_id
+        return objs
+
+    def bulk_update(self, objs, fields, *args, **kwargs):
+        # bulk_update не проставляет auto_now - делаем это сами
+        now = timezone.now()
+        for obj in objs:
+            obj.last_update = now
+        fields = list(dict.fromkeys([*fields, 'last_update']))
+        with transaction.atomic(using=self.db):
+            counts = Counter()
+            if 'collection' in fields or 'collection_id' in fields:
+                old = dict(self.model.objects.using(self.db)
+                           .filter(pk__in=[obj.pk for obj in objs])
+                           .values_list('pk', 'collection_id'))
+                for obj in objs:
+                    counts[old[obj.pk]] -= 1
+                    counts[obj.collection_id] += 1
+                    obj._loaded_collection_id = obj.collection_id
+            rows = super().bulk_update(objs, fields, *args, **kwargs)
+            change_products_count(counts, self.db)
+            cache.invalidate(self.model, self.db)
+        return rows
+
+    def update(self, **kwargs):
+        kwargs.setdefault('last_update', timezone.now())
+        collection = kwargs.get('collection', kwargs.get('collection_id'))
+        if hasattr(collection, 'resolve_expression'):
+            # Выражение (например, Case из bulk_update) - счетчики обновит bulk_update
+            collection = None
+        with transaction.atomic(using=self.db):
+            counts = Counter()
+            if collection is not None:
+                for row in (self.order_by().values('collection_id')
+                            .annotate(count=models.Count('id'))):
+                    counts[row['collection_id']] -= row['count']
+            rows = super().update(**kwargs)
+            if collection is not None:
+                counts[getattr(collection, 'pk', collection)] += rows
+            change_products_count(counts, self.db)
+            cache.invalidate(self.model, self.db)
+        return rows
+
+    def take_inventory(self, quantities):
+        # Списание остатков при заказе, quantities - {product_id: кол-во}.
+        # Вызывать в транзакции. Возвращает кол-во списанных товаров: если
+        # их меньше len(quantities), какого-то не хватило и транзакцию надо
+        # откатить. Сначала блокируем строки по возрастанию id: параллельные
+        # заказы берут блокировки в одном порядке и не ждут друг друга по кругу
+        # (SQLite select_for_update пропускает, там пишет один процесс)
+        if not quantities:
+            return 0
+        ids = sorted(quantities)
+        list(self.select_for_update().filter(pk__in=ids).order_by('pk')
+             .values_list('pk', flat=True))
+        enough = Q()
+        for product_id in ids:
+            enough |= Q(pk=product_id, inventory__gte=quantities[product_id])
+        # Одним условным UPDATE мимо update() выше: кэш каталога не сбрасываем,
+        # иначе каждый заказ выключал бы кэш всего каталога. Остаток
+        # в закэшированных ответах отстает не дольше STORE_CACHE_TIMEOUT,
+        # распроданные товары сбрасывает задача check_low_stock
+        return super(ProductQuerySet, self.filter(enough)).update(
+            inventory=Case(*[When(pk=product_id, then=F('inventory') - quantities[product_id])
+                             for product_id in ids],
+                           default=F('inventory')),
+            last_update=timezone.now(),
+        )
+
+
 class Product(models.Model):
     title = models.CharField(max_length=255, verbose_name='Название товара')
     slug = models.SlugField()  # product/1 -> product/iphone15-pro-max
@@ -38,7 +140,8 @@ class Product(models.Model):
                                      verbose_name='Цена за шт')
     inventory = models.IntegerField(validators=[MinValueValidator(1)],
                                     verbose_name='Кол-во на складе')
-    last_update = models.DateTimeField(auto_now_add=True,
+    # Меняется при любом изменении товара, его картинок и категории
+    last_update = models.DateTimeField(auto_now=True,
                                        verbose_name='Дата обновления')
     collection = models.ForeignKey(Collection, on_delete=models.PROTECT,
                                    verbose_name='Категория', related_name='products')
@@ -46,6 +149,19 @@ class Product(models.Model):
     # products = Product.objects.filter(collection=collection)
     # products = collection.products.all()
     promotion = models.ManyToManyField(Promotion, blank=True)
+    # Хранимая статистика отзывов, чтобы не считать их на каждый запрос.
+    # Обновляется сигналами store/signals.py при создании и удалении отзыва
+    review_count = models.PositiveIntegerField(default=0, editable=False,
+                                               verbose_name='Кол-во отзывов')
+    last_review_date = models.DateField(null=True, editable=False,
+                                        verbose_name='Дата последнего отзыва')
+
+    objects = ProductQuerySet.as_manager()
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Запоминаем категорию, чтобы при сохранении понять, что товар переместили
+        self._loaded_collection_id = self.__dict__.get('collection_id') if self.pk else None
 
     def __str__(self):
         return self.title
@@ -54,6 +170,18 @@ class Product(models.Model):
         ordering = ['title']
         verbose_name = 'Товар'
         verbose_name_plural = 'Товары'
+        # Индексы под сортировки каталога и курсор пагинации (поле + id).
+        # Замеры до/после: manage.py explain_indexes
+        indexes = [
+            models.Index(fields=['title', 'id'], name='store_product_title_idx'),
+            models.Index(fields=['collection', 'title', 'id'],
+                         name='store_product_coll_title_idx'),
+            models.Index(fields=['unit_price', 'id'], name='store_product_price_idx'),
+            models.Index(fields=['last_update', 'id'], name='store_product_updated_idx'),
+            # Частичный индекс для фильтра "мало на складе" в админке
+            models.Index(fields=['inventory'], condition=models.Q(inventory__lt=10),
+                         name='store_product_low_stock_idx'),
+        ]
 
 class Customer(models.Model):
     # Статусы покупателей
@@ -75,6 +203,11 @@ class Customer(models.Model):
     membership = models.CharField(max_length=1, choices=MEMBERSHIP_CHOICES,
                                   default=MEMBERSHIP_BRONZE, verbose_name='Статус')
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Запоминаем пользователя, чтобы при смене сбросить кэш обоих (store/customers.py)
+        self._loaded_user_id = self.__dict__.get('user_id') if self.pk else None
+
     def __str__(self):
         return f'{self.user.first_name} - {self.user.last_name}'
 
@@ -98,6 +231,92 @@ class Cart(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid4)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        # Для удаления старых корзин (manage.py delete_abandoned_carts)
+        indexes = [
+            models.Index(fields=['created_at'], name='store_cart_created_idx'),
+        ]
+
+    def get_total_price(self):
+        # Сумма считается в базе и кэшируется до следующего изменения корзины
+        return cache.get_cart_total(
+            self.pk, [Product],
+            lambda: CartItem.objects.using(self._state.db or 'default')
+            .filter(cart_id=self.pk).total_price()
+        )
+
+
+def line_total_price():
+    # quantity * цена товара, считается в базе
+    return models.ExpressionWrapper(
+        F('quantity') * F('product__unit_price'),
+        output_field=models.DecimalField(max_digits=12, decimal_places=2)
+    )
+
+
+class CartItemQuerySet(models.QuerySet):
+    def with_total_price(self):
+        return self.annotate(total_price=line_total_price())
+
+    def total_price(self):
+        total = self.order_by().aggregate(total=Sum(line_total_price()))['total']
+        return total or 0
+
+    def add(self, cart_id, product_id, quantity):
+        # Добавление товара в корзину одним запросом: если строка уже есть,
+        # база сама увеличит quantity. Параллельные добавления не теряются.
+        # Строка вставляется только если корзина и товар существуют,
+        # иначе возвращаем None
+        connection = connections[self.db]
+        quote = connection.ops.quote_name
+        table = quote(self.model._meta.db_table)
+        cart_table = quote(Cart._meta.db_table)
+        product_table = quote(Product._meta.db_table)
+        cart_field = self.model._meta.get_field('cart')
+        cart_id = cart_field.to_python(cart_id)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO {table} (cart_id, product_id, quantity) '
+                f'SELECT {cart_table}.id, {product_table}.id, %s '
+                f'FROM {cart_table}, {product_table} '
+                f'WHERE {cart_table}.id = %s AND {product_table}.id = %s '
+                'ON CONFLICT (cart_id, product_id) DO UPDATE '
+                f'SET quantity = {table}.quantity + excluded.quantity '
+                'RETURNING id, quantity',
+                [quantity, cart_field.get_db_prep_value(cart_id, connection), product_id]
+            )
+            row = cursor.fetchone()
+        if row is None:
+            return None
+        item_id, total = row
+        # Сигналы при сыром запросе не срабатывают
+        cache.invalidate_cart(cart_id, using=self.db)
+        return self.model(id=item_id, cart_id=cart_id, product_id=product_id, quantity=total)
+
+    def upsert(self, cart_id, quantities, increment=False):
+        # Пачка строк одним INSERT ... ON CONFLICT. quantities - {product_id: кол-во}.
+        # increment=True прибавляет кол-во к уже лежащему в корзине,
+        # иначе кол-во заменяется
+        if not quantities:
+            return
+        connection = connections[self.db]
+        table = connection.ops.quote_name(self.model._meta.db_table)
+        # Ключ кэша суммы строится от UUID корзины, а не от значения для базы
+        cart_field = self.model._meta.get_field('cart')
+        cart_id = cart_field.to_python(cart_id)
+        db_cart_id = cart_field.get_db_prep_value(cart_id, connection)
+        quantity = f'{table}.quantity + excluded.quantity' if increment else 'excluded.quantity'
+        values = ', '.join(['(%s, %s, %s)'] * len(quantities))
+        params = [value for product_id, count in quantities.items()
+                  for value in (db_cart_id, product_id, count)]
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO {table} (cart_id, product_id, quantity) VALUES {values} '
+                f'ON CONFLICT (cart_id, product_id) DO UPDATE SET quantity = {quantity}',
+                params
+            )
+        cache.invalidate_cart(cart_id, using=self.db)
+
 
 class CartItem(models.Model):
     cart = models.ForeignKey(Cart, on_delete=models.CASCADE, verbose_name='Корзина',
@@ -106,6 +325,16 @@ class CartItem(models.Model):
                                 verbose_name='Товар')
     quantity = models.PositiveIntegerField(verbose_name='Кол-во товаров')
 
+    objects = CartItemQuerySet.as_manager()
+
+    class Meta:
+        # Один товар - одна строка в корзине. Индекс заодно ускоряет
+        # поиск строки по (cart_id, product_id)
+        constraints = [
+            models.UniqueConstraint(fields=['cart', 'product'],
+                                    name='store_cartitem_unique_product'),
+        ]
+
 
 class Order(models.Model):
     PAYMENT_STATUS_PENDING = 'P'
@@ -124,6 +353,40 @@ class Order(models.Model):
                                       default=PAYMENT_STATUS_PENDING,
                                       verbose_name='Статус оплаты')
     customer = models.ForeignKey(Customer, on_delete=models.PROTECT)
+    # Итоги заказа записываются один раз при оформлении,
+    # чтобы история заказов не читала строки заказа
+    total_price = models.DecimalField(max_digits=12, decimal_places=2, default=0,
+                                      editable=False, verbose_name='Сумма заказа')
+    item_count = models.PositiveIntegerField(default=0, editable=False,
+                                             verbose_name='Кол-во товаров')
+    # Заказ учтен в сводках продаж (store/sales.py)
+    sales_recorded = models.BooleanField(default=False, editable=False)
+
+    def set_payment_status(self, payment_status):
+        # Смена статуса вместе со сводками продаж. Условный UPDATE по
+        # sales_recorded не дает учесть один заказ дважды при параллельных PATCH
+        complete = payment_status == self.PAYMENT_STATUS_COMPLETE
+        with transaction.atomic():
+            orders = Order.objects.filter(pk=self.pk)
+            changed = orders.filter(sales_recorded=not complete).update(
+                payment_status=payment_status, sales_recorded=complete
+            )
+            if changed:
+                from . import sales
+                sales.record_orders([self.pk], sign=1 if complete else -1)
+            else:
+                orders.update(payment_status=payment_status)
+        self.payment_status = payment_status
+        self.sales_recorded = complete
+
+    class Meta:
+        indexes = [
+            # История заказов покупателя, новые сверху
+            models.Index(fields=['customer', 'placed_at', 'id'],
+                         name='store_order_customer_idx'),
+            # Список всех заказов для персонала
+            models.Index(fields=['placed_at', 'id'], name='store_order_placed_idx'),
+        ]
 
 
 class OrderItem(models.Model):
@@ -134,6 +397,50 @@ class OrderItem(models.Model):
                                      verbose_name='Цена за шт')
 
 
+# Архив старых заказов (manage.py archive_orders). Заказ переносится
+# вместе со строками и сохраняет свой id. Горячие таблицы Order и
+# OrderItem остаются небольшими
+class ArchivedOrder(models.Model):
+    # id те же, что в горячей таблице (BigAutoField)
+    id = models.BigIntegerField(primary_key=True)
+    placed_at = models.DateTimeField(verbose_name='Время оформления')
+    payment_status = models.CharField(max_length=1, choices=Order.PAYMENT_STATUS_CHOICES,
+                                      verbose_name='Статус оплаты')
+    customer = models.ForeignKey(Customer, on_delete=models.PROTECT, related_name='+')
+    total_price = models.DecimalField(max_digits=12, decimal_places=2,
+                                      verbose_name='Сумма заказа')
+    item_count = models.PositiveIntegerField(verbose_name='Кол-во товаров')
+    sales_recorded = models.BooleanField(default=False)
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['customer', 'placed_at', 'id'],
+                         name='store_archorder_customer_idx'),
+            models.Index(fields=['placed_at', 'id'], name='store_archorder_placed_idx'),
+        ]
+
+
+class ArchivedOrderItem(models.Model):
+    id = models.BigIntegerField(primary_key=True)
+    order = models.ForeignKey(ArchivedOrder, on_delete=models.CASCADE, related_name='items')
+    product = models.ForeignKey(Product, on_delete=models.PROTECT, related_name='+')
+    quantity = models.PositiveIntegerField(verbose_name='Кол-во заказанного')
+    unit_price = models.DecimalField(max_digits=6, decimal_places=2,
+                                     verbose_name='Цена за шт')
+
+
+class ArchiveCheckpoint(models.Model):
+    # Прогресс переноса в архив: при повторном запуске с той же датой
+    # отсечки команда продолжает с last_order_id
+    name = models.CharField(max_length=50, unique=True)
+    cutoff = models.DateTimeField()
+    last_order_id = models.BigIntegerField(default=0)
+    archived = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+    finished_at = models.DateTimeField(null=True)
+
+
 class Review(models.Model):
     product = models.ForeignKey(Product, on_delete=models.CASCADE,
                                 related_name='reviews')
@@ -144,6 +451,21 @@ class Review(models.Model):
     class Meta:
         verbose_name = 'Отзыв'
         verbose_name_plural = 'Отзывы'
+        # Отзывы товара по дате - под курсор пагинацию и последний отзыв
+        indexes = [
+            models.Index(fields=['product', 'date', 'id'], name='store_review_product_date_idx'),
+        ]
+
+
+def change_review_stats(product_id, delta, using='default'):
+    # Одним UPDATE: счетчик меняем на delta, дату последнего отзыва
+    # берем из индекса (product, date) - так она верна и после удаления
+    last_date = (Review.objects.using(using).filter(product_id=OuterRef('pk'))
+                 .order_by('-date').values('date')[:1])
+    Product.objects.using(using).filter(pk=product_id).update(
+        review_count=F('review_count') + delta,
+        last_review_date=Subquery(last_date),
+    )
 
 
 class Address(models.Model):
@@ -153,11 +475,130 @@ class Address(models.Model):
                                  verbose_name='Покупатель')
 
 
+def get_blob_names(image, variants):
+    # Файлы хранилища, на которые ссылается картинка: оригинал и варианты
+    names = {getattr(image, 'name', image)}
+    for formats in (variants or {}).values():
+        names.update(formats.values())
+    return {name for name in names if name}
+
+
+def get_image_storage():
+    # Хранилище по содержимому (store/storage.py), задается в STORAGES
+    return storages['product_images']
+
+
 class ProductImage(models.Model):
     product = models.ForeignKey(Product, on_delete=models.CASCADE,
                                 related_name='images')
-    image = models.ImageField(upload_to='store/images',
+    image = models.ImageField(upload_to='store/images', storage=get_image_storage,
                               validators=[validate_file_size])
+    # Уменьшенные копии, строятся в фоне (store/images.py)
+    variants = models.JSONField(default=dict, editable=False)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Запоминаем файл, чтобы при сохранении понять, что картинку заменили
+        image = self.__dict__.get('image') if self.pk else None
+        self._loaded_image = getattr(image, 'name', image) or ''
+
+
+class ImageBlob(models.Model):
+    # Файл хранилища картинок и кол-во ссылок на него из ProductImage
+    # (оригиналы и варианты). Файлы с нулем ссылок удаляет
+    # manage.py delete_orphaned_blobs
+    name = models.CharField(max_length=255, unique=True)
+    refs = models.IntegerField(default=0)
+
+
+def change_blob_refs(counts, using='default'):
+    # counts - {имя файла: на сколько изменить}. Одним INSERT ... ON CONFLICT
+    rows = [(name, delta) for name, delta in counts.items() if delta]
+    if not rows:
+        return
+    connection = connections[using]
+    table = connection.ops.quote_name(ImageBlob._meta.db_table)
+    values = ', '.join(['(%s, %s)'] * len(rows))
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'INSERT INTO {table} (name, refs) VALUES {values} '
+            f'ON CONFLICT (name) DO UPDATE SET refs = {table}.refs + excluded.refs',
+            [value for row in rows for value in row]
+        )
+
+
+class IdempotencyKey(models.Model):
+    # Ответ на POST с заголовком Idempotency-Key. Повтор запроса с тем же
+    # ключом получает сохраненный ответ, а не выполняется еще раз.
+    # lookup - хэш от пользователя, пути и ключа
+    lookup = models.CharField(max_length=64, unique=True)
+    request_hash = models.CharField(max_length=64)
+    # Пока status_code пустой - первый запрос еще выполняется
+    status_code = models.PositiveSmallIntegerField(null=True)
+    response = models.JSONField(null=True, encoder=JSONEncoder)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    # Когда запрос занял ключ. Незавершенный захват старше
+    # STORE_IDEMPOTENCY_LEASE может перехватить повтор
+    claimed_at = models.DateTimeField(default=timezone.now)
+
+
+class Task(models.Model):
+    # Очередь фоновых задач в базе (store/queue.py, manage.py run_tasks)
+    STATUS_PENDING = 'P'
+    STATUS_RUNNING = 'R'
+    STATUS_DONE = 'D'
+    STATUS_FAILED = 'F'
+
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_DONE, 'Done'),
+        (STATUS_FAILED, 'Failed'),
+    ]
 
+    name = models.CharField(max_length=255)
+    payload = models.JSONField(default=dict, encoder=JSONEncoder)
+    status = models.CharField(max_length=1, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    max_attempts = models.PositiveSmallIntegerField(default=5)
+    # Не раньше этого времени. При повторе сдвигается на время отсрочки
+    run_at = models.DateTimeField(default=timezone.now)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True)
+    finished_at = models.DateTimeField(null=True)
+    last_error = models.TextField(blank=True)
+
+    class Meta:
+        indexes = [
+            # Выборка готовых к запуску задач
+            models.Index(fields=['status', 'run_at'], name='store_task_ready_idx'),
+        ]
+
+
+# Сводки продаж по дням. Обновляются, когда заказ становится оплаченным
+# (Order.set_payment_status), история - manage.py rebuild_sales_rollups
+class ProductSales(models.Model):
+    day = models.DateField()
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+')
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    units = models.IntegerField(default=0)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'product'],
+                                    name='store_productsales_unique_day'),
+        ]
+
+
+class CollectionSales(models.Model):
+    day = models.DateField()
+    collection = models.ForeignKey(Collection, on_delete=models.CASCADE, related_name='+')
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    units = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'collection'],
+                                    name='store_collectionsales_unique_day'),
+        ]
 
@@ -1,4 +1,242 @@
-from rest_framework.pagination import PageNumberPagination
+import json
+from datetime import date, datetime
+from decimal import Decimal
+
+from django.core import signing
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db import connections
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
 
 class DefaultPagination(PageNumberPagination):
     page_size = 10
+
+
+class KeysetPagination(BasePagination):
+    # Пагинация по ключу (cursor/keyset): вместо OFFSET следующая страница
+    # берется условием WHERE (title, id) > (последний title, последний id).
+    # Поэтому скорость не зависит от того, насколько глубоко листает клиент.
+    page_size = 10
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    cursor_query_param = 'cursor'
+    # ?count=exact - точное кол-во, ?count=approx - примерное, без параметра - не считаем
+    count_query_param = 'count'
+    approx_count_limit = 1000
+    ordering = ('title',)
+    tiebreak = 'id'  # Уникальное поле, чтобы порядок был однозначным
+    cursor_salt = 'store.paginations.KeysetPagination'
+    invalid_cursor_message = 'Неверный курсор'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.ordering = self.get_ordering(queryset, view)
+        self.fields = [self.get_field(queryset, name.lstrip('-'))
+                       for name in self.ordering]
+        self.count = self.get_count(queryset, request)
+
+        cursor = self.decode_cursor(request)
+        reverse = cursor is not None and cursor['r']
+        ordering = self.ordering
+        if reverse:
+            # Для предыдущей страницы идем в обратную сторону
+            ordering = [self.flip(name) for name in ordering]
+
+        queryset = queryset.order_by(*ordering)
+        if cursor is not None:
+            queryset = queryset.filter(self.build_filter(ordering, cursor['p']))
+
+        # Берем на одну запись больше, чтобы узнать, есть ли еще страница
+        results = list(queryset[:self.page_size + 1])
+        has_more = len(results) > self.page_size
+        results = results[:self.page_size]
+
+        if reverse:
+            results.reverse()
+            self.has_next = True
+            self.has_previous = has_more
+        else:
+            self.has_next = has_more
+            self.has_previous = cursor is not None
+
+        self.page = results
+        return results
+
+    def get_paginated_response(self, data):
+        response = {
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        }
+        if self.count is not None:
+            response['count'], response['count_is_exact'] = self.count
+        return Response(response)
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'count': {'type': 'integer'},
+                'count_is_exact': {'type': 'boolean'},
+                'results': schema,
+            },
+        }
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        if page_size <= 0:
+            return self.page_size
+        return min(page_size, self.max_page_size)
+
+    def get_ordering(self, queryset, view):
+        # Сортировка уже применена фильтрами (OrderingFilter, поиск по релевантности).
+        # Если ее нет - берем сортировку по умолчанию
+        ordering = [name for name in queryset.query.order_by if isinstance(name, str)]
+        ordering = ordering or list(getattr(view, 'ordering', None) or self.ordering)
+        if self.tiebreak not in [name.lstrip('-') for name in ordering]:
+            # Добивка идет в ту же сторону, что и первое поле: (-placed_at, -id)
+            # база читает индекс (placed_at, id) задом наперед, а смешанный
+            # (-placed_at, id) индексом не покрыть - будет сортировка
+            direction = '-' if ordering[0].startswith('-') else ''
+            ordering.append(direction + self.tiebreak)
+        return ordering
+
+    def get_field(self, queryset, name):
+        # Поле модели или аннотация (например, search_rank)
+        try:
+            field = queryset.model._meta.get_field(name)
+            return field, field.attname
+        except FieldDoesNotExist:
+            return queryset.query.annotations[name].output_field, name
+
+    def get_count(self, queryset, request):
+        mode = request.query_params.get(self.count_query_param)
+        if mode == 'exact':
+            return queryset.count(), True
+        if mode == 'approx':
+            return self.get_approx_count(queryset)
+        return None
+
+    def get_approx_count(self, queryset):
+        connection = connections[queryset.db]
+        if connection.vendor == 'postgresql':
+            # Оценка планировщика - запрос не выполняется вовсе
+            sql, params = queryset.order_by().query.sql_with_params()
+            with connection.cursor() as cursor:
+                cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+                plan = cursor.fetchone()[0]
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            return int(plan[0]['Plan']['Plan Rows']), False
+        # На остальных базах считаем не дальше approx_count_limit записей
+        count = queryset.order_by()[:self.approx_count_limit + 1].count()
+        return min(count, self.approx_count_limit), count <= self.approx_count_limit
+
+    def build_filter(self, ordering, values):
+        # (a, b, id) > (x, y, z) раскрываем в
+        # a > x OR (a = x AND b > y) OR (a = x AND b = y AND id > z).
+        # Дополнительное a >= x позволяет базе начать чтение индекса
+        # сразу с нужного места, а не сканировать его с начала
+        first = ordering[0].lstrip('-')
+        bound = 'lte' if ordering[0].startswith('-') else 'gte'
+        condition = Q()
+        equal = {}
+        for name, value in zip(ordering, values):
+            field = name.lstrip('-')
+            lookup = 'lt' if name.startswith('-') else 'gt'
+            condition |= Q(**equal, **{f'{field}__{lookup}': value})
+            equal[field] = value
+        return Q(**{f'{first}__{bound}': values[0]}) & condition
+
+    def flip(self, name):
+        return name[1:] if name.startswith('-') else '-' + name
+
+    def get_position(self, instance):
+        # instance может быть и моделью, и словарем из values()
+        if isinstance(instance, dict):
+            return [self.dump_value(instance[attname]) for field, attname in self.fields]
+        return [self.dump_value(getattr(instance, attname))
+                for field, attname in self.fields]
+
+    def dump_value(self, value):
+        if isinstance(value, (datetime, date)):
+            return value.isoformat()
+        if isinstance(value, Decimal):
+            return str(value)
+        return value
+
+    def encode_cursor(self, position, reverse):
+        cursor = signing.dumps({'o': self.ordering, 'p': position, 'r': reverse},
+                               salt=self.cursor_salt, compress=True)
+        return replace_query_param(self.request.build_absolute_uri(),
+                                   self.cursor_query_param, cursor)
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+        try:
+            cursor = signing.loads(encoded, salt=self.cursor_salt)
+            # Курсор был построен для другой сортировки
+            if cursor['o'] != self.ordering:
+                raise ValueError
+            cursor['p'] = [field.to_python(value)
+                           for (field, attname), value in zip(self.fields, cursor['p'])]
+            cursor['r'] = bool(cursor['r'])
+        except (signing.BadSignature, ValidationError,
+                KeyError, TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        return cursor
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        return self.encode_cursor(self.get_position(self.page[-1]), False)
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        if not self.page:
+            return remove_query_param(self.request.build_absolute_uri(),
+                                      self.cursor_query_param)
+        return self.encode_cursor(self.get_position(self.page[0]), True)
+
+
+class ProductPagination(KeysetPagination):
+    ordering = ('title',)
+
+
+class OrderPagination(KeysetPagination):
+    # История заказов - сначала новые. Архивные заказы старше горячих,
+    # поэтому с последней страницы горячей таблицы next ведет в архив
+    # (?archived=true): листая next, клиент проходит всю историю
+    ordering = ('-placed_at',)
+    archive_query_param = 'archived'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.view = view
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_next_link(self):
+        link = super().get_next_link()
+        if link is None and self.view is not None and self.view.has_archive():
+            url = remove_query_param(self.request.build_absolute_uri(), self.cursor_query_param)
+            link = replace_query_param(url, self.archive_query_param, 'true')
+        return link
+
+
+class ReviewPagination(KeysetPagination):
+    # Сначала новые. Обе колонки по убыванию - база читает
+    # индекс (product, date, id) в обратную сторону без сортировки
+    ordering = ('-date', '-id')
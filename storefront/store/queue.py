@@ -0,0 +1,137 @@
+import logging
+import random
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Avg, Count, DurationField, ExpressionWrapper, F, Max, Min, Q
+from django.utils import timezone
+from .models import Task
+
+# Очередь фоновых задач в таблице Task, без внешнего брокера.
+# Задача - функция, зарегистрированная декоратором @task, ее аргументы
+# лежат в payload. Задачи выполняет manage.py run_tasks.
+
+logger = logging.getLogger(__name__)
+
+TASKS = {}
+
+
+def task(name=None, max_attempts=None):
+    def register(function):
+        task_name = name or f'{function.__module__}.{function.__name__}'
+        function.task_name = task_name
+        function.max_attempts = max_attempts
+        TASKS[task_name] = function
+        return function
+    return register
+
+
+def enqueue(function, using='default', **payload):
+    # Строка задачи пишется в текущей транзакции: воркер увидит ее только
+    # после коммита, а при откате задача исчезнет вместе с заказом
+    return Task.objects.using(using).create(
+        name=function.task_name,
+        payload=payload,
+        max_attempts=function.max_attempts or getattr(settings, 'STORE_TASK_MAX_ATTEMPTS', 5),
+    )
+
+
+def get_retry_delay(attempts):
+    # Экспоненциальная отсрочка со случайной добавкой,
+    # чтобы упавшие разом задачи не повторялись тоже разом
+    base = getattr(settings, 'STORE_TASK_RETRY_DELAY', 10)
+    limit = getattr(settings, 'STORE_TASK_MAX_RETRY_DELAY', 60 * 60)
+    delay = min(base * 2 ** (attempts - 1), limit)
+    return timedelta(seconds=delay * random.uniform(1, 1.25))
+
+
+def claim(limit):
+    # Забираем готовые задачи. Условный UPDATE по статусу гарантирует,
+    # что задачу возьмет только один воркер
+    now = timezone.now()
+    ids = list(Task.objects.filter(status=Task.STATUS_PENDING, run_at__lte=now)
+               .order_by('run_at').values_list('id', flat=True)[:limit])
+    claimed = []
+    for task_id in ids:
+        if Task.objects.filter(pk=task_id, status=Task.STATUS_PENDING).update(
+                status=Task.STATUS_RUNNING, started_at=now, attempts=F('attempts') + 1):
+            claimed.append(task_id)
+    return claimed
+
+
+def run(task_id):
+    try:
+        record = Task.objects.get(pk=task_id)
+        function = TASKS.get(record.name)
+        try:
+            if function is None:
+                raise LookupError(f'Неизвестная задача {record.name}')
+            function(**record.payload)
+        except Exception:
+            error = traceback.format_exc()
+            logger.warning('Задача %s (%s) упала, попытка %s из %s',
+                           record.name, record.pk, record.attempts, record.max_attempts)
+            if record.attempts < record.max_attempts:
+                Task.objects.filter(pk=record.pk).update(
+                    status=Task.STATUS_PENDING, last_error=error,
+                    run_at=timezone.now() + get_retry_delay(record.attempts),
+                )
+            else:
+                Task.objects.filter(pk=record.pk).update(
+                    status=Task.STATUS_FAILED, last_error=error, finished_at=timezone.now()
+                )
+            return False
+        Task.objects.filter(pk=record.pk).update(status=Task.STATUS_DONE,
+                                                 finished_at=timezone.now())
+        return True
+    finally:
+        # Каждый поток воркера держит свое соединение - закрываем его
+        connection.close()
+
+
+def requeue_stale():
+    # Воркер упал посреди задачи - через STORE_TASK_TIMEOUT возвращаем ее в очередь.
+    # Попытка уже засчитана при захвате: задача, которая роняет воркер
+    # каждый раз, после max_attempts считается упавшей, а не крутится вечно
+    now = timezone.now()
+    timeout = timedelta(seconds=getattr(settings, 'STORE_TASK_TIMEOUT', 60 * 5))
+    stale = Task.objects.filter(status=Task.STATUS_RUNNING, started_at__lt=now - timeout)
+    failed = stale.filter(attempts__gte=F('max_attempts')).update(
+        status=Task.STATUS_FAILED, finished_at=now,
+        last_error=f'Воркер не завершил задачу за {timeout.total_seconds():.0f} с',
+    )
+    if failed:
+        logger.warning('Задач упало после зависания воркера: %s', failed)
+    return stale.update(status=Task.STATUS_PENDING, run_at=now)
+
+
+def delete_finished():
+    days = getattr(settings, 'STORE_TASK_KEEP_DONE_DAYS', 7)
+    return Task.objects.filter(status=Task.STATUS_DONE,
+                               finished_at__lt=timezone.now() - timedelta(days=days)).delete()[0]
+
+
+def get_metrics(window=timedelta(hours=1)):
+    now = timezone.now()
+    depth = Task.objects.aggregate(
+        pending=Count('id', filter=Q(status=Task.STATUS_PENDING)),
+        ready=Count('id', filter=Q(status=Task.STATUS_PENDING, run_at__lte=now)),
+        running=Count('id', filter=Q(status=Task.STATUS_RUNNING)),
+        failed=Count('id', filter=Q(status=Task.STATUS_FAILED)),
+        oldest_ready=Min('run_at', filter=Q(status=Task.STATUS_PENDING, run_at__lte=now)),
+    )
+    # Задержка - от постановки в очередь до старта, время работы - от старта до конца
+    wait = ExpressionWrapper(F('started_at') - F('created_at'), output_field=DurationField())
+    duration = ExpressionWrapper(F('finished_at') - F('started_at'),
+                                 output_field=DurationField())
+    latency = Task.objects.filter(status=Task.STATUS_DONE,
+                                  finished_at__gte=now - window).aggregate(
+        done=Count('id'), avg_wait=Avg(wait), max_wait=Max(wait), avg_duration=Avg(duration),
+    )
+    oldest = depth.pop('oldest_ready')
+    depth['oldest_ready_age'] = (now - oldest).total_seconds() if oldest else 0
+    for key in ('avg_wait', 'max_wait', 'avg_duration'):
+        latency[key] = latency[key].total_seconds() if latency[key] else 0
+    return {**depth, **latency}
@@ -0,0 +1,84 @@
+from django.db import connections
+from django.db.models import DecimalField, ExpressionWrapper, F, Sum
+from django.db.models.functions import TruncDate
+from .models import CollectionSales, OrderItem, ProductSales
+
+# Сводки продаж: выручка и кол-во проданных штук по дням для каждого товара
+# и каждой категории. Отчеты читают только эти таблицы, а не строки заказов.
+
+UPSERT_BATCH = 200
+
+
+def get_order_sales(order_ids, using='default', items=OrderItem):
+    # Строки заказов, сгруппированные по дню, товару и категории.
+    # items=ArchivedOrderItem - то же для заказов из архива
+    revenue = ExpressionWrapper(F('quantity') * F('unit_price'),
+                                output_field=DecimalField(max_digits=14, decimal_places=2))
+    return (items.objects.using(using).filter(order_id__in=order_ids)
+            .order_by()
+            .values_list(TruncDate('order__placed_at'), 'product_id', 'product__collection_id')
+            .annotate(revenue=Sum(revenue), units=Sum('quantity')))
+
+
+def record_orders(order_ids, sign=1, using='default', items=OrderItem):
+    # sign=1 - заказ оплачен, sign=-1 - оплату отменили
+    products = {}
+    collections = {}
+    for day, product_id, collection_id, revenue, units in get_order_sales(order_ids, using, items):
+        for totals, key in ((products, (day, product_id)), (collections, (day, collection_id))):
+            total = totals.setdefault(key, [0, 0])
+            total[0] += revenue * sign
+            total[1] += units * sign
+    increment(ProductSales, 'product_id', products, using)
+    increment(CollectionSales, 'collection_id', collections, using)
+
+
+def increment(model, key_column, totals, using='default'):
+    # Прибавляем к сводке одним INSERT ... ON CONFLICT на пачку строк
+    if not totals:
+        return
+    connection = connections[using]
+    table = connection.ops.quote_name(model._meta.db_table)
+    day_field = model._meta.get_field('day')
+    revenue_field = model._meta.get_field('revenue')
+    rows = list(totals.items())
+    with connection.cursor() as cursor:
+        for start in range(0, len(rows), UPSERT_BATCH):
+            batch = rows[start:start + UPSERT_BATCH]
+            values = ', '.join(['(%s, %s, %s, %s)'] * len(batch))
+            params = [value for (day, key), (revenue, units) in batch
+                      for value in (day_field.get_db_prep_value(day, connection), key,
+                                    revenue_field.get_db_prep_value(revenue, connection),
+                                    units)]
+            cursor.execute(
+                f'INSERT INTO {table} (day, {key_column}, revenue, units) VALUES {values} '
+                f'ON CONFLICT (day, {key_column}) DO UPDATE SET '
+                f'revenue = {table}.revenue + excluded.revenue, '
+                f'units = {table}.units + excluded.units',
+                params
+            )
+
+
+def get_report(date_from, date_to, group, limit, using='default'):
+    collections = CollectionSales.objects.using(using).filter(day__range=(date_from, date_to))
+    totals = collections.aggregate(revenue=Sum('revenue'), units=Sum('units'))
+    if group == 'day':
+        results = (collections.order_by('day').values('day')
+                   .annotate(revenue=Sum('revenue'), units=Sum('units')))
+    elif group == 'collection':
+        results = (collections.values('collection_id', title=F('collection__title'))
+                   .annotate(revenue=Sum('revenue'), units=Sum('units'))
+                   .order_by('-revenue', 'collection_id')[:limit])
+    else:
+        results = (ProductSales.objects.using(using).filter(day__range=(date_from, date_to))
+                   .values('product_id', title=F('product__title'))
+                   .annotate(revenue=Sum('revenue'), units=Sum('units'))
+                   .order_by('-revenue', 'product_id')[:limit])
+    return {
+        'date_from': date_from,
+        'date_to': date_to,
+        'group': group,
+        'revenue': totals['revenue'] or 0,
+        'units': totals['units'] or 0,
+        'results': list(results),
+    }
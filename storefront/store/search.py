@@ -0,0 +1,148 @@
+import re
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import FloatField
+from django.db.models.expressions import RawSQL
+
+# Полнотекстовый индекс товаров. Индекс лежит в отдельной таблице,
+# ключ - id товара. Таблица создается миграцией 0002_product_search_index:
+# на SQLite это виртуальная таблица FTS5, на PostgreSQL - tsvector + GIN индекс.
+# На других базах индекса нет и поиск работает через обычный icontains.
+
+SQLITE_TABLE = 'store_product_fts'
+POSTGRES_TABLE = 'store_product_search'
+
+
+def get_search_words(terms):
+    # Из поисковых слов оставляем только буквы и цифры,
+    # чтобы пользовательский ввод не ломал синтаксис запроса к индексу
+    return [word for term in terms for word in re.findall(r'\w+', term)]
+
+
+def _missing_range(column, product_table, after, up_to):
+    bounds, params = [f'{column} > %s'], [after]
+    if up_to is not None:
+        bounds.append(f'{column} <= %s')
+        params.append(up_to)
+    bounds = ' AND '.join(bounds)
+    return (f'{bounds} AND NOT EXISTS (SELECT 1 FROM {product_table} '
+            f'WHERE {product_table}.id = {column})'), params
+
+
+class SqliteSearchBackend:
+    table = SQLITE_TABLE
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def index(self, products):
+        rows = [(product_id, title, description or '')
+                for product_id, title, description in products]
+        with self.connection.cursor() as cursor:
+            cursor.executemany(f'DELETE FROM {self.table} WHERE rowid = %s',
+                               [(row[0],) for row in rows])
+            cursor.executemany(f'INSERT INTO {self.table} (rowid, title, description) '
+                               'VALUES (%s, %s, %s)', rows)
+
+    def remove(self, product_ids):
+        with self.connection.cursor() as cursor:
+            cursor.executemany(f'DELETE FROM {self.table} WHERE rowid = %s',
+                               [(product_id,) for product_id in product_ids])
+
+    def remove_missing(self, product_table, after, up_to=None):
+        # Удаляет из индекса id в диапазоне (after, up_to], которых уже нет в таблице товаров
+        sql, params = _missing_range(f'{self.table}.rowid', product_table, after, up_to)
+        with self.connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {self.table} WHERE {sql}', params)
+
+    def search(self, queryset, words):
+        # "слово"* - поиск по префиксу, чтобы искать прямо во время набора
+        query = ' '.join('"%s"*' % word for word in words)
+        product_table = self.connection.ops.quote_name(queryset.model._meta.db_table)
+        matches = RawSQL(f'SELECT rowid FROM {self.table} WHERE {self.table} MATCH %s',
+                         [query])
+        # bm25 тем меньше, чем релевантнее. Совпадение в названии весит больше
+        rank = RawSQL(f'SELECT -bm25({self.table}, 10.0, 1.0) FROM {self.table} '
+                      f'WHERE {self.table} MATCH %s AND rowid = {product_table}.id',
+                      [query], output_field=FloatField())
+        return queryset.filter(id__in=matches).annotate(search_rank=rank)
+
+
+class PostgresSearchBackend:
+    table = POSTGRES_TABLE
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.config = getattr(settings, 'STORE_SEARCH_CONFIG', 'simple')
+
+    def document_sql(self):
+        return (f"setweight(to_tsvector('{self.config}', %s), 'A') || "
+                f"setweight(to_tsvector('{self.config}', %s), 'B')")
+
+    def index(self, products):
+        rows = [(product_id, title, description or '')
+                for product_id, title, description in products]
+        with self.connection.cursor() as cursor:
+            cursor.executemany(
+                f'INSERT INTO {self.table} (product_id, document) '
+                f'VALUES (%s, {self.document_sql()}) '
+                'ON CONFLICT (product_id) DO UPDATE SET document = EXCLUDED.document',
+                rows
+            )
+
+    def remove(self, product_ids):
+        with self.connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {self.table} WHERE product_id = ANY(%s)',
+                           [list(product_ids)])
+
+    def remove_missing(self, product_table, after, up_to=None):
+        sql, params = _missing_range(f'{self.table}.product_id', product_table, after, up_to)
+        with self.connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {self.table} WHERE {sql}', params)
+
+    def search(self, queryset, words):
+        query = ' & '.join(f'{word}:*' for word in words)
+        tsquery = f"to_tsquery('{self.config}', %s)"
+        product_table = self.connection.ops.quote_name(queryset.model._meta.db_table)
+        matches = RawSQL(f'SELECT product_id FROM {self.table} '
+                         f'WHERE document @@ {tsquery}', [query])
+        rank = RawSQL(f'SELECT ts_rank(document, {tsquery}) FROM {self.table} '
+                      f'WHERE product_id = {product_table}.id',
+                      [query], output_field=FloatField())
+        return queryset.filter(id__in=matches).annotate(search_rank=rank)
+
+
+BACKENDS = {
+    'sqlite': SqliteSearchBackend,
+    'postgresql': PostgresSearchBackend,
+}
+
+_available = {}
+
+
+def get_backend(using='default'):
+    # Проверяем наличие таблицы индекса один раз на процесс
+    connection = connections[using]
+    backend_class = BACKENDS.get(connection.vendor)
+    if backend_class is None:
+        return None
+    if using not in _available:
+        table_names = connection.introspection.table_names()
+        _available[using] = backend_class.table in table_names
+    if not _available[using]:
+        return None
+    return backend_class(connection)
+
+
+def index_products(products, using='default'):
+    # products - список кортежей (id, title, description)
+    backend = get_backend(using)
+    if backend is not None and products:
+        backend.index(products)
+
+
+def remove_products(product_ids, using='default'):
+    backend = get_backend(using)
+    if backend is not None and product_ids:
+        backend.remove(product_ids)
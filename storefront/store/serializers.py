@@ -1,7 +1,12 @@
 from .models import *
 from decimal import Decimal
-from django.db import transaction
+from django.db import IntegrityError, transaction
+from django.db.models import F
 from rest_framework import serializers
+from rest_framework.exceptions import NotFound
+from django.core.exceptions import ValidationError as DjangoValidationError
+from .images import get_variant_urls
+from . import customers, queue, tasks
 
 # Сериализация - процесс формирования объекта из базы данных в вид JSON
 # class CollectionSerializer(serializers.Serializer):
@@ -9,14 +14,49 @@ from rest_framework import serializers
 #     id = serializers.IntegerField()
 #     title = serializers.CharField(max_length=255)
 
+def get_requested_fields(request):
+    # ?fields=id,title - какие поля отдать, ?expand=collection - что развернуть.
+    # Возвращает (set или None если отдаем все, set)
+    if request is None or request.method not in ('GET', 'HEAD'):
+        return None, set()
+
+    def parse(name):
+        value = request.query_params.get(name, '')
+        return {field.strip() for field in value.split(',') if field.strip()}
+
+    return parse('fields') or None, parse('expand')
+
+
+class DynamicFieldsMixin:
+    # Убирает из ответа поля, которые не запросили в ?fields=,
+    # и разворачивает связанные объекты из ?expand=
+    expandable_fields = {}
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        fields, expand = get_requested_fields(self.context.get('request'))
+        for name in expand & set(self.expandable_fields):
+            self.fields[name] = self.expandable_fields[name](read_only=True)
+        if fields is not None:
+            for name in set(self.fields) - fields:
+                self.fields.pop(name)
+
+
 class ProductImageSerializer(serializers.ModelSerializer):
+    # Ссылки на уменьшенные копии: {'card': {'webp': url, 'jpeg': url}, ...}.
+    # Пустой словарь, пока фоновая задача их не построила
+    variants = serializers.SerializerMethodField()
+
+    def get_variants(self, image):
+        return get_variant_urls(image.variants, self.context.get('request'))
+
     def create(self, validated_data):
         product_id = self.context['product_id']
         return ProductImage.objects.create(product_id=product_id, **validated_data)
 
     class Meta:
         model = ProductImage
-        fields = ['id', 'image']
+        fields = ['id', 'image', 'variants']
 
 
 class CollectionSerializer(serializers.ModelSerializer):
@@ -25,7 +65,7 @@ class CollectionSerializer(serializers.ModelSerializer):
         fields = ['id', 'title', 'products_count']
 
     products_count = serializers.IntegerField(read_only=True)
-    # Поле которого нет в базе, при этом его нельзя менять. Только читать
+    # Хранится в базе и обновляется при изменении товаров. Только читать
 
 # class ProductSerializer(serializers.Serializer):
 #     id = serializers.IntegerField()
@@ -42,13 +82,15 @@ class CollectionSerializer(serializers.ModelSerializer):
     #     return round(product.unit_price * Decimal(1.1), 2)
     #     # Округленная цена с наценкой 10% до 2х знаков после запятой
     #
-class ProductSerializer(serializers.ModelSerializer):
+class ProductSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     images = ProductImageSerializer(many=True, read_only=True)
+    expandable_fields = {'collection': CollectionSerializer}
 
     class Meta:
         model = Product
         fields = ['id', 'title', 'price', 'description',
-                  'slug', 'inventory', 'price_with_tax', 'collection', 'images']
+                  'slug', 'inventory', 'price_with_tax', 'collection', 'images',
+                  'review_count', 'last_review_date']
 
     collection = serializers.PrimaryKeyRelatedField(
         queryset=Collection.objects.all() # Будем показывать id категории
@@ -82,6 +124,131 @@ class ProductSerializer(serializers.ModelSerializer):
         instance.save()
         return instance
 
+
+class FastProductSerializer:
+    # Быстрый путь только для чтения (list и retrieve). Работает со словарями
+    # из Product.objects.values(*values_fields) вместо моделей, картинки всей
+    # страницы грузит одним запросом. JSON получается такой же, как у ProductSerializer
+    values_fields = ['id', 'title', 'unit_price', 'description', 'slug',
+                     'inventory', 'collection_id', 'last_update',
+                     'review_count', 'last_review_date']
+    # Какие колонки нужны для каждого поля ответа
+    field_columns = {
+        'id': ['id'],
+        'title': ['title'],
+        'price': ['unit_price'],
+        'description': ['description'],
+        'slug': ['slug'],
+        'inventory': ['inventory'],
+        'price_with_tax': ['unit_price'],
+        'collection': ['collection_id'],
+        'images': [],
+        'review_count': ['review_count'],
+        'last_review_date': ['last_review_date'],
+    }
+    expand_columns = {'collection': ['collection__title', 'collection__products_count']}
+    # Колонки сортировки нужны пагинации для курсора
+    ordering_columns = ['id', 'title', 'unit_price', 'last_update']
+    price_field = serializers.DecimalField(max_digits=6, decimal_places=2)
+    date_field = serializers.DateField()
+    tax_rate = Decimal(1.1)
+
+    def __init__(self, instance=None, many=False, context=None, **kwargs):
+        self.instance = instance
+        self.many = many
+        self.context = context or {}
+
+    @classmethod
+    def get_field_names(cls, request):
+        fields, expand = get_requested_fields(request)
+        names = [name for name in ProductSerializer.Meta.fields
+                 if fields is None or name in fields]
+        return names, expand & set(names)
+
+    @classmethod
+    def get_values_fields(cls, request):
+        names, expand = cls.get_field_names(request)
+        columns = list(cls.ordering_columns)
+        for name in names:
+            columns += cls.field_columns[name]
+        for name in expand:
+            columns += cls.expand_columns[name]
+        return list(dict.fromkeys(columns))
+
+    @property
+    def data(self):
+        rows = list(self.instance) if self.many else [self.instance]
+        result = self.to_representation(rows)
+        return result if self.many else result[0]
+
+    def get_taxes(self, rows):
+        # Налог считаем один раз на каждую цену на странице
+        prices = {row['unit_price'] for row in rows}
+        return {price: round(price * self.tax_rate, 2) for price in prices}
+
+    def get_images(self, rows):
+        images = {row['id']: [] for row in rows}
+        if not images:
+            return images
+        storage = ProductImage._meta.get_field('image').storage
+        request = self.context.get('request')
+        queryset = (ProductImage.objects.filter(product_id__in=list(images))
+                    .order_by('id').values_list('product_id', 'id', 'image', 'variants'))
+        for product_id, image_id, name, variants in queryset:
+            url = None
+            if name:
+                url = storage.url(name)
+                if request is not None:
+                    url = request.build_absolute_uri(url)
+            images[product_id].append({'id': image_id, 'image': url,
+                                       'variants': get_variant_urls(variants, request)})
+        return images
+
+    def to_representation(self, rows):
+        names, expand = self.get_field_names(self.context.get('request'))
+        taxes = self.get_taxes(rows) if 'price_with_tax' in names else {}
+        images = self.get_images(rows) if 'images' in names else {}
+        to_price = self.price_field.to_representation
+        to_date = self.date_field.to_representation
+        if 'collection' in expand:
+            get_collection = lambda row: {
+                'id': row['collection_id'],
+                'title': row['collection__title'],
+                'products_count': row['collection__products_count'],
+            }
+        else:
+            get_collection = lambda row: row['collection_id']
+        getters = {
+            'id': lambda row: row['id'],
+            'title': lambda row: row['title'],
+            'price': lambda row: to_price(row['unit_price']),
+            'description': lambda row: row['description'],
+            'slug': lambda row: row['slug'],
+            'inventory': lambda row: row['inventory'],
+            'price_with_tax': lambda row: taxes[row['unit_price']],
+            'collection': get_collection,
+            'images': lambda row: images[row['id']],
+            'review_count': lambda row: row['review_count'],
+            'last_review_date': lambda row: to_date(row['last_review_date']),
+        }
+        getters = [(name, getters[name]) for name in names]
+        return [{name: getter(row) for name, getter in getters} for row in rows]
+
+
+# Проверка одной записи при массовом импорте товаров (store/bulk.py).
+# Связи проверяются сразу для всей пачки, поэтому здесь это просто id
+class ProductImportSerializer(serializers.ModelSerializer):
+    unit_price = serializers.DecimalField(max_digits=6, decimal_places=2,
+                                          min_value=Decimal(1))
+    collection = serializers.IntegerField()
+    promotion = serializers.ListField(child=serializers.IntegerField(), required=False)
+
+    class Meta:
+        model = Product
+        fields = ['slug', 'title', 'description', 'unit_price', 'inventory',
+                  'collection', 'promotion']
+
+
 class ReviewSerializer(serializers.ModelSerializer):
     class Meta:
         model = Review
@@ -89,7 +256,9 @@ class ReviewSerializer(serializers.ModelSerializer):
 
     def create(self, validated_data):
         product_id = self.context['product_id']
-        return Review.objects.create(product_id=product_id, **validated_data)
+        # Отзыв и статистика товара (сигнал) - в одной транзакции
+        with transaction.atomic():
+            return Review.objects.create(product_id=product_id, **validated_data)
 
 '''
 cart/27bda4c0-3577-4188-be11-a9e3cc808dbe/
@@ -125,6 +294,9 @@ class CartItemSerializer(serializers.ModelSerializer):
     total_price = serializers.SerializerMethodField(method_name='get_total_price')
 
     def get_total_price(self, cart_item: CartItem):
+        # Обычно сумма строки уже посчитана в базе (with_total_price)
+        if hasattr(cart_item, 'total_price'):
+            return cart_item.total_price
         return cart_item.quantity * cart_item.product.unit_price
 
     class Meta:
@@ -132,15 +304,15 @@ class CartItemSerializer(serializers.ModelSerializer):
         fields = ['id', 'product', 'quantity', 'total_price']
 
 
-class CartSerializer(serializers.ModelSerializer):
+class CartSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     id = serializers.UUIDField(read_only=True)
     items = CartItemSerializer(many=True, read_only=True)
     total_price = serializers.SerializerMethodField(method_name='get_total_price')
 
-    # Попробуйте реализовать метод,
-    # который считает всю стоимость корзины по ее товарам
+    # Сумма считается в базе и берется из кэша, поэтому опрос корзины
+    # со страницы оформления заказа не загружает все товары заново
     def get_total_price(self, cart: Cart):
-        return sum([item.quantity * item.product.unit_price for item in cart.items.all()])
+        return cart.get_total_price()
 
     class Meta:
         model = Cart
@@ -150,36 +322,27 @@ class CartSerializer(serializers.ModelSerializer):
 # Сериализер для добавления товара в корзину
 class AddCartItemSerializer(serializers.ModelSerializer):
     product_id = serializers.IntegerField()
-    # Поле, которое нужно выводить
-    def validate_product_id(self, value):
-        # Валидация product_id, проверяет существует ли продукт с этим ID
-        if not Product.objects.filter(pk=value).exists():
-            # Если продует не найдет, выбрасывается ошибка валидации
-            raise serializers.ValidationError('Нет товара с данным id')
-        # Если продукт существует, возвращается значение ID
-        return value
 
     def save(self, **kwargs):
         # Получаем ID корзины из контекста запроса
         cart_id = self.context['cart_id']
-        # Получаем ID продукта из проверенных данных
         product_id = self.validated_data['product_id']
-        # Получаем кол-во добавляемого товара
         quantity = self.validated_data['quantity']
 
+        # Один запрос INSERT ... ON CONFLICT DO UPDATE вместо
+        # проверки товара, поиска строки и отдельного UPDATE/INSERT
         try:
-            # Попытка найти существующий элемент в корзине с данными
-            cart_item = CartItem.objects.get(cart_id=cart_id, product_id=product_id)
-            # Если элемент найдет, увеличиваем кол-во
-            cart_item.quantity += quantity
-            cart_item.save()
-            # Обновляем instance сериалайзера наденным элементом
-            self.instance = cart_item
-        except:
-            # Если элемент не найдет, создаем новый с заданными параметрами
-            self.instance = CartItem.objects.create(cart_id=cart_id,
-                                                    **self.validated_data)
-        # Возвращаем экземпляр модели
+            with transaction.atomic():
+                self.instance = CartItem.objects.add(cart_id, product_id, quantity)
+        except DjangoValidationError:
+            raise NotFound('Корзина не найдена')
+        except IntegrityError:
+            # Корзину или товар удалили одновременно с добавлением
+            self.instance = None
+        if self.instance is None:
+            if not Cart.objects.filter(pk=cart_id).exists():
+                raise NotFound('Корзина не найдена')
+            raise serializers.ValidationError({'product_id': ['Нет товара с данным id']})
         return self.instance
 
     class Meta:
@@ -195,6 +358,92 @@ class UpdateCartItemSerializer(serializers.ModelSerializer):
         fields = ['quantity']
 
 
+class CartItemOperationSerializer(serializers.Serializer):
+    OPERATION_ADD = 'add'
+    OPERATION_SET = 'set'
+    OPERATION_REMOVE = 'remove'
+
+    op = serializers.ChoiceField(choices=[OPERATION_ADD, OPERATION_SET, OPERATION_REMOVE])
+    product_id = serializers.IntegerField()
+    quantity = serializers.IntegerField(min_value=1, required=False)
+
+    def validate(self, attrs):
+        if attrs['op'] != self.OPERATION_REMOVE and 'quantity' not in attrs:
+            raise serializers.ValidationError(
+                {'quantity': [self.fields['quantity'].error_messages['required']]},
+                code='required'
+            )
+        return attrs
+
+
+# Несколько изменений корзины за один запрос:
+# {"operations": [{"op": "add", "product_id": 1, "quantity": 2},
+#                 {"op": "set", "product_id": 2, "quantity": 1},
+#                 {"op": "remove", "product_id": 3}]}
+class CartItemBatchSerializer(serializers.Serializer):
+    operations = serializers.ListField(child=CartItemOperationSerializer(),
+                                       allow_empty=False, max_length=500)
+
+    def validate_operations(self, operations):
+        # Все товары проверяем одним запросом
+        product_ids = {operation['product_id'] for operation in operations}
+        known = set(Product.objects.filter(pk__in=product_ids).order_by()
+                    .values_list('pk', flat=True))
+        errors = {index: {'product_id': ['Нет товара с данным id']}
+                  for index, operation in enumerate(operations)
+                  if operation['product_id'] not in known}
+        if errors:
+            raise serializers.ValidationError(errors)
+        return operations
+
+    def get_changes(self):
+        # Сворачиваем операции по товару в одно итоговое изменение:
+        # прибавить (add), заменить кол-во (set) или удалить (remove)
+        changes = {}
+        for operation in self.validated_data['operations']:
+            product_id = operation['product_id']
+            op = operation['op']
+            previous = changes.get(product_id)
+            if op == CartItemOperationSerializer.OPERATION_ADD and previous is not None:
+                if previous[0] == CartItemOperationSerializer.OPERATION_REMOVE:
+                    # Удалили и снова добавили - итоговое кол-во известно
+                    changes[product_id] = (CartItemOperationSerializer.OPERATION_SET,
+                                           operation['quantity'])
+                else:
+                    changes[product_id] = (previous[0], previous[1] + operation['quantity'])
+            else:
+                changes[product_id] = (op, operation.get('quantity'))
+        return changes
+
+    def save(self, **kwargs):
+        cart_id = self.context['cart_id']
+        grouped = {op: {} for op in (CartItemOperationSerializer.OPERATION_ADD,
+                                     CartItemOperationSerializer.OPERATION_SET,
+                                     CartItemOperationSerializer.OPERATION_REMOVE)}
+        for product_id, (op, quantity) in self.get_changes().items():
+            grouped[op][product_id] = quantity
+
+        try:
+            with transaction.atomic():
+                # Блокируем корзину, чтобы параллельные пачки применялись по очереди.
+                # Пустой UPDATE, как при оформлении заказа: SQLite не поддерживает
+                # SELECT FOR UPDATE, а транзакция должна начинаться с записи
+                if not Cart.objects.filter(pk=cart_id).update(created_at=F('created_at')):
+                    raise NotFound('Корзина не найдена')
+                removed = grouped[CartItemOperationSerializer.OPERATION_REMOVE]
+                if removed:
+                    CartItem.objects.filter(cart_id=cart_id, product_id__in=removed).delete()
+                CartItem.objects.upsert(cart_id, grouped[CartItemOperationSerializer.OPERATION_SET])
+                CartItem.objects.upsert(cart_id, grouped[CartItemOperationSerializer.OPERATION_ADD],
+                                        increment=True)
+        except DjangoValidationError:
+            raise NotFound('Корзина не найдена')
+        except IntegrityError:
+            # Товар удалили, пока применялась пачка
+            raise serializers.ValidationError({'operations': ['Товар был удален, повторите запрос']})
+        return cart_id
+
+
 class CustomerSerializer(serializers.ModelSerializer):
     user_id = serializers.IntegerField()
 
@@ -211,19 +460,76 @@ class OrderItemSerializer(serializers.ModelSerializer):
         fields = ['id', 'product', 'unit_price', 'quantity']
 
 
-class OrderSerializer(serializers.ModelSerializer):
+class OrderSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     items = OrderItemSerializer(many=True)
+    expandable_fields = {'customer': CustomerSerializer}
 
     class Meta:
         model = Order
-        fields = ['id', 'customer', 'placed_at', 'payment_status', 'items']
+        fields = ['id', 'customer', 'placed_at', 'payment_status',
+                  'total_price', 'item_count', 'items']
+
+
+class ArchivedOrderItemSerializer(serializers.ModelSerializer):
+    product = SimpleProductSerializer()
+
+    class Meta:
+        model = ArchivedOrderItem
+        fields = ['id', 'product', 'unit_price', 'quantity']
+
+
+# Заказ из архива выглядит так же, как обычный
+class ArchivedOrderSerializer(OrderSerializer):
+    items = ArchivedOrderItemSerializer(many=True)
+
+    class Meta(OrderSerializer.Meta):
+        model = ArchivedOrder
+
+
+# История заказов без строк заказа (?summary=true)
+class OrderSummarySerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Order
+        fields = ['id', 'placed_at', 'payment_status', 'total_price', 'item_count']
+
+
+class ArchivedOrderSummarySerializer(OrderSummarySerializer):
+    class Meta(OrderSummarySerializer.Meta):
+        model = ArchivedOrder
 
 class UpdateOrderSerializer(serializers.ModelSerializer):
+    def update(self, instance, validated_data):
+        # Через set_payment_status, чтобы обновились сводки продаж
+        if 'payment_status' in validated_data:
+            instance.set_payment_status(validated_data['payment_status'])
+        return instance
+
     class Meta:
         model = Order
         fields = ['payment_status']
 
 
+class SalesReportQuerySerializer(serializers.Serializer):
+    GROUP_CHOICES = ['day', 'product', 'collection']
+
+    date_from = serializers.DateField()
+    date_to = serializers.DateField()
+    group = serializers.ChoiceField(choices=GROUP_CHOICES, default='day')
+    limit = serializers.IntegerField(min_value=1, max_value=1000, default=100)
+
+    def validate(self, attrs):
+        if attrs['date_from'] > attrs['date_to']:
+            raise serializers.ValidationError({'date_to': ['Раньше чем date_from']})
+        return attrs
+
+
+class InsufficientInventory(Exception):
+    # shortfall - строки заказа, которых не хватает на складе
+    def __init__(self, shortfall=None):
+        super().__init__('Недостаточно товара на складе')
+        self.shortfall = shortfall or []
+
+
 class CreateOrderSerializer(serializers.Serializer):
     cart_id = serializers.UUIDField()
 
@@ -235,24 +541,70 @@ class CreateOrderSerializer(serializers.Serializer):
         return cart_id
 
     def save(self, **kwargs):
-        with transaction.atomic():
-            cart_id = self.validated_data['cart_id']
-            customer = Customer.objects.get(user_id=self.context['user_id'])
-            order = Order.objects.create(customer=customer)
-
-            cart_items = CartItem.objects.select_related('product').filter(
-                cart_id=cart_id
-            )
-
-            order_items = [OrderItem(
-                order=order,
-                product=item.product,
-                unit_price=item.product.unit_price,
-                quantity=item.quantity
-            ) for item in cart_items]
-            # Надо сразу закинуть список объектов в базу данных
-            OrderItem.objects.bulk_create(order_items)
-            Cart.objects.filter(pk=cart_id).delete()
-
-            return order
+        cart_id = self.validated_data['cart_id']
+        customer_id = self.context.get('customer_id')
+        if customer_id is None:
+            customer_id = customers.get_customer_id_for_user(self.context['user_id'])
+        try:
+            with transaction.atomic():
+                # Блокируем корзину: одну корзину нельзя оформить дважды.
+                # Пустой UPDATE вместо SELECT FOR UPDATE, потому что транзакция
+                # должна начинаться с записи - иначе SQLite не сможет поднять
+                # блокировку чтения до записи и вернет "database is locked"
+                if not Cart.objects.filter(pk=cart_id).update(created_at=F('created_at')):
+                    raise serializers.ValidationError({'cart_id': ['Не существующий ID корзины']})
+                cart_items = list(CartItem.objects.select_related('product').filter(
+                    cart_id=cart_id
+                ).order_by('product_id'))
+                if not cart_items:
+                    # Корзину опустошили после проверки
+                    raise serializers.ValidationError({'cart_id': ['Корзина пустая']})
+                order = Order.objects.create(
+                    customer_id=customer_id,
+                    total_price=sum(item.quantity * item.product.unit_price
+                                    for item in cart_items),
+                    item_count=sum(item.quantity for item in cart_items),
+                )
+
+                # Если какого-то товара не хватает - откатываем заказ целиком
+                taken = Product.objects.take_inventory(
+                    {item.product_id: item.quantity for item in cart_items})
+                if taken != len(cart_items):
+                    raise InsufficientInventory
+
+                order_items = [OrderItem(
+                    order=order,
+                    product=item.product,
+                    unit_price=item.product.unit_price,
+                    quantity=item.quantity
+                ) for item in cart_items]
+                # Надо сразу закинуть список объектов в базу данных
+                OrderItem.objects.bulk_create(order_items)
+                # Корзину удаляем здесь же - иначе ее можно оформить второй раз
+                Cart.objects.filter(pk=cart_id).delete()
+
+                # Остальное делает фоновый воркер уже после ответа. Задачи
+                # пишутся в этой же транзакции, а не в on_commit: строка Task
+                # коммитится вместе с заказом, и письмо не потеряется, если
+                # процесс упадет сразу после коммита. Воркер увидит задачу
+                # только после коммита, при откате она исчезнет
+                queue.enqueue(tasks.send_order_confirmation, order_id=order.id)
+                queue.enqueue(tasks.check_low_stock,
+                              product_ids=[item.product_id for item in cart_items])
+        except InsufficientInventory:
+            # Транзакция откатилась, ни один остаток не изменился
+            raise InsufficientInventory(self.get_shortfall(cart_id))
+
+        return order
+
+    def get_shortfall(self, cart_id):
+        items = (CartItem.objects.filter(cart_id=cart_id).select_related('product')
+                 .only('quantity', 'product__id', 'product__title', 'product__inventory')
+                 .order_by('product_id'))
+        return [{
+            'product_id': item.product.id,
+            'title': item.product.title,
+            'requested': item.quantity,
+            'available': item.product.inventory,
+        } for item in items if item.quantity > item.product.inventory]
 
@@ -0,0 +1,184 @@
+from django.conf import settings
+from django.db.models.signals import (post_init, pre_save, post_save, pre_delete, post_delete,
+                                      m2m_changed)
+from django.dispatch import receiver
+from django.utils import timezone
+from collections import Counter
+from .models import (Product, Collection, ProductImage, Promotion, CartItem, Customer, Review,
+                     change_blob_refs, change_products_count, change_review_stats,
+                     get_blob_names)
+from . import search
+from . import cache
+from . import customers
+from . import authentication
+from . import queue, tasks
+
+
+# Держим полнотекстовый индекс в актуальном состоянии
+@receiver(post_save, sender=Product)
+def index_product(sender, instance, using, **kwargs):
+    search.index_products([(instance.id, instance.title, instance.description)],
+                          using=using)
+
+
+@receiver(post_delete, sender=Product)
+def remove_product_from_index(sender, instance, using, **kwargs):
+    search.remove_products([instance.id], using=using)
+
+
+# Кол-во товаров в категории
+@receiver(post_save, sender=Product)
+def count_saved_product(sender, instance, created, using, raw=False, **kwargs):
+    if raw:
+        return
+    counts = Counter()
+    if created:
+        counts[instance.collection_id] += 1
+    elif (instance._loaded_collection_id is not None
+          and instance._loaded_collection_id != instance.__dict__.get('collection_id')):
+        # Товар перенесли в другую категорию
+        counts[instance._loaded_collection_id] -= 1
+        counts[instance.collection_id] += 1
+    change_products_count(counts, using)
+    instance._loaded_collection_id = instance.__dict__.get('collection_id')
+
+
+@receiver(post_delete, sender=Product)
+def count_deleted_product(sender, instance, using, **kwargs):
+    change_products_count({instance.collection_id: -1}, using)
+
+
+# Кол-во отзывов и дата последнего отзыва товара
+@receiver(post_save, sender=Review)
+def count_saved_review(sender, instance, created, using, raw=False, **kwargs):
+    if created and not raw:
+        change_review_stats(instance.product_id, 1, using)
+
+
+@receiver(post_delete, sender=Review)
+def count_deleted_review(sender, instance, using, **kwargs):
+    change_review_stats(instance.product_id, -1, using)
+
+
+# Обновляем last_update товара, когда меняется то, что входит в его ответ
+@receiver(post_save, sender=ProductImage)
+@receiver(post_delete, sender=ProductImage)
+def touch_product_on_image_change(sender, instance, using, **kwargs):
+    Product.objects.using(using).filter(pk=instance.product_id).update(
+        last_update=timezone.now())
+
+
+@receiver(post_save, sender=Collection)
+def touch_products_on_collection_change(sender, instance, created, using, raw=False, **kwargs):
+    if not created and not raw:
+        Product.objects.using(using).filter(collection_id=instance.pk).update(
+            last_update=timezone.now())
+
+
+@receiver(m2m_changed, sender=Product.promotion.through)
+def touch_products_on_promotion_change(sender, instance, action, reverse, pk_set, using, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        Product.objects.using(using).filter(pk=instance.pk).update(last_update=timezone.now())
+    elif pk_set:
+        Product.objects.using(using).filter(pk__in=pk_set).update(last_update=timezone.now())
+
+
+# Уменьшенные копии картинки строит фоновая задача (manage.py run_tasks)
+@receiver(post_save, sender=ProductImage)
+def enqueue_image_variants(sender, instance, created, using, raw=False, **kwargs):
+    if raw:
+        return
+    name = instance.image.name or ''
+    if not created and name != instance._loaded_image:
+        # Картинку заменили - старые варианты больше не нужны
+        ProductImage.objects.using(using).filter(pk=instance.pk).update(variants={})
+        instance.variants = {}
+    if name and (created or name != instance._loaded_image):
+        queue.enqueue(tasks.generate_image_variants, using=using, image_id=instance.pk)
+    instance._loaded_image = name
+
+
+# Ссылки на файлы хранилища картинок. Прежние файлы берем из базы,
+# а не из экземпляра: варианты мог дописать воркер уже после его загрузки
+@receiver(pre_save, sender=ProductImage)
+@receiver(pre_delete, sender=ProductImage)
+def load_stored_image_blobs(sender, instance, using, raw=False, **kwargs):
+    row = None
+    if instance.pk is not None and not raw:
+        row = (ProductImage.objects.using(using).filter(pk=instance.pk)
+               .values_list('image', 'variants').first())
+    instance._stored_blobs = get_blob_names(*row) if row else set()
+
+
+# Регистрируется после enqueue_image_variants: тот сбрасывает варианты замененной картинки
+@receiver(post_save, sender=ProductImage)
+def count_image_blob_refs(sender, instance, using, raw=False, **kwargs):
+    if raw:
+        return
+    names = get_blob_names(instance.image, instance.variants)
+    counts = Counter({name: 1 for name in names - instance._stored_blobs})
+    counts.subtract({name: 1 for name in instance._stored_blobs - names})
+    change_blob_refs(counts, using)
+
+
+@receiver(post_delete, sender=ProductImage)
+def release_image_blobs(sender, instance, using, **kwargs):
+    change_blob_refs({name: -1 for name in instance._stored_blobs}, using)
+
+
+# Сбрасываем кэш ответов каталога
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+@receiver(post_save, sender=Collection)
+@receiver(post_delete, sender=Collection)
+@receiver(post_save, sender=ProductImage)
+@receiver(post_delete, sender=ProductImage)
+@receiver(post_save, sender=Promotion)
+@receiver(post_delete, sender=Promotion)
+def invalidate_catalog_cache(sender, using, **kwargs):
+    cache.invalidate(sender, using=using)
+
+
+@receiver(m2m_changed, sender=Product.promotion.through)
+def invalidate_product_promotions(sender, action, using, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        cache.invalidate(Product, using=using)
+
+
+# Сумма корзины меняется при любой записи в ее товары
+@receiver(post_save, sender=CartItem)
+@receiver(post_delete, sender=CartItem)
+def invalidate_cart_total(sender, instance, using, **kwargs):
+    cache.invalidate_cart(instance.cart_id, using=using)
+
+
+# Связка пользователь -> покупатель в кэше
+@receiver(post_save, sender=Customer)
+@receiver(post_delete, sender=Customer)
+def invalidate_customer(sender, instance, using, **kwargs):
+    user_ids = {instance._loaded_user_id, instance.user_id} - {None}
+    customers.invalidate(user_ids, using=using)
+    # customer_id зашит в токены - сверяем его заново (store.authentication)
+    authentication.forget(user_ids, using=using)
+    instance._loaded_user_id = instance.user_id
+
+
+# Права и пароль пользователя зашиты в его токены - при их изменении отзываем токены
+@receiver(post_init, sender=settings.AUTH_USER_MODEL)
+def remember_user_auth_state(sender, instance, **kwargs):
+    instance._loaded_auth_state = authentication.get_auth_state(instance)
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def revoke_tokens_on_user_change(sender, instance, created, using, raw=False, **kwargs):
+    state = authentication.get_auth_state(instance)
+    if not created and not raw and state != instance._loaded_auth_state:
+        authentication.revoke([instance.pk], using=using)
+    instance._loaded_auth_state = state
+
+
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+def revoke_tokens_on_user_delete(sender, instance, using, **kwargs):
+    authentication.revoke([instance.pk], using=using)
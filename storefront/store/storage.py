@@ -0,0 +1,105 @@
+import hashlib
+import os
+import tempfile
+
+from django.core.files.storage import FileSystemStorage
+
+# Хранилище по содержимому для картинок товаров. Имя файла - sha256
+# его содержимого, поэтому одинаковые загрузки лежат на диске один раз:
+# store/images/ab/abcdef....png. Ссылки на файлы считает ImageBlob,
+# файлы без ссылок удаляет manage.py delete_orphaned_blobs.
+
+HEX_DIGITS = '0123456789abcdef'
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    def __init__(self, prefix='store/images', **kwargs):
+        super().__init__(**kwargs)
+        self.prefix = prefix
+
+    def get_blob_name(self, digest, extension):
+        return f'{self.prefix}/{digest[:2]}/{digest}{extension.lower()}'
+
+    def get_temp_dir(self):
+        return self.path(f'{self.prefix}/tmp')
+
+    def get_available_name(self, name, max_length=None):
+        # Имя все равно определит содержимое - подбирать свободное не нужно
+        return name
+
+    def _save(self, name, content):
+        # Пишем во временный файл и считаем хэш в том же проходе по кускам,
+        # не держа загрузку в памяти целиком
+        temp_dir = self.get_temp_dir()
+        os.makedirs(temp_dir, mode=self.directory_permissions_mode or 0o777, exist_ok=True)
+        digest = hashlib.sha256()
+        descriptor, temp_path = tempfile.mkstemp(dir=temp_dir)
+        try:
+            with os.fdopen(descriptor, 'wb') as temp:
+                for chunk in content.chunks():
+                    digest.update(chunk)
+                    temp.write(chunk)
+            name = self.get_blob_name(digest.hexdigest(), os.path.splitext(name)[1])
+            path = self.path(name)
+            try:
+                # Такой файл уже есть - только отмечаем, что он снова нужен.
+                # По этой отметке сборщик мусора не удалит его из-под загрузки
+                os.utime(path)
+            except FileNotFoundError:
+                os.makedirs(os.path.dirname(path),
+                            mode=self.directory_permissions_mode or 0o777, exist_ok=True)
+                if self.file_permissions_mode is not None:
+                    os.chmod(temp_path, self.file_permissions_mode)
+                # Параллельная загрузка того же файла заменит его тем же содержимым
+                os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        return name
+
+    def iter_blobs(self):
+        # (имя, время последнего использования) файлов хранилища. Смотрим
+        # только каталоги ab/ из хэша: старые файлы, загруженные до этого
+        # хранилища, сюда не попадают
+        root = self.path(self.prefix)
+        if not os.path.isdir(root):
+            return
+        for bucket in sorted(os.listdir(root)):
+            directory = os.path.join(root, bucket)
+            if not (len(bucket) == 2 and all(char in HEX_DIGITS for char in bucket)
+                    and os.path.isdir(directory)):
+                continue
+            for filename in os.listdir(directory):
+                path = os.path.join(directory, filename)
+                yield f'{self.prefix}/{bucket}/{filename}', os.stat(path).st_mtime
+
+    def delete_unused(self, name, cutoff):
+        # Удаляет файл, если его не использовали после cutoff (unix time).
+        # Файл сначала переименовываем: загрузка, которая успела отметить
+        # его до этого, оставит свежее время - тогда возвращаем файл на место.
+        # Загрузка после переименования файла не найдет и запишет его заново
+        path = self.path(name)
+        trash = f'{path}.{os.getpid()}.deleted'
+        try:
+            os.rename(path, trash)
+        except FileNotFoundError:
+            return False
+        if os.stat(trash).st_mtime >= cutoff:
+            os.replace(trash, path)
+            return False
+        os.remove(trash)
+        return True
+
+    def delete_stale_temp_files(self, cutoff):
+        # Временные файлы загрузок, упавших посреди записи
+        deleted = 0
+        temp_dir = self.get_temp_dir()
+        if not os.path.isdir(temp_dir):
+            return deleted
+        for filename in os.listdir(temp_dir):
+            path = os.path.join(temp_dir, filename)
+            if os.stat(path).st_mtime < cutoff:
+                os.remove(path)
+                deleted += 1
+        return deleted
+
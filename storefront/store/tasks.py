@@ -0,0 +1,50 @@
+from django.conf import settings
+from django.core.mail import mail_admins, send_mail
+from .models import Order, Product
+from .queue import task
+from . import cache, images
+
+# Фоновые задачи после оформления заказа (ставит CreateOrderSerializer.save)
+# и после загрузки картинок (ставит сигнал). Выполняются manage.py run_tasks
+
+
+@task()
+def send_order_confirmation(order_id):
+    order = (Order.objects.select_related('customer__user')
+             .only('id', 'total_price', 'item_count', 'customer__user__email',
+                   'customer__user__first_name').get(pk=order_id))
+    email = order.customer.user.email
+    if not email:
+        return
+    send_mail(
+        subject=f'Заказ №{order.id} оформлен',
+        message=(f'{order.customer.user.first_name}, спасибо за заказ!\n'
+                 f'Товаров: {order.item_count}, сумма: {order.total_price}'),
+        from_email=None,
+        recipient_list=[email],
+    )
+
+
+@task()
+def check_low_stock(product_ids):
+    # Сообщаем администраторам о товарах, которые заканчиваются после заказа
+    threshold = getattr(settings, 'STORE_LOW_STOCK_THRESHOLD', 10)
+    products = list(Product.objects.filter(pk__in=product_ids, inventory__lt=threshold)
+                    .order_by('inventory').values_list('id', 'title', 'inventory'))
+    if not products:
+        return
+    if products[0][2] <= 0:
+        # Заказ не сбрасывает кэш каталога (take_inventory). Распроданный
+        # товар не должен висеть в кэше как доступный - сбрасываем сейчас
+        cache.invalidate(Product)
+    mail_admins(
+        subject=f'Заканчиваются товары: {len(products)}',
+        message='\n'.join(f'#{pk} {title}: осталось {inventory}'
+                          for pk, title, inventory in products),
+    )
+
+
+@task()
+def generate_image_variants(image_id):
+    # Ставится сигналом после загрузки или замены картинки товара
+    images.generate_variants(image_id)
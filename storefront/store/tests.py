@@ -1,3 +1,933 @@
-from django.test import TestCase
+import io
+import json
+import threading
+from datetime import timedelta
+from urllib.parse import parse_qs, urlsplit
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import DatabaseError, connection
+from django.db.models import Count, Sum
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+from rest_framework.test import APIClient
+from .archive import archive_batch
+from .authentication import ClaimsTokenObtainPairSerializer, user_state_key
+from .models import (ArchivedOrder, Cart, CartItem, Collection, Customer, IdempotencyKey, Order,
+                     OrderItem, Product, ProductImage, ProductSales, Promotion, Review)
+from .serializers import CreateOrderSerializer, InsufficientInventory
+from . import bulk, cache as store_cache, customers, search, tasks
+
+
+def run_in_threads(target, count):
+    # Запускает target в count потоках одновременно, возвращает
+    # (результаты, ошибки). Каждый поток работает в своем соединении
+    barrier = threading.Barrier(count)
+    results, errors = [], []
+
+    def worker():
+        try:
+            barrier.wait()
+            results.append(target())
+        except Exception as error:
+            errors.append(error)
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=worker) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, errors
+
+
+class ConcurrentAddToCartTests(TransactionTestCase):
+    def test_concurrent_adds_are_summed_in_one_row(self):
+        collection = Collection.objects.create(title='a')
+        product = Product.objects.create(title='a', slug='a', unit_price=1,
+                                         inventory=1, collection=collection)
+        cart = Cart.objects.create()
+        threads, adds = 8, 10
+
+        def add():
+            for _ in range(adds):
+                CartItem.objects.add(cart.id, product.id, 2)
+
+        _, errors = run_in_threads(add, threads)
+
+        self.assertEqual(errors, [])
+        item = CartItem.objects.get(cart=cart)
+        self.assertEqual(item.product_id, product.id)
+        self.assertEqual(item.quantity, threads * adds * 2)
+
+    def test_concurrent_batches_are_applied_in_turn(self):
+        collection = Collection.objects.create(title='a')
+        product = Product.objects.create(title='a', slug='a', unit_price=1,
+                                         inventory=1, collection=collection)
+        cart = Cart.objects.create()
+        threads = 8
+
+        def batch():
+            return APIClient().post(f'/carts/{cart.id}/items/batch/', {'operations': [
+                {'op': 'add', 'product_id': product.id, 'quantity': 1},
+                {'op': 'add', 'product_id': product.id, 'quantity': 1},
+            ]}, format='json').status_code
+
+        results, errors = run_in_threads(batch, threads)
+
+        self.assertEqual(errors, [])
+        self.assertEqual(results, [200] * threads)
+        self.assertEqual(CartItem.objects.get(cart=cart).quantity, threads * 2)
+
+
+class ConcurrentCheckoutTests(TransactionTestCase):
+    def setUp(self):
+        self.collection = Collection.objects.create(title='a')
+
+    def create_product(self, inventory):
+        return Product.objects.create(title='a', slug='a', unit_price=1,
+                                      inventory=inventory, collection=self.collection)
+
+    def create_customer(self):
+        user = get_user_model().objects.create(username=f'user-{Customer.objects.count()}')
+        return Customer.objects.create(user=user)
+
+    def create_cart(self, quantities):
+        cart = Cart.objects.create()
+        for product, quantity in quantities.items():
+            CartItem.objects.create(cart=cart, product=product, quantity=quantity)
+        return cart
+
+    def checkout(self, cart, customer):
+        serializer = CreateOrderSerializer(data={'cart_id': cart.id},
+                                           context={'customer_id': customer.id})
+        serializer.is_valid(raise_exception=True)
+        return serializer.save()
+
+    def test_last_unit_is_sold_once(self):
+        product = self.create_product(inventory=1)
+        threads = 8
+        remaining = [(self.create_cart({product: 1}), self.create_customer())
+                     for _ in range(threads)]
+        lock = threading.Lock()
+
+        def checkout():
+            with lock:
+                cart, customer = remaining.pop()
+            try:
+                return self.checkout(cart, customer).id
+            except InsufficientInventory:
+                return None
+
+        results, errors = run_in_threads(checkout, threads)
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len([order_id for order_id in results if order_id]), 1)
+        self.assertEqual(Order.objects.count(), 1)
+        product.refresh_from_db()
+        self.assertEqual(product.inventory, 0)
+
+    def test_shortfall_on_one_line_changes_no_inventory(self):
+        enough, short = self.create_product(inventory=5), self.create_product(inventory=1)
+        cart = self.create_cart({enough: 2, short: 2})
+
+        with self.assertRaises(InsufficientInventory) as raised:
+            self.checkout(cart, self.create_customer())
+
+        self.assertEqual([item['product_id'] for item in raised.exception.shortfall], [short.id])
+        enough.refresh_from_db()
+        short.refresh_from_db()
+        self.assertEqual((enough.inventory, short.inventory), (5, 1))
+        self.assertFalse(Order.objects.exists())
+
+
+class CheckoutTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        collection = Collection.objects.create(title='a')
+        self.product = Product.objects.create(title='a', slug='a', unit_price=1, inventory=2,
+                                              collection=collection)
+        user = get_user_model().objects.create(username='user')
+        self.customer = Customer.objects.create(user=user)
+        self.cart = Cart.objects.create()
+        CartItem.objects.create(cart=self.cart, product=self.product, quantity=1)
+        self.serializer = CreateOrderSerializer(data={'cart_id': self.cart.id},
+                                                context={'customer_id': self.customer.id})
+        self.serializer.is_valid(raise_exception=True)
+
+    def test_order_keeps_catalog_cache(self):
+        generations = store_cache.get_generations([Product])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.serializer.save()
+        self.assertEqual(store_cache.get_generations([Product]), generations)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.inventory, 1)
+
+    def test_sold_out_product_resets_catalog_cache(self):
+        Product.objects.filter(pk=self.product.pk).update(inventory=1)
+        generations = store_cache.get_generations([Product])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.serializer.save()
+        with self.captureOnCommitCallbacks(execute=True):
+            tasks.check_low_stock([self.product.id])
+        self.assertNotEqual(store_cache.get_generations([Product]), generations)
+
+    def test_cart_emptied_after_validation_changes_nothing(self):
+        CartItem.objects.filter(cart=self.cart).delete()
+        with self.assertRaises(ValidationError):
+            self.serializer.save()
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.inventory, 2)
+        self.assertFalse(Order.objects.exists())
+
+
+class ProductSearchTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.collection = Collection.objects.create(title='a')
+        other = Collection.objects.create(title='b')
+        self.in_title = self.create('Пылесос Samsung', unit_price=5)
+        self.in_description = self.create('Чайник', 'не пылесос', unit_price=5)
+        self.expensive = self.create('Пылесос Bosch', unit_price=50)
+        self.elsewhere = self.create('Пылесос LG', unit_price=5, collection=other)
+
+    def create(self, title, description='', unit_price=1, collection=None):
+        return Product.objects.create(title=title, description=description, slug='a',
+                                      unit_price=unit_price, inventory=1,
+                                      collection=collection or self.collection)
+
+    def search(self, query):
+        response = APIClient().get('/products/', {'search': 'пылес', **query})
+        self.assertEqual(response.status_code, 200)
+        return [product['id'] for product in response.data['results']]
+
+    def test_search_is_combined_with_filters(self):
+        ids = self.search({'collection_id': self.collection.id, 'unit_price__lt': 10})
+        self.assertEqual(sorted(ids), sorted([self.in_title.id, self.in_description.id]))
+
+    def test_title_match_ranks_first(self):
+        ids = self.search({'collection_id': self.collection.id, 'unit_price__lt': 10})
+        self.assertEqual(ids, [self.in_title.id, self.in_description.id])
+
+    def indexed_ids(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT rowid FROM {search.SQLITE_TABLE} ORDER BY rowid')
+            return [row[0] for row in cursor.fetchall()]
+
+    def test_rebuild_updates_index_in_place(self):
+        # Строка индекса без товара и товар, переименованный мимо сигналов
+        stale_id = self.elsewhere.id + 100
+        search.index_products([(stale_id, 'Пылесос', '')])
+        Product.objects.filter(pk=self.expensive.pk).update(title='Утюг')
+        self.assertIn(stale_id, self.indexed_ids())
+        self.assertIn(self.expensive.id, self.search({}))
+
+        with self.captureOnCommitCallbacks(execute=True), \
+                CaptureQueriesContext(connection) as queries:
+            call_command('rebuild_search_index', batch_size=1, stdout=io.StringIO())
+
+        # Индекс ни разу не очищался целиком - поиск работал всю перестройку
+        self.assertFalse([query for query in queries.captured_queries
+                          if query['sql'].strip() == f'DELETE FROM {search.SQLITE_TABLE}'])
+        self.assertEqual(self.indexed_ids(),
+                         list(Product.objects.order_by('id').values_list('id', flat=True)))
+        self.assertEqual(sorted(self.search({})), sorted([
+            self.in_title.id, self.in_description.id, self.elsewhere.id]))
+
+
+class ProductImportExportTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.collection = Collection.objects.create(title='a')
+        self.promotion = Promotion.objects.create(description='a', discount=5)
+        self.product = Product.objects.create(title='old', slug='a', unit_price=5, inventory=5,
+                                              collection=self.collection)
+        self.client = APIClient()
+        self.client.force_authenticate(get_user_model().objects.create(username='admin',
+                                                                       is_staff=True))
+
+    def record(self, slug, **fields):
+        return {'slug': slug, 'title': slug.upper(), 'unit_price': '2.50', 'inventory': 3,
+                'collection': self.collection.id, **fields}
+
+    def post(self, body, content_type='application/x-ndjson'):
+        response = self.client.post('/products/import/?batch_size=2', data=body,
+                                    content_type=content_type)
+        self.assertEqual(response.status_code, 200, response.data)
+        return response.data
+
+    def export(self, query=''):
+        response = self.client.get(f'/products/export/{query}')
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content).decode()
+
+    def test_ndjson_import_reports_bad_lines(self):
+        body = b'\n'.join([
+            json.dumps(self.record('a', promotion=[self.promotion.id])).encode(),
+            b'{bad',
+            json.dumps(self.record('b', collection=999)).encode(),
+            '{"slug": "\u0441"}'.encode('cp1251'),
+            json.dumps(self.record('c')).encode(),
+        ])
+        result = self.post(body)
+        self.assertEqual((result['created'], result['updated']), (1, 1))
+        errors = {error['line']: error['errors'] for error in result['errors']}
+        self.assertEqual(sorted(errors), [2, 3, 4])
+        self.assertIn('collection', errors[3])
+        self.assertEqual(errors[4], bulk.ENCODING_ERROR)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.title, 'A')
+        self.assertEqual(list(self.product.promotion.values_list('id', flat=True)),
+                         [self.promotion.id])
+
+    def test_csv_import_accepts_bom_and_reports_bad_bytes(self):
+        body = '\n'.join([
+            'slug,title,unit_price,inventory,collection',
+            f'a,Новое,3,1,{self.collection.id}',
+            f'b,Плохое,3,1,{self.collection.id}',
+            f'c,C,3,1,{self.collection.id}',
+        ])
+        body = body.encode('utf-8-sig').replace('Плохое'.encode(), 'Плохое'.encode('cp1251'))
+        result = self.post(body, 'text/csv')
+        self.assertEqual((result['created'], result['updated']), (1, 1))
+        self.assertEqual(result['errors'], [{'line': 3, 'errors': bulk.ENCODING_ERROR}])
+        self.assertEqual(sorted(Product.objects.values_list('slug', 'title')),
+                         [('a', 'Новое'), ('c', 'C')])
+
+    def test_rolled_back_batch_reports_each_line_once(self):
+        # Два товара с одним slug - ошибка строки 1 появляется при записи
+        Product.objects.create(title='copy', slug='a', unit_price=5, inventory=5,
+                               collection=self.collection)
+
+        class FailingImporter(bulk.ProductImporter):
+            def write_promotions(self, products, promotions):
+                raise DatabaseError('failed')
+
+        result = FailingImporter(batch_size=10).run([
+            (1, self.record('a')), (2, self.record('b', promotion=[self.promotion.id])),
+        ])
+        self.assertEqual(result['errors'], [{'lines': [1, 2], 'errors': 'failed'}])
+        self.assertFalse(Product.objects.filter(slug='b').exists())
+
+    def test_export_round_trip(self):
+        self.product.promotion.add(self.promotion)
+        other = Collection.objects.create(title='b')
+        Product.objects.create(title='Чайник', slug='b', unit_price=1, inventory=2,
+                               collection=other)
+
+        rows = [json.loads(line) for line in self.export().splitlines()]
+        self.assertEqual([row['slug'] for row in rows], ['a', 'b'])
+        self.assertEqual(rows[0]['promotion'], [self.promotion.id])
+        rows = self.export(f'?collection_id={other.id}').splitlines()
+        self.assertEqual([json.loads(line)['title'] for line in rows], ['Чайник'])
+
+        body = self.export('?output=csv&chunk_size=1')
+        result = self.post(body.encode(), 'text/csv')
+        self.assertEqual(result, {'created': 0, 'updated': 2, 'errors': []})
+        self.assertEqual(list(self.product.promotion.values_list('id', flat=True)),
+                         [self.promotion.id])
+
+    def test_import_and_export_need_admin(self):
+        client = APIClient()
+        client.force_authenticate(get_user_model().objects.create(username='user'))
+        self.assertEqual(client.get('/products/export/').status_code, 403)
+        self.assertEqual(client.post('/products/import/', data=b'',
+                                     content_type='application/x-ndjson').status_code, 403)
+
+
+class CartItemBatchTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        collection = Collection.objects.create(title='a')
+        self.products = [Product.objects.create(title=str(i), slug=str(i), unit_price=1,
+                                                inventory=10, collection=collection)
+                         for i in range(3)]
+        self.cart = Cart.objects.create()
+        self.client = APIClient()
+
+    def batch(self, *operations):
+        return self.client.post(f'/carts/{self.cart.id}/items/batch/',
+                                {'operations': list(operations)}, format='json')
+
+    def quantities(self):
+        return dict(CartItem.objects.filter(cart=self.cart).values_list('product_id', 'quantity'))
+
+    def test_add_then_add_sums_quantities(self):
+        a = self.products[0]
+        CartItem.objects.create(cart=self.cart, product=a, quantity=1)
+        response = self.batch({'op': 'add', 'product_id': a.id, 'quantity': 2},
+                              {'op': 'add', 'product_id': a.id, 'quantity': 3})
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual(self.quantities(), {a.id: 6})
+
+    def test_remove_then_add_sets_quantity(self):
+        a, b = self.products[:2]
+        CartItem.objects.create(cart=self.cart, product=a, quantity=5)
+        response = self.batch({'op': 'remove', 'product_id': a.id},
+                              {'op': 'add', 'product_id': a.id, 'quantity': 2},
+                              {'op': 'remove', 'product_id': b.id},
+                              {'op': 'add', 'product_id': b.id, 'quantity': 1})
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual(self.quantities(), {a.id: 2, b.id: 1})
+
+    def test_set_then_remove_removes(self):
+        a, b = self.products[:2]
+        CartItem.objects.create(cart=self.cart, product=a, quantity=5)
+        response = self.batch({'op': 'set', 'product_id': a.id, 'quantity': 2},
+                              {'op': 'remove', 'product_id': a.id},
+                              {'op': 'set', 'product_id': b.id, 'quantity': 4},
+                              {'op': 'add', 'product_id': b.id, 'quantity': 1})
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual(self.quantities(), {b.id: 5})
+
+    def test_batch_resets_cached_total(self):
+        a = self.products[0]
+        self.assertEqual(self.client.get(f'/carts/{self.cart.id}/').data['total_price'], 0)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.batch({'op': 'add', 'product_id': a.id, 'quantity': 2})
+        self.assertEqual(self.client.get(f'/carts/{self.cart.id}/').data['total_price'], 2)
+        # id корзины в URL в другом регистре - та же корзина и тот же ключ кэша
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(f'/carts/{str(self.cart.id).upper()}/items/batch/', {'operations': [
+                {'op': 'add', 'product_id': a.id, 'quantity': 1}]}, format='json')
+        self.assertEqual(self.client.get(f'/carts/{self.cart.id}/').data['total_price'], 3)
+
+    def test_errors_are_reported_by_index(self):
+        a = self.products[0]
+        CartItem.objects.create(cart=self.cart, product=a, quantity=1)
+        response = self.batch({'op': 'add', 'product_id': a.id, 'quantity': 1},
+                              {'op': 'set', 'product_id': a.id},
+                              {'op': 'add', 'product_id': 999, 'quantity': 1})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(set(response.data['operations']), {1})
+        self.assertIn('quantity', response.data['operations'][1])
+
+        response = self.batch({'op': 'add', 'product_id': a.id, 'quantity': 1},
+                              {'op': 'add', 'product_id': 999, 'quantity': 1})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(set(response.data['operations']), {1})
+        self.assertIn('product_id', response.data['operations'][1])
+        # Пачка с ошибкой не применяется целиком
+        self.assertEqual(self.quantities(), {a.id: 1})
+
+    def test_missing_cart_is_404(self):
+        operation = {'op': 'remove', 'product_id': self.products[0].id}
+        for cart_id in ('00000000-0000-0000-0000-000000000000', 'abc'):
+            response = self.client.post(f'/carts/{cart_id}/items/batch/',
+                                        {'operations': [operation]}, format='json')
+            self.assertEqual(response.status_code, 404)
+
+
+class OrderHistoryQueriesTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        user = get_user_model().objects.create(username='user')
+        self.customer = Customer.objects.create(user=user)
+        # id покупателя берется из кэша - считаем только запросы истории
+        customers.get_customer_id_for_user(user.id)
+        collection = Collection.objects.create(title='a')
+        self.products = [Product.objects.create(title=str(number), slug='a', unit_price=1,
+                                                inventory=10, collection=collection)
+                         for number in range(3)]
+        self.client = APIClient()
+        self.client.force_authenticate(user)
+
+    def create_orders(self, count, items):
+        for _ in range(count):
+            order = Order.objects.create(customer=self.customer)
+            OrderItem.objects.bulk_create([
+                OrderItem(order=order, product=product, unit_price=1, quantity=1)
+                for product in self.products[:items]
+            ])
+
+    def assert_queries_constant(self, url, expected):
+        # Один заказ и много заказов со многими строками - одно и то же число запросов
+        self.create_orders(1, items=1)
+        with self.assertNumQueries(expected):
+            response = self.client.get(url)
+        self.assertEqual(len(response.data['results']), 1)
+
+        self.create_orders(9, items=3)
+        with self.assertNumQueries(expected):
+            response = self.client.get(url)
+        self.assertEqual(len(response.data['results']), 10)
+
+    def test_full_history(self):
+        # Заказы, строки, товары и проверка архива на последней странице
+        self.assert_queries_constant('/orders/', 4)
+
+    def test_summary_history(self):
+        self.assert_queries_constant('/orders/?summary=true', 2)
+
+    def test_next_link_continues_into_archive(self):
+        self.create_orders(15, items=1)
+        Order.objects.filter(pk__lte=5).update(placed_at=timezone.now() - timedelta(days=400))
+        archive_batch(timezone.now() - timedelta(days=365), 0, 100)
+
+        seen = []
+        url = '/orders/?page_size=4'
+        while url:
+            response = self.client.get(url)
+            seen += [order['id'] for order in response.data['results']]
+            url = response.data['next']
+
+        # Сначала горячие заказы, потом архив, без повторов
+        self.assertEqual(len(seen), 15)
+        self.assertEqual(set(seen[:10]), set(Order.objects.values_list('id', flat=True)))
+        self.assertEqual(set(seen[10:]), set(ArchivedOrder.objects.values_list('id', flat=True)))
+
+
+class SalesRollupsTests(TestCase):
+    def test_rebuild_keeps_archived_sales(self):
+        user = get_user_model().objects.create(username='user')
+        customer = Customer.objects.create(user=user)
+        collection = Collection.objects.create(title='a')
+        product = Product.objects.create(title='a', slug='a', unit_price=2, inventory=10,
+                                         collection=collection)
+        for days in (400, 1):
+            order = Order.objects.create(customer=customer,
+                                         payment_status=Order.PAYMENT_STATUS_COMPLETE)
+            Order.objects.filter(pk=order.pk).update(
+                placed_at=timezone.now() - timedelta(days=days))
+            OrderItem.objects.create(order=order, product=product, unit_price=2, quantity=3)
+        call_command('rebuild_sales_rollups', stdout=io.StringIO())
+        archive_batch(timezone.now() - timedelta(days=365), 0, 100)
+
+        call_command('rebuild_sales_rollups', '--rebuild', stdout=io.StringIO())
+
+        totals = ProductSales.objects.aggregate(units=Sum('units'), revenue=Sum('revenue'))
+        self.assertEqual(totals, {'units': 6, 'revenue': 12})
+        self.assertTrue(ArchivedOrder.objects.get().sales_recorded)
+
+
+class ProductDestroyTests(TestCase):
+    def test_product_in_archived_order_is_not_deleted(self):
+        admin = get_user_model().objects.create(username='admin', is_staff=True)
+        customer = Customer.objects.create(user=admin)
+        collection = Collection.objects.create(title='a')
+        product = Product.objects.create(title='a', slug='a', unit_price=1, inventory=1,
+                                         collection=collection)
+        order = Order.objects.create(customer=customer)
+        OrderItem.objects.create(order=order, product=product, unit_price=1, quantity=1)
+        archive_batch(timezone.now() + timedelta(days=1), 0, 100)
+        client = APIClient()
+        client.force_authenticate(admin)
+
+        response = client.delete(f'/products/{product.id}/')
+
+        self.assertEqual(response.status_code, 405)
+        self.assertTrue(Product.objects.filter(pk=product.pk).exists())
+
+
+class IdempotencyKeyTests(TestCase):
+    def create_cart(self, key='key', address='10.0.0.1'):
+        return APIClient().post('/carts/', HTTP_IDEMPOTENCY_KEY=key, REMOTE_ADDR=address)
+
+    def test_anonymous_clients_do_not_share_keys(self):
+        first = self.create_cart(address='10.0.0.1')
+        second = self.create_cart(address='10.0.0.2')
+        retry = self.create_cart(address='10.0.0.1')
+
+        self.assertNotEqual(first.data['id'], second.data['id'])
+        self.assertEqual(retry.data['id'], first.data['id'])
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+
+    @override_settings(STORE_IDEMPOTENCY_WAIT=0)
+    def test_stale_claim_is_taken_over(self):
+        first = self.create_cart()
+        # Воркер первого запроса "упал" до ответа
+        IdempotencyKey.objects.update(status_code=None, response=None)
+
+        self.assertEqual(self.create_cart().status_code, 409)
+
+        IdempotencyKey.objects.update(claimed_at=timezone.now() - timedelta(minutes=5))
+        retry = self.create_cart()
+        self.assertEqual(retry.status_code, 201)
+        self.assertNotEqual(retry.data['id'], first.data['id'])
+        self.assertNotIn('Idempotent-Replayed', retry)
+        self.assertEqual(self.create_cart().data['id'], retry.data['id'])
+
+
+class ClaimsJWTAuthenticationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create_user(username='user', password='secret')
+        self.client = self.login(self.user)
+
+    def login(self, user):
+        token = ClaimsTokenObtainPairSerializer.get_token(user).access_token
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'JWT {token}')
+        return client
+
+    def expire_state(self):
+        # Кэш состояния пользователя истек (STORE_JWT_USER_STATE_TTL)
+        cache.delete(user_state_key(self.user.pk))
+
+    def test_token_needs_no_user_query(self):
+        self.assertEqual(self.client.get('/orders/?summary=true').status_code, 200)
+        # Только заказы и проверка архива - без auth_user и store_customer
+        with self.assertNumQueries(2):
+            self.assertEqual(self.client.get('/orders/?summary=true').status_code, 200)
+
+    # update() не вызывает сигналы - так изменение выглядит для процесса
+    # с кэшем в памяти, если его сделал другой процесс
+    def test_user_deactivated_elsewhere_is_rejected_after_ttl(self):
+        self.assertEqual(self.client.get('/orders/').status_code, 200)
+        get_user_model().objects.filter(pk=self.user.pk).update(is_active=False)
+        self.assertEqual(self.client.get('/orders/').status_code, 200)
+        self.expire_state()
+        self.assertEqual(self.client.get('/orders/').status_code, 401)
+
+    def test_password_changed_elsewhere_revokes_token_after_ttl(self):
+        self.assertEqual(self.client.get('/orders/').status_code, 200)
+        self.user.set_password('changed')
+        get_user_model().objects.filter(pk=self.user.pk).update(password=self.user.password)
+        self.expire_state()
+        self.assertEqual(self.client.get('/orders/').status_code, 401)
+
+    def test_deleted_customer_rejects_token(self):
+        self.assertEqual(self.client.get('/customers/me/').status_code, 200)
+        with self.captureOnCommitCallbacks(execute=True):
+            Customer.objects.filter(user=self.user).get().delete()
+        self.assertEqual(self.client.get('/customers/me/').status_code, 401)
+
+    def test_reassigned_customer_is_not_readable_with_old_token(self):
+        other = get_user_model().objects.create_user(username='other', password='secret')
+        with self.captureOnCommitCallbacks(execute=True):
+            Customer.objects.filter(user=self.user).update(user=other)
+        self.expire_state()
+        self.assertEqual(self.client.get('/orders/').status_code, 401)
+
+
+class KeysetPaginationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        collection = Collection.objects.create(title='a')
+        # Повторяющиеся названия и цены - порядок внутри них решает id
+        self.products = [Product.objects.create(title=f'p{number % 7}', slug='a',
+                                                unit_price=number % 5 + 1, inventory=1,
+                                                collection=collection)
+                         for number in range(25)]
+        self.client = APIClient()
+
+    def walk(self, url, link='next'):
+        pages = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            pages.append(response.data)
+            url = response.data[link]
+        return pages
+
+    def ids(self, pages):
+        return [product['id'] for page in pages for product in page['results']]
+
+    def test_next_links_walk_in_order(self):
+        for ordering, key in ((None, lambda p: (p.title, p.id)),
+                              ('-unit_price', lambda p: (-p.unit_price, -p.id))):
+            url = '/products/?page_size=4' + (f'&ordering={ordering}' if ordering else '')
+            pages = self.walk(url)
+            self.assertEqual(len(pages), 7)
+            self.assertEqual(self.ids(pages),
+                             [p.id for p in sorted(self.products, key=key)])
+
+    def test_previous_links_walk_back(self):
+        forward = self.walk('/products/?page_size=4')
+        backward = self.walk(forward[-1]['previous'], link='previous')
+        self.assertEqual([page['results'] for page in backward],
+                         [page['results'] for page in reversed(forward[:-1])])
+        self.assertIsNone(forward[0]['previous'])
+
+    def test_tampered_cursor_is_404(self):
+        url = self.client.get('/products/?page_size=4').data['next']
+        cursor = parse_qs(urlsplit(url).query)['cursor'][0]
+        self.assertEqual(self.client.get('/products/', {'cursor': cursor[:-3] + 'abc'})
+                         .status_code, 404)
+        # Курсор от другой сортировки тоже не подходит
+        self.assertEqual(self.client.get('/products/', {'cursor': cursor,
+                                                        'ordering': '-unit_price'})
+                         .status_code, 404)
+
+    def test_count(self):
+        self.assertNotIn('count', self.client.get('/products/').data)
+        data = self.client.get('/products/?count=exact').data
+        self.assertEqual((data['count'], data['count_is_exact']), (25, True))
+        data = self.client.get('/products/?count=approx').data
+        self.assertEqual((data['count'], data['count_is_exact']), (25, True))
+
+    def test_descending_pages_read_index_without_sort(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('план запроса SQLite')
+        for url in ('/products/?ordering=-unit_price', '/products/?ordering=-last_update'):
+            with CaptureQueriesContext(connection) as queries:
+                self.client.get(url)
+            sql = [query['sql'] for query in queries if 'ORDER BY' in query['sql']][-1]
+            with connection.cursor() as cursor:
+                cursor.execute(f'EXPLAIN QUERY PLAN {sql}')
+                plan = ' '.join(str(row[-1]) for row in cursor.fetchall())
+            self.assertNotIn('TEMP B-TREE', plan)
+
+
+class ConditionalGetTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        collection = Collection.objects.create(title='a')
+        self.product, self.other = [
+            Product.objects.create(title=title, slug='a', unit_price=1, inventory=5,
+                                   collection=collection)
+            for title in ('a', 'b')
+        ]
+        self.client = APIClient()
+        self.url = f'/products/{self.product.id}/'
+
+    def get(self, etag=None):
+        with self.captureOnCommitCallbacks(execute=True):
+            if etag is None:
+                return self.client.get(self.url)
+            return self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+
+    def test_detail_etag_follows_own_last_update(self):
+        etag = self.get()['ETag']
+        self.assertEqual(self.get(etag).status_code, 304)
+
+        # Правка другого товара не трогает этот
+        with self.captureOnCommitCallbacks(execute=True):
+            self.other.title = 'c'
+            self.other.save()
+        self.assertEqual(self.get(etag).status_code, 304)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.title = 'd'
+            self.product.save()
+        response = self.get(etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['title'], 'd')
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_inventory_change_refreshes_detail(self):
+        etag = self.get()['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.take_inventory({self.product.id: 2})
+        response = self.get(etag)
+        self.assertEqual((response.status_code, response.data['inventory']), (200, 3))
+
+    def test_missing_product_is_404(self):
+        self.assertEqual(self.client.get('/products/999/').status_code, 404)
+        self.assertEqual(self.client.get('/products/abc/').status_code, 404)
+
+
+class CatalogCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.collection = Collection.objects.create(title='a')
+        self.product = Product.objects.create(title='a', slug='a', unit_price=1, inventory=5,
+                                              collection=self.collection)
+        self.promotion = Promotion.objects.create(description='a', discount=5)
+        self.client = APIClient()
+
+    def get(self, url):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def assertCacheMissAfter(self, change, url='/products/'):
+        self.get(url)
+        # Повторный запрос отдается из кэша без запросов к базе
+        with self.assertNumQueries(0):
+            self.get(url)
+        with self.captureOnCommitCallbacks(execute=True):
+            change()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.get(url)
+        self.assertTrue(queries.captured_queries, 'ответ взят из кэша')
+        return response
+
+    def test_product_save(self):
+        def change():
+            self.product.title = 'b'
+            self.product.save()
+        response = self.assertCacheMissAfter(change)
+        self.assertEqual(response.data['results'][0]['title'], 'b')
+        self.assertCacheMissAfter(change, '/collections/')
+
+    def test_collection_save(self):
+        def change():
+            self.collection.title = 'b'
+            self.collection.save()
+        self.assertCacheMissAfter(change)
+        response = self.assertCacheMissAfter(change, '/collections/')
+        self.assertEqual(response.data[0]['title'], 'b')
+
+    def test_product_image_save(self):
+        response = self.assertCacheMissAfter(
+            lambda: ProductImage.objects.create(product=self.product, image='store/images/a.jpg'))
+        self.assertEqual(len(response.data['results'][0]['images']), 1)
+
+    def test_promotion_save(self):
+        def change():
+            self.promotion.discount = 10
+            self.promotion.save()
+        self.assertCacheMissAfter(change)
+
+    def test_promotion_m2m_change(self):
+        self.assertCacheMissAfter(lambda: self.product.promotion.add(self.promotion))
+        self.assertCacheMissAfter(lambda: self.promotion.product_set.remove(self.product))
+        self.assertCacheMissAfter(lambda: self.product.promotion.clear())
+
+
+class ProductsCountTests(TestCase):
+    def setUp(self):
+        self.a, self.b = Collection.objects.create(title='a'), Collection.objects.create(title='b')
+        self.products = [Product.objects.create(title=str(i), slug=str(i), unit_price=1,
+                                                inventory=1, collection=self.a)
+                         for i in range(3)]
+
+    def assertCounts(self, a, b):
+        counts = dict(Collection.objects.values_list('pk', 'products_count'))
+        self.assertEqual((counts[self.a.pk], counts[self.b.pk]), (a, b))
+        # Хранимые счетчики совпадают с посчитанными по таблице товаров
+        for collection in Collection.objects.annotate(actual=Count('products')):
+            self.assertEqual(collection.products_count, collection.actual)
+
+    def test_create_and_delete(self):
+        self.assertCounts(3, 0)
+        Product.objects.bulk_create([Product(title='x', slug='x', unit_price=1, inventory=1,
+                                             collection=self.b)])
+        self.assertCounts(3, 1)
+        self.products[0].delete()
+        Product.objects.filter(collection=self.b).delete()
+        self.assertCounts(2, 0)
+
+    def test_move_by_save(self):
+        product = self.products[0]
+        product.collection = self.b
+        product.save()
+        self.assertCounts(2, 1)
+        # Повторное сохранение без переноса ничего не меняет
+        product.title = 'moved'
+        product.save()
+        self.assertCounts(2, 1)
+        product = Product.objects.get(pk=product.pk)
+        product.collection_id = self.a.id
+        product.save()
+        self.assertCounts(3, 0)
+
+    def test_queryset_update(self):
+        Product.objects.filter(pk=self.products[0].pk).update(collection=self.b)
+        self.assertCounts(2, 1)
+        # Товары, которые уже в целевой категории, не считаются дважды
+        Product.objects.all().update(collection_id=self.b.id)
+        self.assertCounts(0, 3)
+        Product.objects.all().update(title='t')
+        self.assertCounts(0, 3)
+
+    def test_bulk_update(self):
+        first, second, third = self.products
+        first.collection = self.b
+        second.collection = self.b
+        third.title = 'same collection'
+        Product.objects.bulk_update([first, second, third], ['collection', 'title'])
+        self.assertCounts(1, 2)
+        first.collection = self.a
+        Product.objects.bulk_update([first], ['collection_id'], batch_size=1)
+        self.assertCounts(2, 1)
+        Product.objects.bulk_update([second], ['title'])
+        self.assertCounts(2, 1)
+
+
+
+class CartTotalTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        collection = Collection.objects.create(title='a')
+        self.a, self.b = [Product.objects.create(title=title, slug=title, unit_price=price,
+                                                 inventory=10, collection=collection)
+                          for title, price in (('a', 2), ('b', 5))]
+        self.client = APIClient()
+        self.cart_id = self.client.post('/carts/').data['id']
+        self.url = f'/carts/{self.cart_id}/'
+
+    def request(self, method, url, data=None):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = getattr(self.client, method)(url, data, format='json')
+        self.assertLess(response.status_code, 300, response.data)
+        return response
+
+    def assertTotal(self, total):
+        self.assertEqual(self.request('get', self.url).data['total_price'], total)
+        # Второй раз сумма берется из кэша
+        self.assertEqual(self.request('get', self.url).data['total_price'], total)
+
+    def test_total_follows_cart_item_writes(self):
+        self.assertTotal(0)
+        item_id = self.request('post', f'{self.url}items/',
+                               {'product_id': self.a.id, 'quantity': 3}).data['id']
+        self.assertTotal(6)
+        self.request('post', f'{self.url}items/', {'product_id': self.a.id, 'quantity': 1})
+        self.assertTotal(8)
+        self.request('patch', f'{self.url}items/{item_id}/', {'quantity': 1})
+        self.assertTotal(2)
+        self.request('post', f'{self.url}items/batch/', {'operations': [
+            {'op': 'add', 'product_id': self.b.id, 'quantity': 2},
+            {'op': 'set', 'product_id': self.a.id, 'quantity': 4},
+        ]})
+        self.assertTotal(18)
+        self.request('delete', f'{self.url}items/{item_id}/')
+        self.assertTotal(10)
+
+    def test_total_follows_price_change(self):
+        self.request('post', f'{self.url}items/', {'product_id': self.b.id, 'quantity': 2})
+        self.assertTotal(10)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.b.unit_price = 7
+            self.b.save()
+        self.assertTotal(14)
+
+
+class ReviewStatsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        collection = Collection.objects.create(title='a')
+        self.product = Product.objects.create(title='a', slug='a', unit_price=1, inventory=1,
+                                              collection=collection)
+        self.client = APIClient()
+        self.url = f'/products/{self.product.id}/reviews/'
+        today = timezone.now().date()
+        self.reviews = []
+        for days in (2, 1, 0):
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.post(self.url, {'name': 'a', 'description': 'a'})
+            review_id = response.data['id']
+            # date проставляется при создании - сдвигаем в прошлое мимо сигналов
+            Review.objects.filter(pk=review_id).update(date=today - timedelta(days=days))
+            self.reviews.append((review_id, today - timedelta(days=days)))
+
+    def stats(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            data = self.client.get(f'/products/{self.product.id}/').data
+        return data['review_count'], data['last_review_date']
+
+    def delete(self, review_id):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.delete(f'{self.url}{review_id}/')
+        self.assertEqual(response.status_code, 204)
+
+    def test_delete_latest_review_moves_last_date_back(self):
+        self.assertEqual(self.stats(), (3, self.reviews[2][1].isoformat()))
+        self.delete(self.reviews[2][0])
+        self.assertEqual(self.stats(), (2, self.reviews[1][1].isoformat()))
+
+    def test_delete_older_review_keeps_last_date(self):
+        self.delete(self.reviews[0][0])
+        self.assertEqual(self.stats(), (2, self.reviews[2][1].isoformat()))
+
+    def test_delete_all_reviews(self):
+        for review_id, date in self.reviews:
+            self.delete(review_id)
+        self.assertEqual(self.stats(), (0, None))
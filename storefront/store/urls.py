@@ -15,6 +15,7 @@ router.register('collections', views.CollectionViewSet)
 router.register('carts', views.CartViewSet)
 router.register('customers', views.CustomerViewSet)
 router.register('orders', views.OrderViewSet, basename='orders')
+router.register('reports/sales', views.SalesReportViewSet, basename='sales-report')
 
 products_router = routers.NestedDefaultRouter(router, 'products', lookup='product') # product_pk
 products_router.register('reviews', views.ReviewViewSet, basename='product-reviews')
@@ -1,12 +1,13 @@
 from django.shortcuts import get_object_or_404
+from django.conf import settings
 from .models import *
 from django.http import HttpResponse
-from django.db.models import Count
 
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 from rest_framework import status
-from .serializers import CollectionSerializer, ProductSerializer, ReviewSerializer
+from .serializers import (CollectionSerializer, ProductSerializer, ReviewSerializer,
+                          FastProductSerializer, get_requested_fields)
 
 # Create your views here.
 # def product_list(request):
@@ -237,7 +238,7 @@ class ProductDetail(RetrieveUpdateDestroyAPIView):
 
 
 class CollectionList(ListCreateAPIView):
-    queryset = Collection.objects.annotate(products_count=Count('products')).all()
+    queryset = Collection.objects.all()
     serializer_class = CollectionSerializer
 
     def get_serializer_context(self):
@@ -246,10 +247,10 @@ class CollectionList(ListCreateAPIView):
 
 class CollectionDetail(RetrieveUpdateDestroyAPIView):
     serializer_class = CollectionSerializer
-    queryset = Collection.objects.annotate(products_count=Count('products')).all()
+    queryset = Collection.objects.all()
 
     def delete(self, request, pk):
-        collection = Collection.objects.annotate(products_count=Count('products')).get(pk=pk)
+        collection = Collection.objects.get(pk=pk)
         if collection.product_set.count() > 0:
             return Response({'error': 'Категория не может быть удалена. '
                                       'Так как в ней есть товары'},
@@ -259,38 +260,125 @@ class CollectionDetail(RetrieveUpdateDestroyAPIView):
 
 
 from rest_framework.viewsets import ModelViewSet
-from rest_framework.filters import SearchFilter, OrderingFilter
-from .paginations import DefaultPagination
-from .filters import ProductFilter
+from rest_framework.filters import OrderingFilter
+from .paginations import ProductPagination, OrderPagination, ReviewPagination
+from .filters import ProductFilter, ProductSearchFilter
 from django_filters.rest_framework import DjangoFilterBackend
 from .permissions import IsAdminOrReadOnly
+from .cache import CachedResponseMixin
+from . import cache
+from .facets import get_facets
+from .conditional import ConditionalGetMixin
+from . import bulk
+from django.http import StreamingHttpResponse
+from rest_framework.decorators import action
+from rest_framework.permissions import IsAdminUser
 
-class ProductViewSet(ModelViewSet):
+class ProductViewSet(ConditionalGetMixin, CachedResponseMixin, ModelViewSet):
     serializer_class = ProductSerializer
     queryset = Product.objects.select_related('collection').all()
-    pagination_class = DefaultPagination
+    pagination_class = ProductPagination
 
     permission_classes = [IsAdminOrReadOnly]
+    # При изменении этих моделей закэшированные ответы устаревают
+    cache_models = (Product, ProductImage, Promotion, Collection)
+    # Ответ товара меняется вместе с его last_update (сигналы трогают его
+    # при смене картинок, акций и категории), с ?expand=collection - и категории
+    version_fields = ('last_update', 'collection__last_update')
 
-    filter_backends = [DjangoFilterBackend, SearchFilter, OrderingFilter]
+    filter_backends = [DjangoFilterBackend, ProductSearchFilter, OrderingFilter]
     filterset_class = ProductFilter
     search_fields = ['title', 'description']
     ordering_fields = ['unit_price', 'last_update']
 
+    def use_fast_serializer(self):
+        # Быстрый путь только для чтения: GET list и retrieve
+        return (getattr(settings, 'STORE_FAST_PRODUCT_SERIALIZER', False)
+                and self.request.method in ('GET', 'HEAD')
+                and self.action in ('list', 'retrieve'))
+
+    def get_queryset(self):
+        # Грузим только то, что попросили в ?fields= и ?expand=
+        columns = FastProductSerializer.get_values_fields(self.request)
+        if self.use_fast_serializer():
+            return Product.objects.values(*columns)
+        fields, expand = get_requested_fields(self.request)
+        queryset = Product.objects.all()
+        if fields is not None:
+            queryset = queryset.only(*columns)
+        if 'collection' in expand and (fields is None or 'collection' in fields):
+            queryset = queryset.select_related('collection')
+        if fields is None or 'images' in fields:
+            queryset = queryset.prefetch_related('images')
+        return queryset
+
+    def get_serializer_class(self):
+        if self.use_fast_serializer():
+            return FastProductSerializer
+        return ProductSerializer
+
     def get_serializer_context(self):
         return {'request': self.request}
 
+    # Счетчики фасетов для текущего поиска и фильтров: GET /products/facets/
+    @action(detail=False, methods=['GET'])
+    def facets(self, request):
+        key = cache.make_key('products-facets', request, self.cache_models)
+        data = cache.get_cache().get(key)
+        if data is None:
+            queryset = ProductSearchFilter().filter_queryset(request, Product.objects.all(), self)
+            data = get_facets(request, queryset)
+            cache.get_cache().set(key, data,
+                                  getattr(settings, 'STORE_FACETS_CACHE_TIMEOUT', 30))
+        return Response(data)
+
+    # Массовый импорт товаров: POST /products/import/
+    # Тело - NDJSON (по умолчанию) или CSV (Content-Type: text/csv)
+    @action(detail=False, methods=['POST'], url_path='import',
+            permission_classes=[IsAdminUser])
+    def import_products(self, request):
+        batch_size = bulk.get_batch_size(request.query_params.get('batch_size'))
+        # Тело читаем построчно в байтах, декодирует bulk
+        if request.content_type.startswith('text/csv'):
+            records = bulk.read_csv(request._request)
+        else:
+            records = bulk.read_ndjson(request._request)
+        result = bulk.ProductImporter(batch_size).run(records)
+        return Response(result)
+
+    # Массовый экспорт товаров: GET /products/export/?output=csv|ndjson
+    @action(detail=False, methods=['GET'], url_path='export',
+            permission_classes=[IsAdminUser])
+    def export_products(self, request):
+        chunk_size = bulk.get_batch_size(request.query_params.get('chunk_size'),
+                                         'STORE_EXPORT_CHUNK_SIZE')
+        queryset = self.filter_queryset(Product.objects.all())
+        if request.query_params.get('output') == 'csv':
+            response = StreamingHttpResponse(bulk.export_csv(queryset, chunk_size),
+                                             content_type='text/csv')
+            response['Content-Disposition'] = 'attachment; filename="products.csv"'
+        else:
+            response = StreamingHttpResponse(bulk.export_ndjson(queryset, chunk_size),
+                                             content_type='application/x-ndjson')
+            response['Content-Disposition'] = 'attachment; filename="products.ndjson"'
+        return response
+
     def destroy(self, request, *args, **kwargs):
-        if OrderItem.objects.filter(product_id=self.kwargs['pk']).count() > 0:
+        # Заказы могли уже уехать в архив - их строки тоже держат товар
+        product_id = self.kwargs['pk']
+        if (OrderItem.objects.filter(product_id=product_id).exists()
+                or ArchivedOrderItem.objects.filter(product_id=product_id).exists()):
             return Response({'error': 'Товар не может быть удален. Так как он есть в заказах'},
                             status=status.HTTP_405_METHOD_NOT_ALLOWED)
         return super().destroy(self, request, *args, **kwargs)
 
 
-class CollectionViewSet(ModelViewSet):
+class CollectionViewSet(ConditionalGetMixin, CachedResponseMixin, ModelViewSet):
     serializer_class = CollectionSerializer
-    queryset = Collection.objects.annotate(products_count=Count('products')).all()
+    queryset = Collection.objects.all()
     permission_classes = [IsAdminOrReadOnly]
+    cache_models = (Collection, Product)
+    version_fields = ('last_update',)
 
 
     def get_serializer_context(self):
@@ -306,6 +394,7 @@ class CollectionViewSet(ModelViewSet):
 
 class ReviewViewSet(ModelViewSet):
     serializer_class = ReviewSerializer
+    pagination_class = ReviewPagination
 
     # Указываем какие отзывы выводим
     def get_queryset(self):
@@ -317,19 +406,39 @@ class ReviewViewSet(ModelViewSet):
 
 from rest_framework.mixins import CreateModelMixin, RetrieveModelMixin, DestroyModelMixin
 from rest_framework.viewsets import GenericViewSet
-from .serializers import (CartSerializer, CartItemSerializer,
-                          AddCartItemSerializer, UpdateCartItemSerializer)
+from django.db.models import Prefetch
+from .idempotency import IdempotentCreateMixin
+from .serializers import (CartSerializer, CartItemSerializer, AddCartItemSerializer,
+                          UpdateCartItemSerializer, CartItemBatchSerializer)
 
-class CartViewSet(CreateModelMixin, RetrieveModelMixin,
+
+def get_carts_with_items():
+    # Строки корзины вместе с товаром и суммой строки одним запросом
+    items = (CartItem.objects.select_related('product').with_total_price()
+             .only('id', 'cart_id', 'quantity',
+                   'product__id', 'product__title', 'product__unit_price'))
+    return Cart.objects.prefetch_related(Prefetch('items', queryset=items))
+
+
+class CartViewSet(IdempotentCreateMixin, CreateModelMixin, RetrieveModelMixin,
                   DestroyModelMixin, GenericViewSet):
-    queryset = Cart.objects.prefetch_related('items__product').all()
+    queryset = Cart.objects.all()
     serializer_class = CartSerializer
 
+    def get_queryset(self):
+        fields, expand = get_requested_fields(self.request)
+        # Товары нужны только для items. total_price считается отдельно
+        if fields is not None and 'items' not in fields:
+            return Cart.objects.all()
+        return get_carts_with_items()
+
 
 class CartItemViewSet(ModelViewSet):
     http_method_names = ['get', 'post', 'patch', 'delete']
 
     def get_serializer_class(self):
+        if self.action == 'batch':
+            return CartItemBatchSerializer
         if self.request.method == 'POST':
             return AddCartItemSerializer
         elif self.request.method == 'PATCH':
@@ -340,7 +449,18 @@ class CartItemViewSet(ModelViewSet):
         return {'cart_id': self.kwargs['cart_pk']}
 
     def get_queryset(self):
-        return CartItem.objects.filter(cart_id=self.kwargs['cart_pk']).select_related('product')
+        return (CartItem.objects.filter(cart_id=self.kwargs['cart_pk'])
+                .select_related('product').with_total_price())
+
+    # POST /carts/{id}/items/batch/ - все изменения корзины одной транзакцией,
+    # в ответе итоговая корзина
+    @action(detail=False, methods=['post'])
+    def batch(self, request, cart_pk=None):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        cart_id = serializer.save()
+        cart = get_object_or_404(get_carts_with_items(), pk=cart_id)
+        return Response(CartSerializer(cart, context={'request': request}).data)
 
 
 # cb869998-76f4-428a-a569-d1b9caa73e18
@@ -351,6 +471,7 @@ class CartItemViewSet(ModelViewSet):
 from .serializers import CustomerSerializer
 from rest_framework.decorators import action
 from rest_framework.permissions import IsAdminUser, IsAuthenticated
+from . import customers
 
 class CustomerViewSet(ModelViewSet):
     queryset = Customer.objects.all()
@@ -360,10 +481,7 @@ class CustomerViewSet(ModelViewSet):
     # customers/me как и users/me
     @action(detail=False, methods=['GET', 'PUT'], permission_classes=[IsAuthenticated])
     def me(self, request):
-        try:
-            customer = Customer.objects.get(user_id=request.user.id)
-        except:
-            customer, created = Customer.objects.get_or_create(user_id=request.user.id)
+        customer = customers.get_customer(request)
 
         if request.method == 'GET':
             serializer = CustomerSerializer(customer)
@@ -375,12 +493,15 @@ class CustomerViewSet(ModelViewSet):
             return Response(serializer.data)
 
 
-from .serializers import OrderSerializer, OrderItemSerializer
-from .serializers import CreateOrderSerializer, UpdateOrderSerializer
+from .serializers import OrderSerializer, OrderItemSerializer, OrderSummarySerializer
+from .serializers import ArchivedOrderSerializer, ArchivedOrderSummarySerializer
+from django.http import Http404
+from .serializers import CreateOrderSerializer, UpdateOrderSerializer, InsufficientInventory
 
 
-class OrderViewSet(ModelViewSet):
+class OrderViewSet(IdempotentCreateMixin, ModelViewSet):
     http_method_names = ['get', 'post', 'patch', 'delete', 'head', 'options']
+    pagination_class = OrderPagination
 
     def get_permissions(self):
         if self.request.method in ['PATCH', 'DELETE']:
@@ -388,10 +509,20 @@ class OrderViewSet(ModelViewSet):
         return [IsAuthenticated()]
 
     def create(self, request, *args, **kwargs):
-        serializer = CreateOrderSerializer(data=request.data,
-                                           context={'user_id': self.request.user.id})
+        # Повтор с тем же Idempotency-Key не создаст второй заказ
+        return self.idempotent_response(self.place_order, request, *args, **kwargs)
+
+    def place_order(self, request, *args, **kwargs):
+        serializer = CreateOrderSerializer(
+            data=request.data, context={'customer_id': customers.get_customer_id(request)}
+        )
         serializer.is_valid(raise_exception=True)
-        order = serializer.save()
+        try:
+            order = serializer.save()
+        except InsufficientInventory as error:
+            # Заказ не создан, остатки не изменились
+            return Response({'detail': str(error), 'items': error.shortfall},
+                            status=status.HTTP_409_CONFLICT)
         serializer = OrderSerializer(order)
         return Response(serializer.data)
 
@@ -400,16 +531,79 @@ class OrderViewSet(ModelViewSet):
             return CreateOrderSerializer
         elif self.request.method == 'PATCH':
             return UpdateOrderSerializer
+        if self.is_archive():
+            return ArchivedOrderSummarySerializer if self.is_summary() else ArchivedOrderSerializer
+        if self.is_summary():
+            return OrderSummarySerializer
         return OrderSerializer
 
-    def get_queryset(self):
-        user = self.request.user
+    def is_archive(self):
+        # ?archived=true - старая история из архива. Только для чтения
+        if self.request.method not in ('GET', 'HEAD'):
+            return False
+        return (getattr(self, 'read_archive', False)
+                or self.request.query_params.get('archived') in ('1', 'true'))
 
+    def get_object(self):
+        # Заказа нет в горячей таблице - ищем его в архиве
+        try:
+            return super().get_object()
+        except Http404:
+            if self.action != 'retrieve' or self.is_archive():
+                raise
+        self.read_archive = True
+        return super().get_object()
+
+    def is_summary(self):
+        # ?summary=true - история заказов только с итогами, без строк заказа
+        return (self.action == 'list'
+                and self.request.query_params.get('summary') in ('1', 'true'))
+
+    def select_requested(self, queryset):
+        if self.is_summary():
+            return queryset.only('id', 'placed_at', 'payment_status',
+                                 'total_price', 'item_count')
+        # Подстраиваем запрос под ?fields= и ?expand=
+        fields, expand = get_requested_fields(self.request)
+        if self.action in ('list', 'retrieve') and (fields is None or 'items' in fields):
+            queryset = queryset.prefetch_related('items__product')
+        if fields is not None:
+            columns = {'id', 'placed_at', 'customer_id'} | (
+                fields & {'payment_status', 'total_price', 'item_count'})
+            queryset = queryset.only(*columns)
+        if 'customer' in expand and (fields is None or 'customer' in fields):
+            queryset = queryset.select_related('customer')
+        return queryset
+
+    def get_orders(self, model):
         # Если админ - можно видеть все заказы
-        if user.is_staff:
-            return Order.objects.all()
-
-        customer_id = Customer.objects.only('id').get(user_id=user.id)
-        return Order.objects.filter(customer_id=customer_id)
+        if self.request.user.is_staff:
+            return model.objects.all()
         # Если это простой смертный - то возвращаем только ЕГО заказы
+        customer_id = customers.get_customer_id(self.request)
+        return model.objects.filter(customer_id=customer_id)
+
+    def has_archive(self):
+        # Горячая история закончилась - есть ли продолжение в архиве (OrderPagination)
+        return not self.is_archive() and self.get_orders(ArchivedOrder).exists()
+
+    def get_queryset(self):
+        # По умолчанию читаем только горячую таблицу
+        model = ArchivedOrder if self.is_archive() else Order
+        return self.select_requested(self.get_orders(model))
+
+
+from .serializers import SalesReportQuerySerializer
+from . import sales
+
+
+# GET /reports/sales/?date_from=2024-01-01&date_to=2024-01-31&group=day|product|collection
+# Отвечает по сводкам продаж, строки заказов не читает
+class SalesReportViewSet(GenericViewSet):
+    permission_classes = [IsAdminUser]
+
+    def list(self, request):
+        query = SalesReportQuerySerializer(data=request.query_params)
+        query.is_valid(raise_exception=True)
+        return Response(sales.get_report(**query.validated_data))
 
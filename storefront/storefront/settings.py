@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/5.0/ref/settings/
 """
 
 from pathlib import Path
+from corsheaders.defaults import default_headers
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -63,6 +64,8 @@ MIDDLEWARE = [
 CORS_ALLOWED_ORIGINS = [
     'http://localhost:5173'
 ]
+CORS_ALLOW_HEADERS = (*default_headers, 'idempotency-key')
+CORS_EXPOSE_HEADERS = ['Idempotent-Replayed']
 
 
 ROOT_URLCONF = 'storefront.urls'
@@ -93,10 +96,82 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # Тесты на конкурентность ходят в базу из нескольких потоков.
+        # Общая база в памяти блокирует таблицы между соединениями,
+        # поэтому тестовая база - файл
+        'TEST': {'NAME': BASE_DIR / 'test_db.sqlite3'},
     }
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/5.0/topics/cache/
+# Локально хватает locmem. На проде можно подключить redis/memcached,
+# store будет работать с любым бэкендом. С locmem у каждого процесса
+# свой кэш: отзыв JWT и отключение пользователя (store.authentication)
+# другие процессы увидят через STORE_JWT_USER_STATE_TTL секунд
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+STORE_CACHE_ALIAS = 'default'  # Какой кэш использовать для ответов каталога
+STORE_CACHE_TIMEOUT = 60 * 5  # Сколько секунд живет ответ в кэше
+STORE_CART_TOTAL_CACHE_TIMEOUT = 60 * 60  # Сумма корзины, сбрасывается при изменении корзины
+STORE_CART_MAX_AGE_DAYS = 30  # Корзины старше удаляет manage.py delete_abandoned_carts
+
+# Idempotency-Key: сколько секунд хранить ответ и сколько ждать
+# параллельный запрос с тем же ключом
+STORE_IDEMPOTENCY_TTL = 60 * 60 * 24
+STORE_IDEMPOTENCY_WAIT = 10
+# Сколько секунд ключ занят незавершенным запросом. Больше самого
+# долгого запроса: после этого повтор считает, что воркер упал
+STORE_IDEMPOTENCY_LEASE = 60
+
+# Сколько секунд помнить, какой покупатель у пользователя
+STORE_CUSTOMER_CACHE_TIMEOUT = 60 * 60
+# Сколько секунд доверять закэшированному состоянию пользователя (активен ли,
+# админ ли, пароль, покупатель). Столько же максимум живет токен, отозванный
+# в обход сигналов или в другом процессе с кэшем в памяти (locmem)
+STORE_JWT_USER_STATE_TTL = 60
+
+# Фоновые задачи (manage.py run_tasks): попытки, отсрочка повтора в секундах
+# (удваивается с каждой попыткой) и через сколько секунд зависшая задача
+# снова попадает в очередь
+STORE_TASK_MAX_ATTEMPTS = 5
+STORE_TASK_RETRY_DELAY = 10
+STORE_TASK_MAX_RETRY_DELAY = 60 * 60
+STORE_TASK_TIMEOUT = 60 * 5
+STORE_TASK_KEEP_DONE_DAYS = 7
+# Порог остатка для уведомления о заканчивающемся товаре
+STORE_LOW_STOCK_THRESHOLD = 10
+
+# Уменьшенные копии картинок товаров: вариант -> максимальная сторона в пикселях.
+# Каждый строится в WebP и JPEG фоновой задачей после загрузки
+STORE_IMAGE_VARIANTS = {'thumbnail': 150, 'card': 600, 'zoom': 1600}
+# Файл картинки без ссылок удаляется (manage.py delete_orphaned_blobs),
+# только если его не использовали столько секунд
+STORE_BLOB_GC_GRACE = 60 * 60 * 24
+
+# Заказы старше переносит в архив manage.py archive_orders
+STORE_ORDER_ARCHIVE_DAYS = 365
+
+EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
+
+# Отдавать товары (GET list/retrieve) через FastProductSerializer. Включается явно
+STORE_FAST_PRODUCT_SERIALIZER = False
+
+# Фасеты каталога: границы ценовых диапазонов и сколько секунд кэшировать ответ
+STORE_FACET_PRICE_BUCKETS = [0, 10, 50, 100, 500]
+STORE_FACETS_CACHE_TIMEOUT = 30
+
+# Массовый импорт/экспорт товаров: сколько записей в одной пачке
+STORE_IMPORT_BATCH_SIZE = 500
+STORE_EXPORT_CHUNK_SIZE = 2000
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
 
@@ -136,6 +211,20 @@ STATIC_ROOT = BASE_DIR / 'static'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+STORAGES = {
+    'default': {
+        'BACKEND': 'django.core.files.storage.FileSystemStorage',
+    },
+    'staticfiles': {
+        'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage',
+    },
+    # Картинки товаров: файл с одинаковым содержимым хранится один раз
+    'product_images': {
+        'BACKEND': 'store.storage.ContentAddressedStorage',
+        'OPTIONS': {'prefix': 'store/images'},
+    },
+}
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.0/ref/settings/#default-auto-field
 
@@ -145,14 +234,16 @@ REST_FRAMEWORK = {
     'COERCE_DECIMAL_TO_STRING': False,
     # Вырубит отображение дробных чисел как строка "12.50" -> 12.50
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        # Права и покупатель берутся из claims токена, без запроса пользователя
+        'store.authentication.ClaimsJWTAuthentication',
     )
 }
 from datetime import timedelta
 
 SIMPLE_JWT = {
     'AUTH_HEADER_TYPES': ('JWT',),
-    'ACCESS_TOKEN_LIFETIME': timedelta(days=1)
+    'ACCESS_TOKEN_LIFETIME': timedelta(days=1),
+    'TOKEN_OBTAIN_SERIALIZER': 'store.authentication.ClaimsTokenObtainPairSerializer',
 }
 
 # AUTH_USER_MODEL = 'core.User'